@@ -38,6 +38,16 @@ register(id="sym_pendulum-v0", entry_point="seagul.envs.classic_control:Pendulum
 register(id="dt_pendulum-v0", entry_point="seagul.envs.classic_control:PendulumDtEnv", max_episode_steps=200)
 register(id="su_acro_drake-v0", entry_point="seagul.envs.drake:DrakeAcroEnv")
 
+# Batched versions of the classic_control envs, these step (num_envs, state_dim) arrays, see seagul.envs.classic_control.vec_env
+register(id="su_cartpole_vec-v0", entry_point="seagul.envs.classic_control:VecSUCartPoleEnv")
+register(id="sg_cartpole_vec-v0", entry_point="seagul.envs.classic_control:VecSGCartPoleEnv")
+register(id="su_cartpole_push_vec-v0", entry_point="seagul.envs.classic_control:VecSUCartPolePushEnv")
+register(id="su_cartpole_discrete_vec-v0", entry_point="seagul.envs.classic_control:VecSUCartPoleDiscEnv")
+register(id="su_acrobot_vec-v0", entry_point="seagul.envs.classic_control:VecSGAcroEnv")
+register(id="su_acrobot_vec-v2", entry_point="seagul.envs.classic_control:VecSGAcroEnv2")
+register(id="su_acroswitch_vec-v0", entry_point="seagul.envs.classic_control:VecSGAcroSwitchEnv")
+register(id="su_acroswitchsin_vec-v0", entry_point="seagul.envs.classic_control:VecSGAcroSwitchSinEnv")
+
 register(id="bball-v0", entry_point="seagul.envs.matlab:BBallEnv")
 register(id="bball3-v0", entry_point="seagul.envs.matlab:BBallEnv3")
 
@@ -16,3 +16,7 @@ from seagul.envs.classic_control.acroswitchsin import SGAcroSwitchSinEnv
 
 from seagul.envs.classic_control.sym_pendulum import PendulumSymEnv
 from seagul.envs.classic_control.dt_pendulum import PendulumDtEnv
+
+from seagul.envs.classic_control.vec_env import VecEnv, SerialVecEnv, make_vec_env
+from seagul.envs.classic_control.vec_cartpole import VecSUCartPoleEnv, VecSGCartPoleEnv, VecSUCartPolePushEnv, VecSUCartPoleDiscEnv
+from seagul.envs.classic_control.vec_acrobot import VecSGAcroEnv, VecSGAcroEnv2, VecSGAcroSwitchEnv, VecSGAcroSwitchSinEnv
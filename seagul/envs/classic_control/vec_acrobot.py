@@ -0,0 +1,256 @@
+import numpy as np
+import torch
+from gym import spaces
+from numpy import sin, cos, pi
+
+from seagul.integration import rk4, euler, wrap
+from seagul.envs.classic_control.vec_env import VecEnv
+
+
+def default_vec_reward(ns, a):
+    return np.sin(ns[:, 0]) + np.sin(ns[:, 0] + ns[:, 1]), np.zeros(ns.shape[0], dtype=bool)
+
+
+class VecSGAcroEnv(VecEnv):
+    """
+    Batched counterpart of SGAcroEnv, see VecEnv for the batch interface.
+
+    Takes the same arguments as SGAcroEnv except that reward_fn must work on a whole batch, it is passed the wrapped
+    (num_envs, 4) state and (num_envs, 1) actions and returns (rewards, dones), each of shape (num_envs,)
+    """
+
+    def __init__(self,
+                 num_envs=64,
+                 max_torque=25,
+                 init_state=np.array([-pi/2, 0.0, 0.0, 0.0]),
+                 init_state_weights=np.array([0.0, 0.0, 0.0, 0.0]),
+                 dt=.01,
+                 max_t=5,
+                 act_hold=1,
+                 integrator=euler,
+                 reward_fn=default_vec_reward,
+                 th1_range=[0, 2 * pi],
+                 th2_range=[-pi, pi],
+                 max_th1dot=float('inf'),
+                 max_th2dot=float('inf'),
+                 m1=1,
+                 m2=1,
+                 l1=1,
+                 lc1=.5,
+                 lc2=.5,
+                 i1=.2,
+                 i2=.8,
+                 auto_reset=True,
+                 ):
+        self.state_dim = 4
+        self.init_state = np.asarray(init_state, dtype=np.float64)
+        self.init_state_weights = np.asarray(init_state_weights, dtype=np.float64)
+        self.dt = dt
+        self.max_t = max_t
+        self.act_hold = act_hold
+        self.reward_fn = reward_fn
+        self.integrator = integrator
+
+        self.max_th1dot = max_th1dot
+        self.max_th2dot = max_th2dot
+        self.th1_range = th1_range
+        self.th2_range = th2_range
+        self.max_torque = max_torque
+
+        self.m1 = m1
+        self.m2 = m2
+        self.l1 = l1
+        self.lc1 = lc1
+        self.lc2 = lc2
+        self.i1 = i1
+        self.i2 = i2
+
+        self.observation_space = self._make_observation_space()
+        self.action_space = spaces.Box(low=np.array([-max_torque], dtype=np.float32), high=np.array([max_torque], dtype=np.float32), dtype=np.float32)
+
+        self.num_steps = int(self.max_t / (self.act_hold * self.dt))
+        super(VecSGAcroEnv, self).__init__(num_envs, auto_reset)
+        self.reset()
+
+    @property
+    def t(self):
+        return self.cur_step * self.dt * self.act_hold
+
+    def _make_observation_space(self):
+        low = np.array([self.th1_range[0], self.th2_range[0], -self.max_th1dot, -self.max_th2dot], dtype=np.float32)
+        high = np.array([self.th1_range[1], self.th2_range[1], self.max_th1dot, self.max_th2dot], dtype=np.float32)
+        return spaces.Box(low=low-1, high=high+1, dtype=np.float32)
+
+    def _reset_rows(self, idx):
+        noise = self.np_random.uniform(size=(idx.shape[0], 4))*(self.init_state_weights * 2) - self.init_state_weights
+        self.state[idx] = self.init_state + noise
+
+    def _integrate(self, a, t):
+        for _ in range(self.act_hold):
+            self.state = self.integrator(self._dynamics, a, t, self.dt, self.state)
+
+    def _step_rows(self, a):
+        a = np.clip(a, -self.max_torque, self.max_torque)
+        t = (self.cur_step + 1) * self.dt * self.act_hold
+        self._integrate(a, t)
+
+        reward, done = self.reward_fn(self._get_state(), a)
+        reward = np.asarray(reward, dtype=np.float64).reshape(-1)
+        done = np.asarray(done, dtype=bool).reshape(-1) | (t >= self.max_t)
+
+        unstable = (np.abs(self.state[:, 2]) > self.max_th1dot) | (np.abs(self.state[:, 3]) > self.max_th2dot)
+        reward = reward - 5 * unstable
+        return reward, done | unstable
+
+    def _get_state(self):
+        s = self.state.copy()
+        s[:, 0] = wrap(s[:, 0], self.th1_range[0], self.th1_range[1])
+        s[:, 1] = wrap(s[:, 1], self.th2_range[0], self.th2_range[1])
+        return s
+
+    def _get_obs(self):
+        return self._get_state()
+
+    def _dynamics(self, t, s0, act):
+        """
+        Batched version of SGAcroEnv._dynamics, the 2x2 mass matrix is inverted in closed form for every row
+
+        Args:
+            t: float or array with the current time (not used)
+            s0: (num_envs, 4) array of states [th1, th2, th1d, th2d]
+            act: (num_envs, 1) array of torques on the second joint
+
+        Returns:
+            (num_envs, 4) array of state derivatives
+        """
+        tau = act[:, 0]
+        th1 = s0[:, 0]
+        th2 = s0[:, 1]
+        th1d = s0[:, 2]
+        th2d = s0[:, 3]
+        g = 9.8
+
+        c2 = cos(th2)
+        s2 = sin(th2)
+        c12 = cos(th1 + th2)
+
+        m11 = self.m1*self.lc1**2 + self.m2*(self.l1**2 + self.lc2**2 + 2*self.l1*self.lc2*c2) + self.i1 + self.i2
+        m22 = self.m2*self.lc2**2 + self.i2
+        m12 = self.m2*(self.lc2**2 + self.l1*self.lc2*c2) + self.i2
+
+        h1 = -self.m2*self.l1*self.lc2*s2*th2d**2 - 2*self.m2*self.l1*self.lc2*s2*th2d*th1d
+        h2 = self.m2*self.l1*self.lc2*s2*th1d**2
+
+        phi1 = (self.m1*self.lc1+self.m2*self.l1)*g*cos(th1) + self.m2*self.lc2*g*c12
+        phi2 = self.m2*self.lc2*g*c12
+
+        b1 = -h1 - phi1
+        b2 = tau - h2 - phi2
+        det = m11*m22 - m12**2
+
+        ds = np.empty_like(s0)
+        ds[:, 0] = th1d
+        ds[:, 1] = th2d
+        ds[:, 2] = (m22*b1 - m12*b2) / det
+        ds[:, 3] = (m11*b2 - m12*b1) / det
+        return ds
+
+
+class VecSGAcroEnv2(VecSGAcroEnv):
+    """
+    Batched counterpart of SGAcroEnv2, observations are [cos(th1), sin(th1), cos(th2), cos(th2), th1d, th2d]
+    """
+
+    def __init__(self, num_envs=64, act_hold=20, **kwargs):
+        super(VecSGAcroEnv2, self).__init__(num_envs=num_envs, act_hold=act_hold, **kwargs)
+
+    def _make_observation_space(self):
+        low = np.array([-1, -1, -1, -1, -self.max_th1dot, -self.max_th2dot], dtype=np.float32)
+        high = -low
+        return spaces.Box(low=low-1, high=high+1, dtype=np.float32)
+
+    def _step_rows(self, a):
+        a = np.clip(a, -self.max_torque, self.max_torque)
+        t = (self.cur_step + 1) * self.dt * self.act_hold
+        self._integrate(a, t)
+
+        reward, done = self.reward_fn(self.state, a)
+        reward = np.asarray(reward, dtype=np.float64).reshape(-1)
+        done = np.asarray(done, dtype=bool).reshape(-1) | (t > self.max_t)
+
+        unstable = (np.abs(self.state[:, 2]) > self.max_th1dot) | (np.abs(self.state[:, 3]) > self.max_th2dot)
+        reward = reward - 5 * unstable
+        return reward, done | unstable
+
+    def _get_obs(self):
+        s = self.state
+        # the repeated cos(th2) matches SGAcroEnv2
+        return np.stack((cos(s[:, 0]), sin(s[:, 0]), cos(s[:, 1]), cos(s[:, 1]), s[:, 2], s[:, 3]), axis=1)
+
+
+class VecSGAcroSwitchEnv(VecSGAcroEnv):
+    """
+    Batched counterpart of SGAcroSwitchEnv.
+
+    gate_fn and controller must accept a batch of states, gate_fn (num_envs, 4) float32 -> (num_envs, 1) logits and
+    controller (num_envs, 4) -> (num_envs, 1) torques. Once a row switches to the controller it stays there until
+    that row is reset.
+    """
+
+    def __init__(self, num_envs=64, gate_fn=None, controller=None, thresh=.9, max_torque=25, lqr_max_torque=None,
+                 act_hold=20, **kwargs):
+        self.gate_fn = gate_fn
+        self.controller = controller
+        self.sig = torch.nn.Sigmoid()
+        self.thresh = thresh
+        self.lqr_on = np.zeros(int(num_envs), dtype=bool)
+
+        if lqr_max_torque is None:
+            self.lqr_max_torque = max_torque
+        else:
+            self.lqr_max_torque = lqr_max_torque
+
+        super(VecSGAcroSwitchEnv, self).__init__(num_envs=num_envs, max_torque=max_torque, act_hold=act_hold, **kwargs)
+
+    def _reset_rows(self, idx):
+        super(VecSGAcroSwitchEnv, self)._reset_rows(idx)
+        self.lqr_on[idx] = False
+
+    def _gate(self):
+        gate_in = torch.as_tensor(np.array(self._get_state(), dtype=np.float32))
+        with torch.no_grad():
+            path = self.sig(torch.as_tensor(self.gate_fn(gate_in))) > self.thresh
+        return np.asarray(path).reshape(-1)
+
+    def _step_rows(self, a):
+        a = np.clip(a, -self.max_torque, self.max_torque)
+        t = (self.cur_step + 1) * self.dt * self.act_hold
+
+        self.lqr_on |= self._gate()
+        for _ in range(self.act_hold):
+            if self.lqr_on.any():
+                lqr_a = np.clip(np.asarray(self.controller(self._get_state())).reshape(self.num_envs, -1),
+                                -self.lqr_max_torque, self.lqr_max_torque)
+                a = np.where(self.lqr_on[:, None], lqr_a, a)
+            self.state = self.integrator(self._dynamics, a, t, self.dt, self.state)
+
+        reward, done = self.reward_fn(self._get_state(), a)
+        reward = np.asarray(reward, dtype=np.float64).reshape(-1)
+        done = np.asarray(done, dtype=bool).reshape(-1) | (t > self.max_t)
+        return reward, done
+
+
+class VecSGAcroSwitchSinEnv(VecSGAcroSwitchEnv):
+    """
+    Batched counterpart of SGAcroSwitchSinEnv, same as VecSGAcroSwitchEnv but observations are
+    [cos(th1), sin(th1), cos(th2), sin(th2), th1d, th2d]
+    """
+
+    def _make_observation_space(self):
+        low = np.array([-1, -1, -1, -1, -self.max_th1dot, -self.max_th2dot], dtype=np.float32)
+        high = -low
+        return spaces.Box(low=low-1, high=high+1, dtype=np.float32)
+
+    def _get_obs(self):
+        s = self.state
+        return np.stack((cos(s[:, 0]), sin(s[:, 0]), cos(s[:, 1]), sin(s[:, 1]), s[:, 2], s[:, 3]), axis=1)
@@ -0,0 +1,232 @@
+import numpy as np
+import gym
+from numpy import cos, sin, pi
+
+from seagul.integration import rk4, euler, wrap
+from seagul.envs.classic_control.vec_env import VecEnv
+
+
+class VecCartPoleBase(VecEnv):
+    """
+    Batched cartpole, shared by the Vec* counterparts of the cartpole envs in this package.
+
+    state: (num_envs, 4) array, each row is [theta(rads), x(m), dtheta(rads/s), dx (m/s)]
+    Subclasses set the physical constants, init_center, theta_range and implement _reward_done
+    """
+
+    metadata = {"render.modes": [], "video.frames_per_second": 15}
+
+    def __init__(self, num_envs, num_steps, dt, auto_reset=True, integrator=euler, n_substeps=5):
+        self.state_dim = 4
+        self.dt = dt
+        self.num_steps = num_steps
+        self.integrator = integrator
+        self.n_substeps = n_substeps
+
+        # might impose an upper limit on these but it would only end the episode
+        self.DTHETA_MAX = 100.0 * pi
+        self.DX_MAX = 500.0
+
+        high = np.array([pi, self.X_MAX, self.DTHETA_MAX, self.DX_MAX])
+        low = -high
+        self.observation_space = gym.spaces.Box(low=low, high=high, dtype=np.float64)
+
+        super(VecCartPoleBase, self).__init__(num_envs, auto_reset)
+        self.reset()
+
+    def _reset_rows(self, idx):
+        self.state[idx] = self.init_center + self.np_random.uniform(
+            -self.init_state_noise_max, self.init_state_noise_max, size=(idx.shape[0], 4)
+        )
+
+    def _get_obs(self):
+        return self.state.copy()
+
+    def _torque(self, actions):
+        torque = np.clip(actions[:, 0], -self.TORQUE_MAX, self.TORQUE_MAX)
+        if self.torque_noise_max > 0:
+            torque = torque + self.np_random.uniform(-self.torque_noise_max, self.torque_noise_max, size=torque.shape)
+        return torque
+
+    def _step_rows(self, actions):
+        torque = self._torque(actions)
+
+        for _ in range(self.n_substeps):
+            self.state = self.integrator(self._derivs, torque, 0, self.dt, self.state)
+            self.state[:, 0] = wrap(self.state[:, 0], self.theta_range[0], self.theta_range[1])
+
+        return self._reward_done(torque)
+
+    def _reward_done(self, torque):
+        raise NotImplementedError
+
+    def _derivs(self, t, q, u):
+        """
+        Batched version of the cartpole dynamics in su_cartpole.py
+
+        Args:
+            t: float with the current time (not actually used but most ODE solvers want to pass this in anyway)
+            q: (num_envs, 4) array of state variables [theta, x, thetadot, xdot]
+            u: (num_envs,) array of forces on the cart
+
+        Returns:
+            dqdt: (num_envs, 4) array with the derivatives of the current state variable [thetadot, xdot, theta2dot, x2dot]
+        """
+        th = q[:, 0]
+        thd = q[:, 2]
+        s = sin(th)
+        c = cos(th)
+
+        dqdt = np.empty_like(q)
+        delta = self.mp * s ** 2 + self.mc
+
+        dqdt[:, 0] = thd
+        dqdt[:, 1] = q[:, 3]
+
+        dqdt[:, 2] = (
+            -self.mp * (thd ** 2) * s * c / delta
+            - (self.mp + self.mc) * self.g * s / delta / self.L
+            - u * c / delta / self.L
+        )
+
+        dqdt[:, 3] = (
+            self.mp * self.L * (thd ** 2) * s / delta
+            + self.mp * self.L * self.g * s * c / delta / self.L
+            + u / delta
+        )
+
+        return dqdt
+
+
+class VecSUCartPoleEnv(VecCartPoleBase):
+    """
+    Batched counterpart of SUCartPoleEnv, see VecEnv for the batch interface
+    """
+
+    def __init__(self, num_envs=64, num_steps=1500, dt=0.001, L=1.0, mc=4.0, mp=1.0, g=9.8, auto_reset=True):
+        self.L = L
+        self.mc = mc
+        self.mp = mp
+        self.g = g
+
+        self.X_MAX = 50.0
+        self.TORQUE_MAX = 5.0
+        self.torque_noise_max = 0.0
+        self.init_state_noise_max = 0.1
+        self.init_center = np.array([0.0, 0.0, 0.0, 0.0])
+        self.theta_range = (-2 * pi, 2 * pi)
+        self.action_space = gym.spaces.Box(-self.TORQUE_MAX, self.TORQUE_MAX, shape=(1,), dtype=np.float32)
+
+        super(VecSUCartPoleEnv, self).__init__(num_envs, num_steps, dt, auto_reset)
+
+    def _reward_done(self, torque):
+        reward = (
+            -5 * np.cos(self.state[:, 0])
+            - 0.001 * self.state[:, 2] ** 2
+            - 0.001 * self.state[:, 3] ** 2
+            - 0.001 * torque ** 2
+        )
+
+        done = (self.cur_step + 1) > self.num_steps
+        reward -= 5 * (np.logical_not(done) & (np.abs(self.state[:, 1]) > self.X_MAX))
+        return reward, done
+
+
+class VecSGCartPoleEnv(VecCartPoleBase):
+    """
+    Batched counterpart of SGCartPoleEnv, see VecEnv for the batch interface
+    """
+
+    def __init__(self, num_envs=64, num_steps=1500, dt=0.01, auto_reset=True):
+        self.L = 1.0
+        self.mc = 4.0
+        self.mp = 1.0
+        self.g = 9.8
+
+        self.X_MAX = 50.0
+        self.TORQUE_MAX = 5.0
+        self.torque_noise_max = 0.0
+        self.init_state_noise_max = 0.1
+        self.init_center = np.array([pi, 0.0, 0.0, 0.0])
+        self.theta_range = (-2 * pi, 2 * pi)
+        self.action_space = gym.spaces.Box(-self.TORQUE_MAX, self.TORQUE_MAX, shape=(1,), dtype=np.float32)
+
+        super(VecSGCartPoleEnv, self).__init__(num_envs, num_steps, dt, auto_reset)
+
+    def _reward_done(self, torque):
+        upright = ((pi - 0.2) < self.state[:, 0]) & (self.state[:, 0] < (pi + 0.2))
+        reward = upright.astype(np.float64)
+        time_up = (self.cur_step + 1) > self.num_steps
+        reward -= 5 * (np.logical_not(time_up) & (np.abs(self.state[:, 1]) > self.X_MAX))
+        done = np.logical_not(upright) | time_up
+        return reward, done
+
+
+class VecSUCartPolePushEnv(VecCartPoleBase):
+    """
+    Batched counterpart of SUCartPolePushEnv, see VecEnv for the batch interface
+    """
+
+    def __init__(self, num_envs=64, num_steps=4500, dt=0.001, auto_reset=True):
+        self.L = 5.0
+        self.mc = 4.0
+        self.mp = 5.0
+        self.g = 9.8
+
+        self.X_MAX = 50.0
+        self.TORQUE_MAX = 50.0
+        self.torque_noise_max = 0.0
+        self.init_state_noise_max = 0.0
+        self.init_center = np.array([pi, 0.0, 0.0, 0.0])
+        self.theta_range = (-2 * pi, 2 * pi)
+        self.action_space = gym.spaces.Box(-self.TORQUE_MAX, self.TORQUE_MAX, shape=(1,), dtype=np.float32)
+
+        super(VecSUCartPolePushEnv, self).__init__(num_envs, num_steps, dt, auto_reset, integrator=rk4)
+
+    def _step_rows(self, actions):
+        # Randomly apply a perturbation to the rows that are near upright
+        near_top = (self.state[:, 0] > 145 * pi / 180) & (self.state[:, 0] < 215 * pi / 180)
+        push = near_top & (self.np_random.uniform(size=self.num_envs) > 0.99)
+        self.state[push, 0] += self.np_random.normal(0, 0.2, size=np.count_nonzero(push))
+
+        return super(VecSUCartPolePushEnv, self)._step_rows(actions)
+
+    def _reward_done(self, torque):
+        reward = -np.cos(self.state[:, 0])
+        done = (self.cur_step + 1) > self.num_steps
+        reward -= 5 * (np.logical_not(done) & (np.abs(self.state[:, 1]) > self.X_MAX))
+        return reward, done
+
+
+class VecSUCartPoleDiscEnv(VecCartPoleBase):
+    """
+    Batched counterpart of SUCartPoleDiscEnv, actions are (num_envs,) indices into AVAIL_ACTIONS
+    """
+
+    def __init__(self, num_envs=64, num_steps=1500, dt=0.2, auto_reset=True):
+        self.L = 1.0
+        self.mc = 4.0
+        self.mp = 1.0
+        self.g = 9.8
+
+        self.X_MAX = 100.0
+        self.TORQUE_LIMIT = 1000.0
+        self.AVAIL_ACTIONS = np.array([+1.0, 0.0, -1.0])
+        self.torque_noise_max = 0.0
+        self.init_state_noise_max = 0.0
+        self.init_center = np.array([0.0, 0.0, 0.0, 0.0])
+        self.theta_range = (0, 2 * pi)
+        self.action_space = gym.spaces.Discrete(3)
+
+        super(VecSUCartPoleDiscEnv, self).__init__(num_envs, num_steps, dt, auto_reset, n_substeps=1)
+
+    def _torque(self, actions):
+        torque = self.AVAIL_ACTIONS[actions[:, 0].astype(np.int64)] * self.TORQUE_LIMIT
+        if self.torque_noise_max > 0:
+            torque = torque + self.np_random.uniform(-self.torque_noise_max, self.torque_noise_max, size=torque.shape)
+        return torque
+
+    def _reward_done(self, torque):
+        reward = -5 * np.cos(self.state[:, 0]) - 0.001 * (self.state[:, 1] ** 2) + 50
+        done = ((self.cur_step + 1) > self.num_steps) | (np.abs(self.state[:, 1]) > self.X_MAX)
+        return reward, done
@@ -0,0 +1,169 @@
+import numpy as np
+import gym
+from gym.utils import seeding
+
+
+class VecEnv(gym.Env):
+    """
+    Base class for the batched classic_control environments.
+
+    Holds the state of num_envs copies of a system in a single (num_envs, state_dim) array, so that one call to step
+    advances every copy at once (the dynamics are evaluated on the whole array through seagul.integration.rk4/euler).
+    observation_space and action_space describe a single copy, like the gym / baselines VecEnvs.
+
+    Subclasses need to set self.state_dim in __init__ and implement:
+        _reset_rows(idx): write fresh initial states into self.state[idx]
+        _step_rows(actions): advance self.state by one control step, returns (rewards, dones) each of shape (num_envs,)
+        _get_obs(): return the observation array for all rows, (num_envs, obs_dim)
+
+    Attributes:
+        num_envs: how many copies of the environment to simulate
+        auto_reset: if True rows that finish an episode are reset inside step. The observation they finished on is
+            returned in info["terminal_obs"] (rows that did not finish are left as nan)
+        cur_step: (num_envs,) int array, how many steps each row has taken in its current episode
+
+    Example:
+        env = VecSUCartPoleEnv(num_envs=1024)
+        obs = env.reset()
+        for _ in range(100):
+            obs, rews, dones, info = env.step(np.random.randn(1024, 1))
+    """
+
+    def __init__(self, num_envs, auto_reset=True):
+        self.num_envs = int(num_envs)
+        self.auto_reset = auto_reset
+        self.cur_step = np.zeros(self.num_envs, dtype=np.int64)
+        self.state = np.zeros((self.num_envs, self.state_dim))
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def reset(self, mask=None):
+        """
+        Args:
+            mask: boolean (num_envs,) array or array of row indices, which rows to reset. None resets everything
+        Returns:
+            obs: the observations for ALL rows, (num_envs, obs_dim)
+        """
+        if mask is None:
+            idx = np.arange(self.num_envs)
+        else:
+            mask = np.asarray(mask)
+            idx = np.nonzero(mask)[0] if mask.dtype == np.bool_ else mask
+
+        if idx.shape[0] > 0:
+            self._reset_rows(idx)
+            self.cur_step[idx] = 0
+
+        return self._get_obs()
+
+    def step(self, actions):
+        """
+        Args:
+            actions: (num_envs, act_dim) array, one action per row
+        Returns:
+            obs: (num_envs, obs_dim), rewards: (num_envs,), dones: (num_envs,) bool, info: dict
+        """
+        actions = np.asarray(actions, dtype=np.float64).reshape(self.num_envs, -1)
+        rews, dones = self._step_rows(actions)
+        self.cur_step += 1
+
+        obs = self._get_obs()
+        info = {}
+        if self.auto_reset and dones.any():
+            terminal_obs = np.full_like(obs, np.nan)
+            terminal_obs[dones] = obs[dones]
+            info["terminal_obs"] = terminal_obs
+            obs = self.reset(dones)
+
+        return obs, rews, dones, info
+
+    def _reset_rows(self, idx):
+        raise NotImplementedError
+
+    def _step_rows(self, actions):
+        raise NotImplementedError
+
+    def _get_obs(self):
+        raise NotImplementedError
+
+
+class SerialVecEnv:
+    """
+    Steps a list of ordinary gym environments as if they were one batched environment.
+
+    Exposes the same interface as VecEnv (num_envs, reset, step returning arrays, done rows
+    reset automatically with their last observation in info["terminal_obs"]), so algorithms only have to deal with one
+    kind of env. The envs are still stepped one after another, the win is that the policy only runs once per step.
+
+    Example:
+        env = SerialVecEnv([gym.make("Pendulum-v0") for _ in range(8)])
+        obs = env.reset()
+        obs, rews, dones, info = env.step(np.zeros((8, 1)))
+    """
+
+    def __init__(self, env_list):
+        self.envs = env_list
+        self.num_envs = len(env_list)
+        self.observation_space = env_list[0].observation_space
+        self.action_space = env_list[0].action_space
+        self.obs = None
+
+    def seed(self, seed=None):
+        if seed is None:
+            return [env.seed() for env in self.envs]
+        return [env.seed(seed + i) for i, env in enumerate(self.envs)]
+
+    def reset(self, mask=None):
+        if self.obs is None or mask is None:
+            self.obs = np.stack([np.asarray(env.reset(), dtype=np.float64) for env in self.envs])
+        else:
+            mask = np.asarray(mask)
+            idx = np.nonzero(mask)[0] if mask.dtype == np.bool_ else mask
+            for i in idx:
+                self.obs[i] = self.envs[i].reset()
+
+        return self.obs.copy()
+
+    def step(self, actions):
+        rews = np.zeros(self.num_envs)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        terminal_obs = None
+
+        for i, (env, act) in enumerate(zip(self.envs, actions)):
+            obs, rews[i], dones[i], _ = env.step(act)
+            if dones[i]:
+                if terminal_obs is None:
+                    terminal_obs = np.full_like(self.obs, np.nan)
+                terminal_obs[i] = obs
+                obs = env.reset()
+            self.obs[i] = obs
+
+        info = {}
+        if terminal_obs is not None:
+            info["terminal_obs"] = terminal_obs
+
+        return self.obs.copy(), rews, dones, info
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def make_vec_env(env_name, num_envs=1, env_config=None):
+    """
+    Makes a batched version of env_name.
+
+    If env_name is already batched (one of the *_vec envs, pass num_envs through env_config) it is returned as is,
+    otherwise num_envs copies are made and wrapped in a SerialVecEnv.
+    """
+    if env_config is None:
+        env_config = {}
+
+    env = gym.make(env_name, **env_config)
+    if hasattr(env.unwrapped, "num_envs"):
+        return env.unwrapped
+
+    return SerialVecEnv([env] + [gym.make(env_name, **env_config) for _ in range(num_envs - 1)])
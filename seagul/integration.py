@@ -3,6 +3,7 @@ Utility functions for seagul, mostly fixed step integrators
 """
 
 import numpy as np
+import warnings
 
 
 def wrap(x, low, high):
@@ -63,3 +64,137 @@ def euler(derivs, a, t0, dt, s0):
     Single step of an euler integtation, exactly the same parameters and usage as rk4 above
     """
     return s0 + dt * derivs(t0 + dt, s0, a)
+
+
+def integrate(derivs, a, t0, dt, s0, n_steps, integrator=rk4):
+    """
+    Takes n_steps steps of a fixed step integrator in one call and returns every intermediate state.
+
+    Works on a single state or a batch of them, s0 and a can be (N, d) arrays as long as derivs works on the whole
+    batch (like the dynamics of the Vec* envs), every step is then one derivs call per stage for all N rows.
+
+    Args:
+        derivs, a, t0, dt, s0: same as rk4, t advances by dt every step
+        n_steps: how many steps of dt to take
+        integrator: the single step integrator to use, e.g. rk4, euler, rk45
+
+    Returns:
+        traj: array (n_steps, *s0.shape), traj[i] is the state after i+1 steps, so traj[-1] is the final state
+
+    Example:
+        # what SGAcroEnv.step does with act_hold=20
+        traj = integrate(env._dynamics, a, env.t, env.dt, env.state, 20)
+        env.state = traj[-1]
+    """
+    s = np.asarray(s0)
+    traj = np.empty((n_steps,) + s.shape, dtype=np.result_type(s.dtype, np.float64))
+    for i in range(n_steps):
+        s = integrator(derivs, a, t0 + i * dt, dt, s)
+        traj[i] = s
+
+    return traj
+
+
+# Dormand-Prince 5(4) tableau
+_DP_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1])
+_DP_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# 5th order weights minus the embedded 4th order ones, the last entry is for the FSAL stage
+_DP_E = np.array([71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40])
+
+
+def rk45(derivs, a, t0, dt, s0, rtol=1e-6, atol=1e-9, first_step=None, max_steps=10000):
+    """
+    Adaptive Dormand-Prince RK45 over an interval of length dt, same call signature as rk4 so it can be dropped in as
+    an envs integrator.
+
+    Internally takes as many steps as the error estimate asks for, so an env can use a large dt without losing
+    accuracy. With a (N, d) batch of states every row gets its own step size and error control, but the rows are still
+    advanced together, one derivs call per stage for the whole batch. Rows that reached t0 + dt take zero length steps
+    until the rest catch up. derivs gets t as an array with one entry per row (a 0-d array for a single state).
+
+    Args:
+        derivs, a, t0, dt, s0: same as rk4
+        rtol, atol: relative and absolute tolerance, a step is accepted when the RMS over the state of
+            err / (atol + rtol * |s|) is at most one
+        first_step: size of the first internal step, picked from the derivative at s0 by default
+        max_steps: limit on the number of internal steps (accepted or not)
+
+    Returns:
+        s[n+1]: the state after integrating with action a for dt seconds
+    """
+    s = np.array(s0, dtype=np.float64)
+    t = np.full(s.shape[:-1], float(t0))
+    t1 = t0 + dt
+
+    k = [None] * 7
+    k[0] = derivs(t, s, a)
+
+    if first_step is None:
+        scale = atol + rtol * np.abs(s)
+        d0 = np.sqrt(np.mean((s / scale) ** 2, axis=-1))
+        d1 = np.sqrt(np.mean((k[0] / scale) ** 2, axis=-1))
+        h = np.where((d0 > 1e-5) & (d1 > 1e-5), 0.01 * d0 / np.maximum(d1, 1e-300), 1e-6)
+    else:
+        h = np.full(t.shape, float(first_step))
+
+    for _ in range(max_steps):
+        h = np.minimum(h, t1 - t)
+        if not (h > 0).any():
+            break
+        H = h[..., None]
+
+        for i in range(1, 7):
+            ds = sum(a_ij * k[j] for j, a_ij in enumerate(_DP_A[i]) if a_ij != 0)
+            k[i] = derivs(t + _DP_C[i] * h, s + H * ds, a)
+
+        s_new = s + H * sum(b * k[j] for j, b in enumerate(_DP_A[6]) if b != 0)
+        err = H * sum(e * k[j] for j, e in enumerate(_DP_E) if e != 0)
+
+        scale = atol + rtol * np.maximum(np.abs(s), np.abs(s_new))
+        err_norm = np.sqrt(np.mean((err / scale) ** 2, axis=-1))
+        accept = err_norm <= 1
+
+        s = np.where(accept[..., None], s_new, s)
+        k[0] = np.where(accept[..., None], k[6], k[0])
+        t = np.where(accept, t + h, t)
+
+        with np.errstate(divide="ignore"):
+            factor = np.clip(0.9 * err_norm ** -0.2, 0.2, 10.0)
+        h = h * np.where(accept, factor, np.minimum(factor, 1.0))
+    else:
+        if (t < t1).any():
+            warnings.warn(f"rk45 stopped after max_steps ({max_steps}) internal steps before reaching t0 + dt")
+
+    return s
+
+
+if __name__ == "__main__":
+    # One 0.2s control step of 1024 acrobots, fixed step rk4 at a few dts vs rk45, against rk4 with a tiny dt
+    import time
+    from seagul.envs.classic_control.vec_acrobot import VecSGAcroEnv
+
+    env = VecSGAcroEnv(num_envs=1024)
+    rng = np.random.RandomState(0)
+    s0 = rng.uniform(-np.pi, np.pi, size=(1024, 4))
+    a = rng.uniform(-5, 5, size=(1024, 1))
+    step = 0.2
+
+    ref = integrate(env._dynamics, a, 0, 1e-4, s0, int(step / 1e-4))[-1]
+
+    for dt in [1e-2, 1e-3]:
+        start = time.time()
+        s = integrate(env._dynamics, a, 0, dt, s0, int(round(step / dt)))[-1]
+        print(f"rk4 dt={dt}: {time.time() - start:.3f}s, max error {np.abs(s - ref).max():.2e}")
+
+    for rtol in [1e-4, 1e-6, 1e-8]:
+        start = time.time()
+        s = rk45(env._dynamics, a, 0, step, s0, rtol=rtol, atol=rtol * 1e-2)
+        print(f"rk45 rtol={rtol}: {time.time() - start:.3f}s, max error {np.abs(s - ref).max():.2e}")
@@ -1,8 +1,15 @@
 import numpy as np
 import copy
 import scipy.optimize as opt
+from scipy.spatial import cKDTree
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sparse_linalg
+from scipy.sparse.csgraph import breadth_first_order
 import torch
+import dill
+from torch.multiprocessing import Pool
 from collections.abc import MutableMapping
+from collections import deque
 
 
 class MeshPoint:
@@ -42,38 +49,263 @@ class BylMesh(MutableMapping):
         round_key = tuple(round_key)
         return round_key
 
+    def transform_keys(self, keys):
+        """ Applies the key transform to every row of keys at once, returns a list of the transformed keys """
+        round_keys = np.round(np.asarray(keys) * self.scale, decimals=0) * self.d
+        round_keys[round_keys == -0.0] = 0.0
+        return [tuple(k) for k in round_keys.tolist()]
 
 
-def create_mesh(data, d, initial_mesh=None):
+class CompactMesh:
+    """
+    Mesh store for large meshes, an alternative to a BylMesh of MeshPoints.
+
+    Cells are the same ones BylMesh(d) uses (keys rounded to the nearest multiple of d). A cell is kept as its rounded
+    coordinates in int64 (key / d), next to its point and frequency, in contiguous arrays indexed by id that double in
+    size when full. There are no per cell python objects: cells are found with binary searches over sorted arrays of
+    64 bit hashes of their coordinates, and every hit is checked against the stored coordinates so hash collisions
+    can't merge cells. Lookups take whole batches at a time.
+
+    Each batch of new cells goes into the index as its own sorted run, and runs are merged whenever one gets to within
+    a factor of two of the one before it (like carries in a binary counter). A cell is merged O(log n) times and there
+    are at most O(log n) runs to search, instead of the whole index being copied to insert every batch.
+
+    Args:
+        d: float, cell size
+        key_dim: size of the keys
+        point_dim: size of the points stored with each cell, defaults to key_dim
+        capacity: number of cells to allocate room for up front
+
+    Example:
+        mesh = CompactMesh(d, key_dim=4)
+        ids = mesh.lookup_or_insert((pts - ref_mean) / ref_std, pts)
+        mesh.points[ids], mesh.freqs[ids]
+    """
+
+    def __init__(self, d, key_dim, point_dim=None, capacity=1024):
+        self.d = d; self.scale = 1/d
+        self.key_dim = key_dim
+        self.point_dim = key_dim if point_dim is None else point_dim
+
+        self.size = 0
+        self._codes = np.zeros((capacity, key_dim), dtype=np.int64)
+        self._points = np.zeros((capacity, self.point_dim))
+        self._freqs = np.zeros(capacity, dtype=np.int64)
+
+        # (hashes, ids) pairs sorted by hash, from the oldest and largest run to the newest
+        self._runs = []
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def points(self):
+        return self._points[:self.size]
+
+    @property
+    def freqs(self):
+        return self._freqs[:self.size]
+
+    @property
+    def keys(self):
+        """ The rounded key of every cell, by id, same values BylMesh would use """
+        return self._codes[:self.size] * self.d
+
+    def _quantize(self, keys):
+        codes = np.round(np.asarray(keys, dtype=np.float64).reshape(-1, self.key_dim) * self.scale, decimals=0)
+        return np.ascontiguousarray(codes.astype(np.int64))
+
+    def _grow(self, n_new):
+        capacity = self._codes.shape[0]
+        if self.size + n_new <= capacity:
+            return
+
+        capacity = max(2 * capacity, self.size + n_new)
+        for name in ["_codes", "_points", "_freqs"]:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _find(self, codes, hashes):
+        ids = np.full(codes.shape[0], -1, dtype=np.int64)
+        for run_hashes, run_ids in self._runs:
+            todo = np.nonzero(ids < 0)[0]
+            if todo.shape[0] == 0:
+                break
+
+            left = np.searchsorted(run_hashes, hashes[todo], side="left")
+            right = np.searchsorted(run_hashes, hashes[todo], side="right")
+
+            hit = np.nonzero(right > left)[0]
+            candidates = run_ids[left[hit]]
+            match = (self._codes[candidates] == codes[todo[hit]]).all(axis=1)
+            ids[todo[hit[match]]] = candidates[match]
+
+            # different cells with the same hash, practically never happens
+            for n in hit[~match]:
+                for i in run_ids[left[n] + 1:right[n]]:
+                    if (self._codes[i] == codes[todo[n]]).all():
+                        ids[todo[n]] = i
+                        break
+
+        return ids
+
+    def _add_run(self, hashes, ids):
+        order = np.argsort(hashes, kind="stable")
+        self._runs.append((hashes[order], ids[order]))
+
+        while len(self._runs) > 1 and self._runs[-2][0].shape[0] <= 2 * self._runs[-1][0].shape[0]:
+            (hashes, ids), (last_hashes, last_ids) = self._runs[-2:]
+            hashes = np.concatenate((hashes, last_hashes))
+            ids = np.concatenate((ids, last_ids))
+            # two sorted runs back to back, which the stable sort (timsort) merges in linear time
+            order = np.argsort(hashes, kind="stable")
+            self._runs[-2:] = [(hashes[order], ids[order])]
+
+    def lookup(self, keys):
+        """ Returns the id of the cell each key falls in, -1 where there is no such cell yet """
+        codes = self._quantize(keys)
+        return self._find(codes, _hash_rows(codes))
+
+    def lookup_or_insert(self, keys, points=None):
+        """
+        Returns the id of the cell each key falls in, adding cells for keys that aren't in the mesh yet.
+
+        New cells get ids in the order their first key appears in the batch, and store the point that came with that
+        key, so inserting a batch gives the same ids as inserting its rows one at a time. freqs counts every key that
+        lands in a cell, including the one that created it, like MeshPoint.freq.
+
+        Args:
+            keys: np.array (n, key_dim)
+            points: np.array (n, point_dim), what to store for new cells, defaults to keys
+        Returns:
+            ids: np.array (n,) of int64
+        """
+        codes = self._quantize(keys)
+        if points is None:
+            points = keys
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.point_dim)
+
+        packed = codes.view(np.dtype((np.void, 8 * self.key_dim))).reshape(-1)
+        _, first, inverse, counts = np.unique(packed, return_index=True, return_inverse=True, return_counts=True)
+        uniq_codes = codes[first]
+        uniq_hashes = _hash_rows(uniq_codes)
+        uniq_ids = self._find(uniq_codes, uniq_hashes)
+
+        new = np.nonzero(uniq_ids < 0)[0]
+        if new.shape[0] > 0:
+            new = new[np.argsort(first[new], kind="stable")]
+            new_ids = self.size + np.arange(new.shape[0])
+            uniq_ids[new] = new_ids
+
+            self._grow(new.shape[0])
+            self._codes[new_ids] = uniq_codes[new]
+            self._points[new_ids] = points[first[new]]
+            self.size += new.shape[0]
+            self._add_run(uniq_hashes[new], new_ids)
+
+        self._freqs[uniq_ids] += counts
+        return uniq_ids[inverse.reshape(-1)]
+
+
+def create_mesh(data, d, initial_mesh=None, initial_weights=None):
     """ Creates a mesh from the given data using balls of size d
+
+    Points are visited in order, and every point that is not within d (L1) of a mesh point becomes one. The data goes
+    into a KD tree once, so each new mesh point only looks at the points near it rather than the whole dataset. The
+    tree returns a slight superset of the ball, which is then checked with the same distance computation as always,
+    so the output doesn't depend on rounding inside the tree.
+
     Args:
         data: np.array, the data you want to create a mesh for
         d: float, the radius for the ball used to determine membership in the mesh
-        initial_mesh: list, if you want to extend an existing mesh with new data, pass the old mesh as a list
+        initial_mesh: list, if you want to extend an existing mesh with new data, pass the old mesh as a list. Points
+            in data already within d of it don't become mesh points
+        initial_weights: list, the weights that came with initial_mesh, counts from the new data are added to them
     Returns:
-        mesh: list, all the points from data that made it into the mesh
+        mesh: list, all the points from data that made it into the mesh, after those from initial_mesh
         weights: how many points from the original set are represented by the corresponding point in the mesh
+
+    Extending gives the same mesh points as meshing everything at once, create_mesh(new, d, *create_mesh(old, d)) vs
+    create_mesh(np.concatenate((old, new)), d). The weights of the new mesh points only count points in the new data.
     """
-    if initial_mesh is None:
-        initial_mesh = []
+    mesh = [] if initial_mesh is None else list(initial_mesh)
+    if initial_weights is None:
+        weights = [0] * len(mesh)
+    else:
+        weights = list(initial_weights)
 
-    mesh = initial_mesh
-    weights = []
-    in_mesh = np.zeros(data.shape[0], dtype=np.bool)
+    data = np.asarray(data)
+    if data.shape[0] == 0:
+        return mesh, weights
+    data = data.reshape(data.shape[0], -1)
+
+    tree = cKDTree(data)
+    search_d = d * (1 + 1e-9)
+
+    def in_ball(x, cand):
+        cand = np.asarray(cand, dtype=np.int64)
+        return cand[np.linalg.norm(x - data[cand], axis=1, ord=1) < d]
+
+    covered = np.zeros(data.shape[0], dtype=bool)
+
+    if len(mesh) > 0:
+        old_mesh = np.asarray(mesh).reshape(len(mesh), -1)
+        for j, (x, cand) in enumerate(zip(old_mesh, tree.query_ball_point(old_mesh, search_d, p=1))):
+            members = in_ball(x, cand)
+            covered[members] = True
+            weights[j] += members.shape[0]
 
-    for i, x in enumerate(data):
-        if in_mesh[i]:
+    for i in range(data.shape[0]):
+        if covered[i]:
             continue
-        else:
-            in_criteria = np.linalg.norm(x - data, axis=1, ord=1) < d
-            in_mesh = np.logical_or(in_mesh, in_criteria)
-            mesh.append(x)
-            weights.append(np.sum(in_criteria))
+
+        x = data[i]
+        members = in_ball(x, tree.query_ball_point(x, search_d, p=1))
+        covered[members] = True
+        mesh.append(x)
+        weights.append(members.shape[0])
 
     return mesh, weights
 
 
-def create_mesh_act(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn, interp_fn, ref_mean, ref_std):
+def _mesh_rollout(env, policy, init_pos, pert, reset_fn, snapshot_fn, interp_fn, max_steps=200):
+    """ Runs one create_mesh_act rollout, from init_pos with pert added to the first action only
+
+    Returns:
+        pt: interp_fn at the first step snapshot_fn fires, None if the env finished first
+        failed: True if the rollout went on for more than max_steps
+    """
+    step = 0
+    done = False
+    do_once = 1
+    pt = None
+    failed = False
+    o = reset_fn(env, init_pos)
+
+    while not done:
+        a = policy(o) + do_once * pert
+        step += 1
+        do_once = 0
+
+        last_o = copy.copy(o)
+
+        o, r, done, _ = env.step(a.numpy())
+
+        if snapshot_fn(o, last_o, step):
+            pt = copy.copy(interp_fn(o, last_o))
+            done = True
+
+        if step > max_steps:
+            failed = True
+            done = True
+
+    return pt, failed
+
+
+def create_mesh_act(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn, interp_fn, ref_mean, ref_std,
+                    seed=None):
     torch.autograd.set_grad_enabled(False)
     failure_point = np.ones_like(seed_point) * 10
 
@@ -89,7 +321,7 @@ def create_mesh_act(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn,
 
     cnt = 0;
     cur_explored_cnt = 0
-    for init_pos in mesh_points:
+    for point_id, init_pos in enumerate(mesh_points):
         if (init_pos == failure_point).all():
             continue
 
@@ -100,44 +332,28 @@ def create_mesh_act(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn,
         tmp_keys = []
         failed = False
 
-        for pert in perturbs:
+        for pert_id, pert in enumerate(perturbs):
             if failed:
                 break
             cnt += 1
 
-            step = 0
-            done = False;
-            do_once = 1
-            o = reset_fn(env, init_pos)
-
-            while not done:
-                a = policy(o) + do_once * pert
-                step += 1
-                do_once = 0
+            if seed is not None:
+                env.seed(_mesh_job_seed(seed, point_id, pert_id, len(perturbs)))
 
-                last_o = copy.copy(o)
+            pt, failed = _mesh_rollout(env, policy, init_pos, pert, reset_fn, snapshot_fn, interp_fn)
 
-                o, r, done, _ = env.step(a.numpy())
+            if pt is not None:
+                key = (pt - ref_mean) / ref_std
 
-                if snapshot_fn(o, last_o, step):
+                # weights = pca.singular_values_/pca.singular_values_.max()
+                # key = weights*pca.transform(key.reshape(1,-1)).reshape(-1)
 
-                    pt = interp_fn(o, last_o)
-                    key = (pt - ref_mean) / ref_std
+                tmp_points.append(pt)
+                tmp_keys.append(copy.copy(key))
 
-                    # weights = pca.singular_values_/pca.singular_values_.max()
-                    # key = weights*pca.transform(key.reshape(1,-1)).reshape(-1)
-
-                    tmp_points.append(copy.copy(pt))
-                    tmp_keys.append(copy.copy(key))
-
-                    if cnt % 1000 == 0:
-                        print("explored: ", cur_explored_cnt, "| added: ", len(mesh), "| ratio: ",
-                              cur_explored_cnt / len(mesh), "| failures: ", mesh[failure_point].freq, "| count: ", cnt)
-                    done = True
-
-                if step > 200:
-                    failed = True
-                    done = True
+                if cnt % 1000 == 0:
+                    print("explored: ", cur_explored_cnt, "| added: ", len(mesh), "| ratio: ",
+                          cur_explored_cnt / len(mesh), "| failures: ", mesh[failure_point].freq, "| count: ", cnt)
 
         if not failed:
             for p, k in zip(tmp_points, tmp_keys):
@@ -159,6 +375,274 @@ def create_mesh_act(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn,
     return mesh, mesh_points, np.array(transition_list)
 
 
+def _mesh_job_seed(seed, point_id, pert_id, n_perts):
+    # depends only on which rollout this is, so the serial and parallel builders seed every rollout the same way
+    return seed + point_id * n_perts + pert_id
+
+
+_mesh_worker = {}
+
+
+def _mesh_worker_init(payload):
+    torch.autograd.set_grad_enabled(False)
+    torch.set_num_threads(1)
+    names = ("env", "policy", "perturbs", "reset_fn", "snapshot_fn", "interp_fn", "seed")
+    _mesh_worker.update(zip(names, dill.loads(payload)))
+
+
+def _mesh_worker_rollout(job):
+    point_id, init_pos, pert_id = job
+    w = _mesh_worker
+    if w["seed"] is not None:
+        w["env"].seed(_mesh_job_seed(w["seed"], point_id, pert_id, len(w["perturbs"])))
+
+    return _mesh_rollout(w["env"], w["policy"], init_pos, w["perturbs"][pert_id], w["reset_fn"], w["snapshot_fn"],
+                         w["interp_fn"])
+
+
+def create_mesh_act_parallel(env, policy, d, seed_point, perturbs, reset_fn, snapshot_fn, interp_fn, ref_mean, ref_std,
+                             n_workers=4, seed=None, chunksize=8):
+    """ Parallel version of create_mesh_act, takes the same arguments and returns the same mesh
+
+    The mesh is explored one frontier (every mesh point found by the last frontier) at a time. Each (mesh point,
+    perturbation) rollout in the frontier is a separate job for a pool of n_workers processes, each holding its own
+    copy of env and policy. Once the frontier is back, all of its snapshots are keyed in one vectorized pass and merged
+    into the mesh in the same order the serial version visits them, so mesh ids and the transition table match
+    create_mesh_act exactly as long as a rollout only depends on its start point and perturbation. Pass seed to both
+    versions if the env uses its own random state, every rollout then gets a seed based on its mesh id and
+    perturbation index.
+
+    env, policy and the three callbacks are sent to the workers with dill, so lambdas are fine but env has to be
+    picklable by dill.
+
+    Args:
+        n_workers: number of worker processes
+        seed: int or None, base seed for the per rollout env seeds, None leaves the env alone
+        chunksize: rollouts handed to a worker at a time
+    Returns:
+        mesh: BylMesh of MeshPoints
+        mesh_points: list, mesh_points[i] is the point with id i, the failure point is id 0
+        transitions: np.array, transitions[i, j] is the id reached from mesh point i with perturbs[j]
+    """
+    failure_point = np.ones_like(seed_point) * 10
+
+    mesh = BylMesh(d)
+    mesh[failure_point] = MeshPoint(0, failure_point)
+    mesh[seed_point] = MeshPoint(1, seed_point)
+
+    mesh_points = [failure_point, seed_point]
+    transition_list = [[0] * len(perturbs)]  # Failure state always transitions to itself
+
+    n_perts = len(perturbs)
+    payload = dill.dumps((env, policy, perturbs, reset_fn, snapshot_fn, interp_fn, seed))
+
+    with Pool(n_workers, initializer=_mesh_worker_init, initargs=(payload,)) as pool:
+        frontier = [1]
+        while frontier:
+            frontier = [i for i in frontier if not (mesh_points[i] == failure_point).all()]
+            jobs = [(i, mesh_points[i], j) for i in frontier for j in range(n_perts)]
+            results = pool.map(_mesh_worker_rollout, jobs, chunksize=chunksize)
+
+            pts = [pt for pt, _ in results if pt is not None]
+            if pts:
+                keys = iter(mesh.transform_keys(np.stack([np.asarray((pt - ref_mean) / ref_std) for pt in pts])))
+
+            next_frontier = []
+            for k in range(len(frontier)):
+                point_results = [(pt, next(keys)) for pt, _ in results[k * n_perts:(k + 1) * n_perts] if pt is not None]
+                transition_list.append([])
+
+                if any(failed for _, failed in results[k * n_perts:(k + 1) * n_perts]):
+                    mesh[failure_point].freq += n_perts
+                    transition_list[-1].extend([mesh[failure_point].id] * n_perts)
+                    continue
+
+                for pt, key in point_results:
+                    if key in mesh.mesh:
+                        mesh.mesh[key].freq += 1
+                    else:
+                        mesh_points.append(pt)
+                        mesh.mesh[key] = MeshPoint(len(mesh_points) - 1, pt)
+                        next_frontier.append(len(mesh_points) - 1)
+
+                    transition_list[-1].append(mesh.mesh[key].id)
+
+            print("explored: ", len(transition_list) - 1, "| added: ", len(mesh), "| failures: ",
+                  mesh[failure_point].freq, "| frontier: ", len(next_frontier))
+            frontier = next_frontier
+
+    return mesh, mesh_points, np.array(transition_list)
+
+
+def transition_matrix(transitions, n_states=None):
+    """ Turns a create_mesh_act transition table into a sparse row stochastic matrix
+
+    Args:
+        transitions: np.array or list, row i holds the ids reached from mesh point i, one per perturbation. Rows may
+            have different lengths
+        n_states: int, size of the matrix, defaults to the number of rows or the largest id + 1, whichever is bigger
+    Returns:
+        P: scipy.sparse.csr_matrix (n_states, n_states), P[i, j] is the fraction of perturbations that take mesh point i
+            to mesh point j. States with no transitions (empty or missing rows) stay where they are
+    """
+    if isinstance(transitions, np.ndarray) and transitions.ndim == 2:
+        lengths = np.full(transitions.shape[0], transitions.shape[1], dtype=np.int64)
+        cols = transitions.reshape(-1).astype(np.int64)
+    else:
+        rows = [np.asarray(row, dtype=np.int64).reshape(-1) for row in transitions]
+        lengths = np.array([row.shape[0] for row in rows], dtype=np.int64)
+        cols = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    n_rows = lengths.shape[0]
+    if n_states is None:
+        n_states = max(n_rows, int(cols.max()) + 1 if cols.size else 0)
+
+    row_idx = np.repeat(np.arange(n_rows), lengths)
+    data = np.repeat(1.0 / np.maximum(lengths, 1), lengths)
+
+    all_lengths = np.zeros(n_states, dtype=np.int64)
+    all_lengths[:n_rows] = lengths
+    stuck = np.nonzero(all_lengths == 0)[0]
+
+    row_idx = np.concatenate((row_idx, stuck))
+    cols = np.concatenate((cols, stuck))
+    data = np.concatenate((data, np.ones(stuck.shape[0])))
+
+    # repeated (i, j) pairs are summed on conversion
+    return sparse.coo_matrix((data, (row_idx, cols)), shape=(n_states, n_states)).tocsr()
+
+
+def _as_state_mask(states, n_states):
+    mask = np.zeros(n_states, dtype=bool)
+    mask[np.atleast_1d(np.asarray(states, dtype=np.int64))] = True
+    return mask
+
+
+def _can_reach(P, target_mask):
+    # BFS over the reversed graph from an extra node that points at every target, returns a mask of states that reach
+    # the targets with nonzero probability (targets included)
+    n_states = P.shape[0]
+    reverse = sparse.vstack((P.T.tocsr(), sparse.csr_matrix(target_mask[None, :].astype(np.float64))))
+    reverse = sparse.hstack((reverse, sparse.csr_matrix((n_states + 1, 1)))).tocsr()
+
+    order = breadth_first_order(reverse, n_states, directed=True, return_predecessors=False)
+    mask = np.zeros(n_states, dtype=bool)
+    mask[order[order < n_states]] = True
+    return mask
+
+
+def _sparse_solve(A, b, tol, max_iter, method="iterative"):
+    # bicgstab with a Jacobi preconditioner, falls back to a direct solve if that doesn't converge
+    if A.shape[0] == 0:
+        return np.zeros(0)
+    if method == "direct":
+        return sparse_linalg.spsolve(A.tocsc(), b)
+
+    M = sparse.diags(1.0 / A.diagonal())
+    try:
+        x, info = sparse_linalg.bicgstab(A, b, rtol=tol, maxiter=max_iter, M=M)
+    except TypeError:  # scipy < 1.12 calls rtol tol
+        x, info = sparse_linalg.bicgstab(A, b, tol=tol, maxiter=max_iter, M=M)
+
+    if info != 0:
+        x = sparse_linalg.spsolve(A.tocsc(), b)
+    return x
+
+
+def absorption_probs(P, absorbing=0, tol=1e-10, max_iter=10000, method="iterative"):
+    """ Probability of reaching each absorbing state (before any of the others) from every state
+
+    Only the states that can reach the absorbing set go into the linear system, everything else gets 0 directly.
+
+    Args:
+        P: sparse row stochastic matrix, see transition_matrix
+        absorbing: int or list of ints, states to treat as absorbing whatever their rows say, 0 is the failure point
+        tol: relative tolerance for the iterative solver
+        max_iter: iteration limit for the iterative solver
+        method: "iterative" (bicgstab) or "direct" (sparse LU). Direct is often faster on meshes with few ids between
+            neighbours but its memory use depends on fill in, iterative never needs more than a few vectors
+    Returns:
+        probs: np.array, (n_states,) for a single absorbing state, (n_states, len(absorbing)) for a list
+    """
+    P = sparse.csr_matrix(P)
+    n_states = P.shape[0]
+    absorbing_idx = np.atleast_1d(np.asarray(absorbing, dtype=np.int64))
+    absorbing_mask = _as_state_mask(absorbing_idx, n_states)
+
+    transient = np.nonzero(_can_reach(P, absorbing_mask) & ~absorbing_mask)[0]
+    A = sparse.identity(transient.shape[0], format="csr") - P[transient][:, transient]
+    B = P[transient][:, absorbing_idx]
+
+    probs = np.zeros((n_states, absorbing_idx.shape[0]))
+    probs[absorbing_idx, np.arange(absorbing_idx.shape[0])] = 1.0
+    for k in range(absorbing_idx.shape[0]):
+        probs[transient, k] = _sparse_solve(A, B[:, k].toarray().reshape(-1), tol, max_iter, method)
+
+    if np.ndim(absorbing) == 0:
+        return probs[:, 0]
+    return probs
+
+
+def mean_first_passage(P, target=0, tol=1e-10, max_iter=10000, method="iterative"):
+    """ Expected number of transitions before first reaching target, from every state
+
+    Args:
+        P: sparse row stochastic matrix, see transition_matrix
+        target: int or list of ints, the states to reach, 0 is the failure point
+        tol: relative tolerance for the iterative solver
+        max_iter: iteration limit for the iterative solver
+        method: "iterative" (bicgstab) or "direct" (sparse LU). Direct is often faster on meshes with few ids between
+            neighbours but its memory use depends on fill in, iterative never needs more than a few vectors
+    Returns:
+        steps: np.array (n_states,), 0 on the target, inf for states that might never reach it
+    """
+    P = sparse.csr_matrix(P)
+    n_states = P.shape[0]
+    target_mask = _as_state_mask(target, n_states)
+
+    # any chance of getting stuck somewhere that never reaches the target makes the expected time infinite
+    never = ~_can_reach(P, target_mask)
+    sure = ~_can_reach(P, never) & ~target_mask if never.any() else ~target_mask
+    sure_idx = np.nonzero(sure)[0]
+
+    A = sparse.identity(sure_idx.shape[0], format="csr") - P[sure_idx][:, sure_idx]
+
+    steps = np.full(n_states, np.inf)
+    steps[target_mask] = 0.0
+    steps[sure_idx] = _sparse_solve(A, np.ones(sure_idx.shape[0]), tol, max_iter, method)
+    return steps
+
+
+def stationary_distribution(P, p0=None, tol=1e-12, max_iter=100000):
+    """ Long run distribution over states, found by power iteration from p0
+
+    Uses the lazy chain (I + P)/2, which has the same stationary distributions but doesn't oscillate on periodic
+    chains. When the chain has more than one closed class (an absorbing failure point plus some stable cycle, say) the
+    answer depends on p0.
+
+    Args:
+        P: sparse row stochastic matrix, see transition_matrix
+        p0: np.array (n_states,), starting distribution, uniform by default
+        tol: stop once the L1 change in an iteration is below this
+        max_iter: iteration limit
+    Returns:
+        p: np.array (n_states,) summing to 1
+    """
+    P = sparse.csr_matrix(P)
+    PT = P.T.tocsr()
+    n_states = P.shape[0]
+
+    p = np.full(n_states, 1.0 / n_states) if p0 is None else np.asarray(p0, dtype=np.float64) / np.sum(p0)
+    for _ in range(max_iter):
+        next_p = 0.5 * (p + PT @ p)
+        if np.abs(next_p - p).sum() < tol:
+            p = next_p
+            break
+        p = next_p
+
+    return p / p.sum()
+
+
 def create_box_mesh(data, d, initial_mesh=None):
     """ Creates a mesh from the given data using boxes of size d
     Args:
@@ -179,16 +663,56 @@ def create_box_mesh(data, d, initial_mesh=None):
     keys = np.round(data*scale, decimals=0)*d
     keys[keys == -0.0] = 0.0
 
-    for key in keys:
+    # only make a tuple for each distinct box, not for every row
+    keys, counts = np.unique(keys.reshape(keys.shape[0], -1), axis=0, return_counts=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
         key = tuple(key)
         if key in mesh:
-            mesh[key] +=1
+            mesh[key] += count
         else:
-            mesh[key] = 1
+            mesh[key] = count
 
     return mesh
 
 
+def _hash_rows(codes):
+    """ 64 bit hash of every row of an int64 array, mixed one column at a time """
+    codes = codes.view(np.uint64)
+    h = np.full(codes.shape[0], 0x243F6A8885A308D3, dtype=np.uint64)
+    for j in range(codes.shape[1]):
+        h ^= codes[:, j]
+        h *= np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(31)
+    return h
+
+
+def count_boxes(data, d):
+    """ Counts the boxes of size d it takes to cover data, same as len(create_box_mesh(data, d)) without the dict
+
+    Each row is rounded to integer box coordinates, hashed to a single 64 bit code, and the distinct codes are counted
+    with a sort. Two different boxes sharing a hash would be counted once, with 1e6 points the odds of that happening
+    anywhere are around 1e-7.
+
+    Args:
+        data: np.array, the data you want to cover, (n_points, n_dims)
+        d: float, size of the boxes
+    Returns:
+        number of distinct boxes
+    """
+    data = np.asarray(data)
+    if data.shape[0] == 0:
+        return 0
+
+    codes = np.rint(data.reshape(data.shape[0], -1) * (1/d)).astype(np.int64)
+    if codes.shape[1] == 1:
+        codes = codes[:, 0]
+    else:
+        codes = _hash_rows(codes)
+
+    codes.sort()
+    return 1 + np.count_nonzero(codes[1:] != codes[:-1])
+
+
 def mesh_dim(data, scaling_factor=1.5, init_d=1e-2, upper_size_ratio=4/5, lower_size_ratio=0.0, d_limit=1e-9):
     """
     Args:
@@ -206,25 +730,23 @@ def mesh_dim(data, scaling_factor=1.5, init_d=1e-2, upper_size_ratio=4/5, lower_
         d_vals: box sizes used to create each mesh during the computation
     """
 
+    data = np.asarray(data)
     mesh_size_upper = np.round(upper_size_ratio * data.shape[0])
     mesh_size_lower = np.round(np.max((1.0, lower_size_ratio * data.shape[0])))
     d = init_d
 
-    mesh = create_box_mesh(data, d)
-    mesh_sizes = [len(mesh)]
+    mesh_sizes = [count_boxes(data, d)]
     d_vals = [d]
 
     while mesh_sizes[0] < mesh_size_upper and d > d_limit:
         d /= scaling_factor
-        mesh = create_box_mesh(data, d)
-        mesh_sizes.insert(0, len(mesh))
+        mesh_sizes.insert(0, count_boxes(data, d))
         d_vals.insert(0, d)
 
     d = init_d
     while mesh_sizes[-1] > mesh_size_lower and d > d_limit:
         d = d * scaling_factor
-        mesh = create_box_mesh(data, d)
-        mesh_sizes.append(len(mesh))
+        mesh_sizes.append(count_boxes(data, d))
         d_vals.append(d)
 
     for i, m in enumerate(mesh_sizes):
@@ -251,19 +773,115 @@ def mesh_dim(data, scaling_factor=1.5, init_d=1e-2, upper_size_ratio=4/5, lower_
     return -popt[0], -min_slope, mesh_sizes, d_vals
 
 
+def _as_2d_array(X):
+    if torch.is_tensor(X):
+        X = X.detach().cpu().numpy()
+    X = np.asarray(X, dtype=np.float64)
+    return X.reshape(X.shape[0], -1)
+
+
+def power_vars(X, lags=(1, 2), orders=(1,)):
+    """ Order p variations of X for every lag and order at once, eq (16) from https://arxiv.org/pdf/1101.1444.pdf
+
+    The increments at each lag are computed once and shared by every order, the size of an increment is its L1 norm.
+
+    Args:
+        X: np.array or torch tensor, the trajectory, (n_steps,) or (n_steps, n_dims)
+        lags: ints, the lags to compute
+        orders: floats, the orders p to compute
+    Returns:
+        np.array (len(orders), len(lags)), entry i, j is power_var(X, lags[j], orders[i])
+    """
+    X = _as_2d_array(X)
+    out = np.zeros((len(orders), len(lags)))
+    for j, l in enumerate(lags):
+        norms = np.abs(X[l:] - X[:-l]).sum(axis=1)
+        for i, order in enumerate(orders):
+            out[i, j] = np.sum(norms if order == 1 else norms ** order)
+
+    return out / (2 * X.shape[0] - np.asarray(lags))
+
+
 def power_var(X, l, ord):
-    diffs = X[l:] - X[:-l]
-    norms = np.zeros(diffs.shape[0])
-    for i,d in enumerate(diffs):
-        norms[i] = np.linalg.norm(d,ord=1)
-        
-    return 1 / (2 * len(X) - l) * np.sum(norms)
+    return power_vars(X, (l,), (ord,))[0, 0]
 
 
 def variation_dim(X, order=1):
     # Implements the order p variation fractal dimension from https://arxiv.org/pdf/1101.1444.pdf (eq 18)
     # order 1 corresponds to the madogram, 2 to the variogram, 1/2 to the rodogram
-    return 2 - 1/(order*np.log(2))*(np.log(power_var(X, 2, order)) - np.log(power_var(X, 1, order)))
+    v1, v2 = power_vars(X, (1, 2), (order,))[0]
+    return 2 - 1/(order*np.log(2))*(np.log(v2) - np.log(v1))
+
+
+class StreamingVariation:
+    """
+    Running version of power_vars, fed the trajectory as it is generated. It keeps only the last max(lags)
+    observations and a running sum of |increment|^order for each lag and order. The dimension is then available at the
+    end of an episode without storing the episode, and gives the same numbers as power_vars / variation_dim on the
+    whole trajectory.
+
+    Example:
+        var_est = StreamingVariation()
+        obs = env.reset()
+        while not done:
+            var_est.update(obs)
+            obs, rew, done, _ = env.step(policy(obs))
+        dim = var_est.variation_dim()
+    """
+
+    def __init__(self, lags=(1, 2), orders=(1,)):
+        self.lags = tuple(lags)
+        self.orders = tuple(orders)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.tail = deque(maxlen=max(self.lags))
+        self.sums = np.zeros((len(self.orders), len(self.lags)))
+
+    def update(self, x):
+        """ Add a single observation """
+        if torch.is_tensor(x):
+            x = x.detach().cpu().numpy()
+        x = np.asarray(x, dtype=np.float64).reshape(-1)
+
+        for j, l in enumerate(self.lags):
+            if len(self.tail) >= l:
+                norm = np.abs(x - self.tail[-l]).sum()
+                for i, order in enumerate(self.orders):
+                    self.sums[i, j] += norm if order == 1 else norm ** order
+
+        self.tail.append(x)
+        self.n += 1
+
+    def extend(self, X):
+        """ Add a chunk of consecutive observations, (n_steps,) or (n_steps, n_dims) """
+        X = _as_2d_array(X)
+        n_new = X.shape[0]
+        if len(self.tail) > 0:
+            X = np.concatenate((np.stack(self.tail), X))
+
+        # only count increments that end in the new chunk, the rest were counted already
+        for j, l in enumerate(self.lags):
+            first = max(X.shape[0] - n_new, l)
+            if first >= X.shape[0]:
+                continue
+            norms = np.abs(X[first:] - X[first - l:X.shape[0] - l]).sum(axis=1)
+            for i, order in enumerate(self.orders):
+                self.sums[i, j] += np.sum(norms if order == 1 else norms ** order)
+
+        self.tail.extend(X[X.shape[0] - min(n_new, self.tail.maxlen):])
+        self.n += n_new
+
+    def power_vars(self):
+        """ Same as power_vars(trajectory_so_far, lags, orders) """
+        return self.sums / (2 * self.n - np.asarray(self.lags))
+
+    def variation_dim(self, order=1):
+        """ Same as variation_dim(trajectory_so_far, order), needs lags 1 and 2 and order to be tracked """
+        v = self.power_vars()[self.orders.index(order)]
+        v1, v2 = v[self.lags.index(1)], v[self.lags.index(2)]
+        return 2 - 1/(order*np.log(2))*(np.log(v2) - np.log(v1))
 
 
 # if __name__ == "__main__":
@@ -143,18 +143,56 @@ class MLP(nn.Module):
         self.state_means = torch.zeros(input_size, requires_grad=False)
         self.state_std = torch.ones(input_size, requires_grad=False)
 
+        # set this to a RunningMeanStd to use it instead of state_means / state_std
+        self.obs_norm = None
+
+    def normalize(self, data):
+        if self.obs_norm is not None:
+            return self.obs_norm(data)
+        return (torch.as_tensor(data) - self.state_means) / self.state_std
+
     def forward(self, data):
+        inference = getattr(self, "_inference", None)
+        if inference is not None and not torch.is_grad_enabled():
+            out = inference(self, data)
+            if out is not None:
+                return out
 
         if self.input_bias is not None:
-            data += self.input_bias
+            data = data + self.input_bias
 
-        data = (torch.as_tensor(data) - self.state_means) / self.state_std
+        data = self.normalize(data)
 
         for layer in self.layers:
             data = self.activation(layer(data))
 
         return self.output_activation(self.output_layer(data))
-    
+
+    def compile_inference(self, enable=True):
+        """
+        Turns on a fast path for calls on a single observation with autograd off, which is what a policy sees at every
+        step of a rollout. For networks this small the torch dispatch for every op costs more than the math, so the
+        fast path runs on a numpy copy of the weights instead, with the normalization (and input_bias) folded into the
+        first layer and the hidden activations written into preallocated arrays. Batches, calls with grad enabled, and
+        anything not on the cpu go through the regular forward. Outputs match the regular forward up to float rounding.
+
+        The copy is rebuilt on the next call whenever a parameter or the normalization statistics change in this
+        process (optimizer steps, vector_to_parameters, load_state_dict, obs_norm updates, new state_means etc). Writes
+        it can't see, like another process updating parameters in shared memory, need another call to this.
+
+        enable: False goes back to always using the regular forward
+        returns: self
+        """
+        if enable and self.output_layer.weight.device.type != "cpu":
+            raise ValueError("compile_inference only works for networks on the cpu")
+
+        self._inference = _InferenceSnapshot(self) if enable else None
+        return self
+
+    @property
+    def inference_compiled(self):
+        return getattr(self, "_inference", None) is not None
+
     def to(self, place):
         super(MLP, self).to(place)
         self.state_means = self.state_means.to(place)
@@ -162,6 +200,333 @@ class MLP(nn.Module):
         return self
 
 
+def _np_activation(activation):
+    """
+    In place numpy version of an activation module, None for the identity. Anything we don't have a version of is
+    applied through torch on a view of the array
+    """
+    if isinstance(activation, nn.Identity):
+        return None
+    if isinstance(activation, nn.ReLU):
+        return lambda h: np.maximum(h, 0, out=h)
+    if isinstance(activation, nn.Tanh):
+        return lambda h: np.tanh(h, out=h)
+    if isinstance(activation, nn.LeakyReLU) and 0 <= activation.negative_slope <= 1:
+        slope = activation.negative_slope
+        return lambda h: np.maximum(h, slope * h, out=h)
+
+    def torch_activation(h):
+        h[...] = activation(torch.from_numpy(h)).numpy()
+
+    return torch_activation
+
+
+class _InferenceSnapshot:
+    """
+    Numpy copy of an MLP's weights for running it on one observation at a time, see MLP.compile_inference
+    """
+
+    def __init__(self, mlp):
+        linears = list(mlp.layers) + [mlp.output_layer]
+        params = [mlp.input_bias] + [t for layer in linears for t in (layer.weight, layer.bias)]
+        self.params = [p for p in params if p is not None]
+        self.build(mlp)
+
+    def __getstate__(self):
+        # the weights get rebuilt on the first call after unpickling, no need to save a second copy of them
+        return {"params": self.params, "x": self.x}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.key = [None] * (len(self.params) + 2)
+
+    def norm_tensors(self, mlp):
+        if mlp.obs_norm is not None:
+            return [mlp.obs_norm.mean, mlp.obs_norm.var]
+        return [mlp.state_means, mlp.state_std]
+
+    def build(self, mlp):
+        sources = self.params + self.norm_tensors(mlp)
+        self.key = [(t.data_ptr(), t._version) for t in sources]
+        # holding on to the storage means none of it can be freed and reused at the same address, which would look
+        # unchanged to the key above
+        self.alive = [t.detach() for t in sources]
+
+        with torch.no_grad():
+            if mlp.obs_norm is not None:
+                mean, std = mlp.obs_norm.mean.double(), mlp.obs_norm.std.double()
+            else:
+                mean, std = mlp.state_means.double(), mlp.state_std.double()
+            if mlp.input_bias is not None:
+                mean = mean - mlp.input_bias.double()
+
+            # W((x - mean)/std) + b = (W/std)x + (b - (W/std)mean)
+            first = mlp.layers[0] if len(mlp.layers) else mlp.output_layer
+            weight = first.weight.double() / std
+            bias = -weight.mv(mean)
+            if first.bias is not None:
+                bias += first.bias.double()
+
+            rest = list(mlp.layers[1:]) + [mlp.output_layer] if len(mlp.layers) else []
+            weights = [weight] + [layer.weight for layer in rest]
+            biases = [bias] + [layer.bias for layer in rest]
+            dtype = first.weight.detach().numpy().dtype
+
+            self.x = np.zeros(weight.shape[1], dtype=dtype)
+            self.layers = []
+            for i, (w, b) in enumerate(zip(weights, biases)):
+                act = mlp.output_activation if i == len(weights) - 1 else mlp.activation
+                self.layers.append((np.ascontiguousarray(w.detach().numpy(), dtype=dtype),
+                                    None if b is None else np.ascontiguousarray(b.detach().numpy(), dtype=dtype),
+                                    _np_activation(act),
+                                    np.zeros(w.shape[0], dtype=dtype)))
+
+    def __call__(self, mlp, data):
+        """
+        Runs mlp on data if it is a single observation on the cpu, returns None otherwise
+        """
+        if isinstance(data, torch.Tensor):
+            if data.device.type != "cpu":
+                return None
+            data = data.detach().numpy()
+        else:
+            data = np.asarray(data)
+
+        if data.size != self.x.shape[0] or not (data.ndim == 1 or (data.ndim == 2 and data.shape[0] == 1)):
+            return None
+
+        sources = self.params + self.norm_tensors(mlp)
+        if any((t.data_ptr(), t._version) != key for t, key in zip(sources, self.key)):
+            self.build(mlp)
+
+        h = data.reshape(-1)
+        if h.dtype != self.x.dtype:
+            self.x[:] = h
+            h = self.x
+
+        for weight, bias, act, out in self.layers:
+            np.dot(weight, h, out=out)
+            if bias is not None:
+                out += bias
+            if act is not None:
+                act(out)
+            h = out
+
+        out = torch.from_numpy(h.copy())
+        return out.reshape(1, -1) if data.ndim == 2 else out
+
+
+class LinearPolicy(nn.Module):
+    """
+    Linear policy, act = W((obs - state_means)/state_std), which is what ARS usually trains.
+
+    Computes the same thing as MLP(input_size, output_size, 0, 0, bias=False), with the same normalization hooks
+    (state_means / state_std, or obs_norm) and a single (output_size, input_size) parameter, so flat parameter vectors
+    carry over between the two. ARS runs these (and MLPs that reduce to one, see is_linear) in numpy instead of torch.
+    W starts at zero, which is where ARS starts anyway.
+
+    Example:
+        policy = LinearPolicy(obs_size, act_size)
+        policy, r_hist, lr_hist = ars(env_name, policy, 100)
+    """
+
+    def __init__(self, input_size, output_size):
+        super(LinearPolicy, self).__init__()
+        self.weight = Parameter(torch.zeros(output_size, input_size))
+
+        self.state_means = torch.zeros(input_size, requires_grad=False)
+        self.state_std = torch.ones(input_size, requires_grad=False)
+        self.obs_norm = None
+
+    def normalize(self, data):
+        if self.obs_norm is not None:
+            return self.obs_norm(data)
+        return (torch.as_tensor(data) - self.state_means) / self.state_std
+
+    def forward(self, data):
+        return torch.nn.functional.linear(self.normalize(data), self.weight)
+
+    def to(self, place):
+        super(LinearPolicy, self).to(place)
+        self.state_means = self.state_means.to(place)
+        self.state_std = self.state_std.to(place)
+        return self
+
+
+def is_linear(policy):
+    """
+    True if policy is a LinearPolicy or an MLP that computes the same thing (no hidden layers, no biases, no input_bias,
+    identity output), so its flat parameter vector is just W in act = W((obs - mean)/std), row major
+    """
+    if isinstance(policy, LinearPolicy):
+        return True
+    return (isinstance(policy, MLP) and len(policy.layers) == 0 and policy.output_layer.bias is None
+            and policy.input_bias is None and isinstance(policy.output_activation, nn.Identity))
+
+
+def linear_norm(policy):
+    """
+    (mean, std) numpy arrays a linear policy (see is_linear) normalizes its observations with
+    """
+    if policy.obs_norm is not None:
+        return policy.obs_norm.mean.numpy(), policy.obs_norm.std.numpy()
+    return policy.state_means.numpy(), policy.state_std.numpy()
+
+
+
+class EnsembleMLP(nn.Module):
+    """
+    num_nets MLPs with the same shape, evaluated together. Each layer's weights are stacked into one
+    (num_nets, in, out) tensor and applied with a single batched matmul, so running K networks costs about the same
+    number of kernel calls as running one. Meant for the Q function ensembles in sac and td3.
+
+    Example:
+        q_fns = EnsembleMLP(obs_size + act_size, 1, 2, 256, num_nets=2)
+        q_preds = q_fns(torch.cat((obs, acts), dim=1))  # (2, batch_size, 1)
+    """
+
+    def __init__(
+            self, input_size, output_size, num_layers, layer_size, num_nets=2, activation=nn.ReLU, output_activation=nn.Identity, bias=True):
+        """
+         input_size: how many inputs
+         output_size: how many outputs
+         num_layers: how many HIDDEN layers
+         layer_size: how big each hidden layer should be
+         num_nets: how many networks in the ensemble
+         activation: which activation function to use
+         """
+        super(EnsembleMLP, self).__init__()
+
+        self.activation = activation()
+        self.output_activation = output_activation()
+        self.num_nets = num_nets
+
+        sizes = [input_size] + [layer_size] * num_layers + [output_size]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList() if bias else None
+        for in_size, out_size in zip(sizes[:-1], sizes[1:]):
+            # same init as nn.Linear, independently for each network
+            bound = 1 / np.sqrt(in_size)
+            self.weights.append(Parameter(torch.empty(num_nets, in_size, out_size).uniform_(-bound, bound)))
+            if bias:
+                self.biases.append(Parameter(torch.empty(num_nets, 1, out_size).uniform_(-bound, bound)))
+
+        self.state_means = torch.zeros(input_size, requires_grad=False)
+        self.state_std = torch.ones(input_size, requires_grad=False)
+        self.obs_norm = None
+
+    def normalize(self, data):
+        if self.obs_norm is not None:
+            return self.obs_norm(data)
+        return (torch.as_tensor(data) - self.state_means) / self.state_std
+
+    def forward(self, data):
+        """
+        data: (batch_size, input_size), fed to every network, or (num_nets, batch_size, input_size), one batch per network
+        returns: (num_nets, batch_size, output_size)
+        """
+        data = self.normalize(data)
+        if data.dim() == 2:
+            data = data.unsqueeze(0).expand(self.num_nets, -1, -1)
+
+        n_layers = len(self.weights)
+        for i in range(n_layers):
+            if self.biases is not None:
+                data = torch.baddbmm(self.biases[i], data, self.weights[i])
+            else:
+                data = torch.bmm(data, self.weights[i])
+            data = self.activation(data) if i < n_layers - 1 else self.output_activation(data)
+
+        return data
+
+    def to(self, place):
+        super(EnsembleMLP, self).to(place)
+        self.state_means = self.state_means.to(place)
+        self.state_std = self.state_std.to(place)
+        return self
+
+
+class RunningMeanStd(nn.Module):
+    """
+    Running mean and variance of a stream of data, e.g. the observations an agent sees.
+
+    Batches are merged in with the parallel algorithm from Chan et al. (the batch version of Welford's algorithm),
+    which stays accurate as the mean drifts and lets statistics from different workers be merged without sending the
+    raw data around: a worker can ship a (count, sum, sum of squares) or another RunningMeanStd instead.
+
+    The statistics are buffers, so they show up in state_dict and can be moved to shared memory with share_memory().
+    Calling the module normalizes its input, and setting it as the obs_norm of an MLP makes the MLP use it.
+
+    Example:
+        obs_rms = RunningMeanStd(obs_size)
+        policy.obs_norm = obs_rms
+        obs_rms.update(batch_obs)
+    """
+
+    def __init__(self, shape, min_var=1e-6):
+        """
+         shape: shape of a single sample, an int or tuple
+         min_var: dimensions with a variance below this are left unscaled (std of 1)
+         """
+        super(RunningMeanStd, self).__init__()
+        self.min_var = min_var
+        self.register_buffer("mean", torch.zeros(shape, dtype=torch.float64))
+        self.register_buffer("var", torch.ones(shape, dtype=torch.float64))
+        self.register_buffer("count", torch.zeros((), dtype=torch.float64))
+
+    @property
+    def std(self):
+        return torch.where(self.var < self.min_var, torch.ones_like(self.var), torch.sqrt(self.var))
+
+    def update(self, data):
+        """
+        data: (batch_size, *shape) tensor or array
+        """
+        data = torch.as_tensor(data).detach().to(torch.float64).reshape((-1,) + self.mean.shape)
+        if data.shape[0] == 0:
+            return
+        self.update_from_moments(data.mean(dim=0), data.var(dim=0, unbiased=False), data.shape[0])
+
+    def update_from_sums(self, count, total, total_sq):
+        """
+        Merge in a batch given only its count, sum, and sum of squares (less accurate than update when |mean| >> std)
+        """
+        count = float(count)
+        if count == 0:
+            return
+        batch_mean = torch.as_tensor(total, dtype=torch.float64) / count
+        batch_var = torch.clamp(torch.as_tensor(total_sq, dtype=torch.float64) / count - batch_mean ** 2, min=0)
+        self.update_from_moments(batch_mean, batch_var, count)
+
+    def update_from_moments(self, batch_mean, batch_var, batch_count):
+        batch_count = float(batch_count)
+        if batch_count == 0:
+            return
+
+        batch_mean = torch.as_tensor(batch_mean, dtype=torch.float64)
+        batch_var = torch.as_tensor(batch_var, dtype=torch.float64)
+
+        count = self.count.item()
+        tot_count = count + batch_count
+        delta = batch_mean - self.mean
+
+        m2 = self.var * count + batch_var * batch_count + delta ** 2 * count * batch_count / tot_count
+
+        # everything in place so copies in shared memory stay in sync
+        self.mean.add_(delta * batch_count / tot_count)
+        self.var.copy_(m2 / tot_count)
+        self.count.fill_(tot_count)
+
+    def merge(self, other):
+        """
+        Merge the statistics from another RunningMeanStd into this one
+        """
+        self.update_from_moments(other.mean, other.var, other.count.item())
+
+    def forward(self, data):
+        data = torch.as_tensor(data)
+        return ((data - self.mean) / self.std).to(data.dtype)
+
 
 # Nina
 def gaus(x, mu, beta):
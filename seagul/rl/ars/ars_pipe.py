@@ -1,6 +1,8 @@
 import gym
+import numpy as np
 import torch
-from seagul.rl.common import update_std, update_mean
+from seagul.nn import MLP, RunningMeanStd, is_linear, linear_norm
+from seagul.rl.common import EpisodeBuffer, run_episode
 from torch.multiprocessing import Process,Pipe
 import cProfile
 import os
@@ -9,7 +11,10 @@ def worker_fn(worker_con, env_name, env_config, policy, postprocess):
     # pr = cProfile.Profile()
     # pr.enable()
     env = gym.make(env_name, **env_config)
+    buf = None
     epoch = 0
+    if isinstance(policy, MLP) and not is_linear(policy):
+        policy.compile_inference()
 
     while True:
         data = worker_con.recv()
@@ -25,34 +30,51 @@ def worker_fn(worker_con, env_name, env_config, policy, postprocess):
             policy.state_std = state_std
             policy.state_means = state_mean
 
-            states, returns, log_returns = do_rollout_train(env, policy, postprocess, W)
-            worker_con.send((states, returns, log_returns))
-            epoch +=1
-
+            if buf is None:
+                buf = EpisodeBuffer(env.observation_space.shape[0], env.action_space.shape[0], dtype=W.dtype)
+            states, returns, log_returns = do_rollout_train(env, policy, postprocess, W, buf)
 
-def do_rollout_train(env, policy, postprocess, W):
-    torch.nn.utils.vector_to_parameters(W, policy.parameters())
+            # the master only needs the observation statistics, not the whole trajectory
+            obs_moments = (states.shape[0], states.mean(dim=0), states.var(dim=0, unbiased=False))
+            worker_con.send((obs_moments, returns, log_returns))
+            epoch +=1
 
-    state_list = []
-    act_list = [] 
-    reward_list = []
 
+def run_linear_episode(env, weight, mean, std, buf):
+    """
+    run_episode for the linear policy act = weight((obs - mean)/std), in numpy so nothing goes through torch per step
+    """
+    act_shape = env.action_space.shape
     obs = env.reset()
+    buf.start(obs)
     done = False
     while not done:
-        state_list.append(torch.as_tensor(obs))
+        act = weight @ ((obs - mean) / std)
+        obs, rew, done, _ = env.step(act.reshape(act_shape))
+        buf.add(act, rew, obs, done)
+
+    return buf
+
+
+def do_rollout_train(env, policy, postprocess, W, buf=None):
+    if buf is None:
+        buf = EpisodeBuffer(env.observation_space.shape[0], env.action_space.shape[0], dtype=W.dtype)
 
-        actions = policy(torch.as_tensor(obs))
-        obs, reward, done, _ = env.step(actions)
+    if is_linear(policy):
+        mean, std = linear_norm(policy)
+        run_linear_episode(env, W.numpy().reshape(-1, mean.shape[0]), mean, std, buf)
+    else:
+        torch.nn.utils.vector_to_parameters(W, policy.parameters())
+        run_episode(env, policy, buf)
 
-        act_list.append(torch.as_tensor(actions))
-        reward_list.append(reward)
+    # views into buf, only good until the next rollout
+    state_tens = buf.obs1
+    act_tens = buf.acts
+    reward_tens = buf.rews.reshape(-1)
 
-    state_tens = torch.stack(state_list)
-    act_tens = torch.stack(act_list)
-    preprocess_sum = torch.as_tensor(sum(reward_list))
+    preprocess_sum = torch.as_tensor(sum(reward_tens.tolist()))
     nstate_tens = (state_tens - policy.state_means) / policy.state_std
-    reward_list = postprocess(torch.tensor(reward_list), nstate_tens, act_tens)
+    reward_list = postprocess(reward_tens.clone(), nstate_tens, act_tens)
     reward_sum = torch.as_tensor(sum(reward_list))
 
     return state_tens, reward_sum, preprocess_sum
@@ -92,9 +114,9 @@ def ars(env_name, policy, n_epochs, env_config={}, n_workers=8, step_size=.02, n
         W = torch.zeros_like(W)
 
     env = gym.make(env_name,**env_config)
+    obs_rms = RunningMeanStd(env.observation_space.shape[0])
     s_mean = policy.state_means
     s_std = policy.state_std
-    total_steps = 0
     env.close()
 
     r_hist = []
@@ -114,17 +136,15 @@ def ars(env_name, policy, n_epochs, env_config={}, n_workers=8, step_size=.02, n
         for i, _ in enumerate(pm_W):
             results.append(master_pipe_list[i % n_workers].recv())
 
-        states = torch.empty(0)
         p_returns = []
         m_returns = []
         l_returns = []
         top_returns = []
 
         for p_result, m_result in zip(results[:n_delta], results[n_delta:]):
-            ps, pr, plr = p_result
-            ms, mr, mlr = m_result
+            _, pr, plr = p_result
+            _, mr, mlr = m_result
 
-            states = torch.cat((states, ms, ps), dim=0)
             p_returns.append(pr)
             m_returns.append(mr)
             l_returns.append(plr); l_returns.append(mlr)
@@ -138,10 +158,11 @@ def ars(env_name, policy, n_epochs, env_config={}, n_workers=8, step_size=.02, n
         lr_hist.append(l_returns.mean())
         r_hist.append((p_returns.mean() + m_returns.mean())/2)
 
-        ep_steps = states.shape[0]
-        s_mean = update_mean(states, s_mean, total_steps)
-        s_std = update_std(states, s_std, total_steps)
-        total_steps += ep_steps
+        if learn_means:
+            for obs_moments, _, _ in results:
+                obs_rms.update_from_moments(obs_moments[1], obs_moments[2], obs_moments[0])
+            s_mean = obs_rms.mean.to(W.dtype)
+            s_std = obs_rms.std.to(W.dtype)
 
         if epoch % 5 == 0:
             print(f"epoch: {epoch}, reward: {lr_hist[-1].item()}, processed reward: {r_hist[-1].item()} ")
@@ -0,0 +1,375 @@
+import gym
+import numpy as np
+import torch
+from torch.multiprocessing import Process, Queue
+from seagul.nn import MLP, RunningMeanStd, is_linear, linear_norm
+from seagul.rl.common import EpisodeBuffer
+
+
+def worker_fn(worker_id, env_name, env_config, policy, postprocess, shared, job_queue, done_queue):
+    envs = []
+    bufs = []
+    noise = shared["noise"]
+    W = shared["W"]
+    n_param = W.shape[0]
+
+    # These are views into shared memory (as is policy.obs_norm), whatever the master writes shows up here
+    obs_count = shared["obs_count"][worker_id]
+    obs_sum = shared["obs_sum"][worker_id]
+    obs_sumsq = shared["obs_sumsq"][worker_id]
+
+    while True:
+        jobs = job_queue.get()
+
+        if jobs == "STOP":
+            for env in envs:
+                env.close()
+            return
+
+        while len(envs) < len(jobs):
+            env = gym.make(env_name, **env_config)
+            env.seed(shared["seed"] + worker_id*shared["batch_size"] + len(envs))
+            envs.append(env)
+            bufs.append(EpisodeBuffer(env.observation_space.shape[0], env.action_space.shape[0], dtype=W.dtype))
+
+        Ws = torch.stack([W + sign*shared["exp_noise"]*noise[offset:offset + n_param] for _, offset, sign in jobs])
+        if is_linear(policy):
+            results = do_rollout_batch_linear(envs[:len(jobs)], policy, postprocess, Ws, bufs)
+        elif isinstance(policy, MLP):
+            results = do_rollout_batch(envs[:len(jobs)], policy, postprocess, Ws)
+        else:
+            results = [do_rollout_train(env, policy, postprocess, Ws_row) for env, Ws_row in zip(envs, Ws)]
+
+        for (idx, _, _), (states, returns, log_returns) in zip(jobs, results):
+            obs_count += states.shape[0]
+            obs_sum += states.sum(dim=0)
+            obs_sumsq += (states ** 2).sum(dim=0)
+
+            shared["returns"][idx] = returns
+            shared["log_returns"][idx] = log_returns
+
+        done_queue.put(len(jobs))
+
+
+def do_rollout_train(env, policy, postprocess, W):
+    torch.nn.utils.vector_to_parameters(W, policy.parameters())
+
+    state_list = []
+    act_list = []
+    reward_list = []
+
+    obs = env.reset()
+    done = False
+    while not done:
+        state_list.append(torch.as_tensor(obs))
+
+        actions = policy(torch.as_tensor(obs))
+        obs, reward, done, _ = env.step(actions)
+
+        act_list.append(torch.as_tensor(actions))
+        reward_list.append(reward)
+
+    state_tens = torch.stack(state_list)
+    act_tens = torch.stack(act_list)
+    preprocess_sum = torch.as_tensor(sum(reward_list))
+    nstate_tens = policy.normalize(state_tens)
+    reward_list = postprocess(torch.tensor(reward_list), nstate_tens, act_tens)
+    reward_sum = torch.as_tensor(sum(reward_list))
+
+    return state_tens, reward_sum, preprocess_sum
+
+
+def unflatten_mlp(policy, Ws):
+    """
+    Splits a (k, n_param) stack of flat parameter vectors for an MLP into a dict of name -> (k, *param.shape) tensors,
+    same order as torch.nn.utils.parameters_to_vector
+    """
+    params = {}
+    i = 0
+    for name, param in policy.named_parameters():
+        params[name] = Ws[:, i:i + param.numel()].reshape((Ws.shape[0],) + param.shape)
+        i += param.numel()
+    return params
+
+
+def mlp_batch_forward(policy, params, obs):
+    """
+    Evaluates k copies of an MLP on k observations at once, row j of obs goes through the network with parameters j.
+
+    Args:
+        policy: the seagul.nn.MLP the parameters belong to, used for its structure, activations, and normalization
+        params: output of unflatten_mlp
+        obs: (k, input_size) tensor
+
+    Returns:
+        (k, output_size) tensor of actions
+    """
+    if policy.input_bias is not None:
+        obs = obs + params["input_bias"]
+
+    data = policy.normalize(obs)
+
+    def linear(name, data):
+        out = torch.einsum("koi,ki->ko", params[name + ".weight"], data)
+        if name + ".bias" in params:
+            out = out + params[name + ".bias"]
+        return out
+
+    for j in range(len(policy.layers)):
+        data = policy.activation(linear(f"layers.{j}", data))
+
+    return policy.output_activation(linear("output_layer", data))
+
+
+def do_rollout_batch(envs, policy, postprocess, Ws):
+    """
+    Runs one episode in each of envs side by side, env j is controlled by policy with the flat parameters Ws[j].
+    Envs that finish early just drop out of the batch.
+
+    Returns:
+        list with a (states, reward_sum, preprocess_sum) tuple per env, same as do_rollout_train
+    """
+    params = unflatten_mlp(policy, Ws)
+    n_envs = len(envs)
+
+    state_lists = [[] for _ in range(n_envs)]
+    act_lists = [[] for _ in range(n_envs)]
+    reward_lists = [[] for _ in range(n_envs)]
+
+    obs = [env.reset() for env in envs]
+    active = list(range(n_envs))
+    while active:
+        obs_tens = torch.stack([torch.as_tensor(obs[j]) for j in active])
+        active_params = {name: param[active] for name, param in params.items()}
+        actions = mlp_batch_forward(policy, active_params, obs_tens)
+
+        still_active = []
+        for j, act in zip(active, actions):
+            state_lists[j].append(torch.as_tensor(obs[j]))
+            obs[j], reward, done, _ = envs[j].step(act)
+
+            act_lists[j].append(act)
+            reward_lists[j].append(reward)
+            if not done:
+                still_active.append(j)
+        active = still_active
+
+    results = []
+    for state_list, act_list, reward_list in zip(state_lists, act_lists, reward_lists):
+        state_tens = torch.stack(state_list)
+        act_tens = torch.stack(act_list)
+        preprocess_sum = torch.as_tensor(sum(reward_list))
+        nstate_tens = policy.normalize(state_tens)
+        reward_list = postprocess(torch.tensor(reward_list), nstate_tens, act_tens)
+        results.append((state_tens, torch.as_tensor(sum(reward_list)), preprocess_sum))
+
+    return results
+
+
+def do_rollout_batch_linear(envs, policy, postprocess, Ws, bufs=None):
+    """
+    do_rollout_batch for a linear policy (see seagul.nn.is_linear). Each row of Ws is a flattened (act_size, obs_size)
+    matrix, and every step all of them are applied to the normalized observations with one stacked numpy matmul, so
+    nothing goes through torch until the episodes are over. Episode j is recorded into the EpisodeBuffer bufs[j], the
+    states returned are views into those, only good until the next rollout.
+    """
+    n_envs = len(envs)
+    mean, std = linear_norm(policy)
+    weights = Ws.numpy().reshape(n_envs, -1, mean.shape[0])
+    act_shape = envs[0].action_space.shape
+    if bufs is None:
+        bufs = [EpisodeBuffer(env.observation_space.shape[0], env.action_space.shape[0], dtype=Ws.dtype) for env in envs]
+
+    obs = np.stack([env.reset() for env in envs])
+    for buf, env_obs in zip(bufs, obs):
+        buf.start(env_obs)
+
+    active = list(range(n_envs))
+    while active:
+        # rows for finished envs are computed too and thrown away, cheaper than gathering the active ones
+        actions = np.matmul(weights, ((obs - mean) / std)[:, :, None])[:, :, 0]
+
+        still_active = []
+        for j in active:
+            obs[j], reward, done, _ = envs[j].step(actions[j].reshape(act_shape))
+            bufs[j].add(actions[j], reward, obs[j], done)
+            if not done:
+                still_active.append(j)
+        active = still_active
+
+    results = []
+    for buf in bufs[:n_envs]:
+        state_tens = buf.obs1
+        reward_tens = buf.rews.reshape(-1)
+        preprocess_sum = torch.as_tensor(sum(reward_tens.tolist()))
+        nstate_tens = policy.normalize(state_tens)
+        reward_list = postprocess(reward_tens.clone(), nstate_tens, buf.acts)
+        results.append((state_tens, torch.as_tensor(sum(reward_list)), preprocess_sum))
+
+    return results
+
+
+def postprocess_default(rews, obs, acts):
+    return rews
+
+
+def ars(env_name, policy, n_epochs, env_config={}, n_workers=8, step_size=.02, n_delta=32, n_top=16, exp_noise=0.03,
+        zero_policy=True, learn_means=True, postprocess=postprocess_default, seed=0, noise_table_size=int(1e7), batch_size=1):
+    """
+    Augmented Random Search with the workers working out of shared memory
+    https://arxiv.org/pdf/1803.07055
+
+    Same algorithm as seagul.rl.ars.ars_pipe.ars, but nothing big gets passed between processes. Every worker gets a
+    view of one shared table of gaussian noise, and each perturbation is sent as an (index, offset, sign) triple, the
+    worker rebuilds W +/- exp_noise*noise[offset:offset+n_param] itself. Returns are written into a shared array, and
+    instead of sending back whole trajectories the workers keep a count/sum/sum of squares of the states they see in
+    shared memory, which the master merges into the policies obs_norm (a seagul.nn.RunningMeanStd) every epoch.
+
+    Work is handed out through a queue, so a worker that draws short episodes just goes back for more instead of
+    waiting on the slowest one. With batch_size > 1 each job is several perturbations, which the worker runs side by
+    side in its own env copies, evaluating all the perturbed policies with one stacked matrix product per step (only
+    for seagul.nn.MLP policies, anything else is run one rollout at a time). Linear policies (a seagul.nn.LinearPolicy
+    or an MLP with no hidden layers and no biases) are evaluated in numpy, where the policy costs next to nothing
+    compared to the simulator, and n_workers=1 with batch_size=2*n_delta evaluates every perturbation in one matmul.
+
+    Args:
+        env_name: name of the gym environment to train on
+        policy: seagul.nn.MLP or LinearPolicy to train (or another module with the same obs_norm / normalize hooks)
+        n_epochs: how many epochs (policy updates) to do
+        env_config: kwargs passed to gym.make
+        n_workers: number of worker processes
+        step_size: step size for the update to W
+        n_delta: number of perturbations per epoch, each one is evaluated in the + and - direction
+        n_top: only the n_top best directions are used in the update
+        exp_noise: std of the perturbations
+        zero_policy: if True start from W = 0
+        learn_means: if True keep a RunningMeanStd of the states seen during training as the policies obs_norm
+        postprocess: fn(rews, normalized_obs, acts) -> rews, applied to each rollout before summing
+        seed: seeds the noise table, the perturbation offsets, and the workers environments
+        noise_table_size: number of entries in the shared noise table, must be bigger than the number of parameters
+        batch_size: how many rollouts a worker takes off the queue at once
+
+    Returns:
+        policy: the trained policy
+        r_hist: list of the mean (postprocessed) return of the top directions at each epoch
+        lr_hist: list of the mean raw return of the top directions at each epoch
+
+    Example:
+        from seagul.nn import MLP, RunningMeanStd
+        policy = MLP(17, 6, 0, 0, bias=False)
+        policy, r_hist, lr_hist = ars("HalfCheetah-v2", policy, 100, n_workers=8)
+    """
+    torch.autograd.set_grad_enabled(False)
+
+    W = torch.nn.utils.parameters_to_vector(policy.parameters())
+    n_param = W.shape[0]
+    if zero_policy:
+        W = torch.zeros_like(W)
+
+    if noise_table_size <= n_param:
+        raise ValueError(f"noise_table_size ({noise_table_size}) needs to be bigger than the number of parameters ({n_param})")
+
+    env = gym.make(env_name, **env_config)
+    obs_size = env.observation_space.shape[0]
+    env.close()
+
+    if learn_means and policy.obs_norm is None:
+        policy.obs_norm = RunningMeanStd(obs_size)
+    if policy.obs_norm is not None:
+        policy.obs_norm.share_memory()
+
+    rng = torch.Generator()
+    rng.manual_seed(seed)
+
+    shared = {
+        "seed": seed,
+        "batch_size": batch_size,
+        "exp_noise": exp_noise,
+        "noise": torch.randn(noise_table_size, generator=rng, dtype=W.dtype).share_memory_(),
+        "W": W.clone().share_memory_(),
+        "obs_count": torch.zeros(n_workers, dtype=torch.int64).share_memory_(),
+        "obs_sum": torch.zeros(n_workers, obs_size, dtype=torch.float64).share_memory_(),
+        "obs_sumsq": torch.zeros(n_workers, obs_size, dtype=torch.float64).share_memory_(),
+        "returns": torch.zeros(2 * n_delta, dtype=W.dtype).share_memory_(),
+        "log_returns": torch.zeros(2 * n_delta, dtype=W.dtype).share_memory_(),
+    }
+
+    job_queue = Queue()
+    done_queue = Queue()
+    proc_list = []
+    for i in range(n_workers):
+        proc = Process(target=worker_fn, args=(i, env_name, env_config, policy, postprocess, shared, job_queue, done_queue))
+        proc.start()
+        proc_list.append(proc)
+
+    r_hist = []
+    lr_hist = []
+
+    for epoch in range(n_epochs):
+        offsets = torch.randint(0, noise_table_size - n_param + 1, (n_delta,), generator=rng).tolist()
+
+        jobs = [(i, offset, 1.0) for i, offset in enumerate(offsets)] + \
+               [(i + n_delta, offset, -1.0) for i, offset in enumerate(offsets)]
+
+        for i in range(0, len(jobs), batch_size):
+            job_queue.put(jobs[i:i + batch_size])
+
+        n_done = 0
+        while n_done < len(jobs):
+            n_done += done_queue.get()
+
+        p_returns = shared["returns"][:n_delta].clone()
+        m_returns = shared["returns"][n_delta:].clone()
+        l_returns = shared["log_returns"].clone()
+
+        top_idx = torch.argsort(torch.max(p_returns, m_returns), descending=True)[:n_top]
+        p_returns = p_returns[top_idx]
+        m_returns = m_returns[top_idx]
+        l_returns = torch.cat((l_returns[:n_delta][top_idx], l_returns[n_delta:][top_idx]))
+        deltas = torch.stack([shared["noise"][offsets[i]:offsets[i] + n_param] for i in top_idx.tolist()])
+
+        lr_hist.append(l_returns.mean())
+        r_hist.append((p_returns.mean() + m_returns.mean()) / 2)
+
+        if learn_means:
+            policy.obs_norm.update_from_sums(shared["obs_count"].sum(), shared["obs_sum"].sum(dim=0),
+                                             shared["obs_sumsq"].sum(dim=0))
+            shared["obs_count"].zero_()
+            shared["obs_sum"].zero_()
+            shared["obs_sumsq"].zero_()
+
+        if epoch % 5 == 0:
+            print(f"epoch: {epoch}, reward: {lr_hist[-1].item()}, processed reward: {r_hist[-1].item()} ")
+
+        W = W + (step_size / (n_delta * torch.cat((p_returns, m_returns)).std() + 1e-6)) * torch.sum((p_returns - m_returns)*deltas.T, dim=1)
+        shared["W"].copy_(W)
+
+    for _ in proc_list:
+        job_queue.put("STOP")
+    for proc in proc_list:
+        proc.join()
+
+    torch.nn.utils.vector_to_parameters(W, policy.parameters())
+    return policy, r_hist, lr_hist
+
+
+if __name__ == "__main__":
+    torch.set_default_dtype(torch.float64)
+    import seagul.envs
+    import matplotlib.pyplot as plt
+    from seagul.nn import MLP, RunningMeanStd
+
+    env_name = "HalfCheetah-v2"
+    env = gym.make(env_name)
+    in_size = env.observation_space.shape[0]
+    out_size = env.action_space.shape[0]
+
+    policy = MLP(in_size, out_size, 0, 0, bias=False)
+
+    import time
+    start = time.time()
+    policy, r_hist, lr_hist = ars(env_name, policy, 20, n_workers=8, n_delta=32, n_top=16)
+    print(time.time() - start)
+
+    plt.plot(lr_hist)
+    plt.show()
@@ -0,0 +1,191 @@
+import time
+
+import dill
+import gym
+import numpy as np
+import torch
+from torch.multiprocessing import Process, Queue, Lock
+
+from seagul.rl.common import EpisodeBuffer, PolyakTarget, PrioritizedReplayBuffer
+
+# slots of the shared progress tensor
+_ENV_STEPS, _UPDATES, _STOP = 0, 1, 2
+
+
+def actor_fn(env_name, env_config, model, replay_buf, rollout_payload, lock, progress, rew_queue, start_steps,
+             utd_ratio, max_lead, seed):
+    """
+    Actor process loop, keeps running episodes with model (whose policy the learner overwrites every so often) and
+    storing them in the shared replay_buf until the learner sets the stop flag. Waits instead whenever it is more than
+    max_lead env steps ahead of what the learner has trained on.
+    """
+    torch.set_num_threads(1)
+    rollout_fn = dill.loads(rollout_payload)
+
+    env = gym.make(env_name, **env_config)
+    env.seed(seed)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    act_size = env.action_space.shape[0]
+    buf = EpisodeBuffer(env.observation_space.shape[0], act_size)
+
+    while not progress[_STOP]:
+        steps = int(progress[_ENV_STEPS])
+        if steps - start_steps - int(progress[_UPDATES]) / utd_ratio > max_lead:
+            time.sleep(1e-3)
+            continue
+
+        # the learner writes the policy straight into shared memory, which the inference snapshot can't notice
+        if getattr(model.policy, "inference_compiled", False):
+            model.policy.compile_inference()
+
+        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = rollout_fn(env, model, buf, steps)
+        with lock:
+            replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
+            progress[_ENV_STEPS] += ep_rews.shape[0]
+
+        rew_queue.put(float(ep_rews.sum()))
+
+    env.close()
+
+
+class AsyncActors:
+    """
+    Actor processes for off policy algorithms, they collect data while the learner (the process that made this)
+    trains, instead of the two taking turns.
+
+    Each actor steps its own copy of the environment with a copy of the model whose policy parameters live in shared
+    memory, and pushes whole episodes into replay_buf, which has to be a ReplayBuffer made with shared=True. The
+    learner overwrites the shared policy with the one it's training every sync_every updates. Actors can act with a
+    half copied policy now and then, which doesn't matter for off policy learning.
+
+    The update to data ratio is throttled from both sides. The learner may only take utd_ratio gradient steps per env
+    step collected since the actors started (see updates_allowed), and actors pause once they are more than max_lead
+    env steps ahead of what the learner has caught up on. Training stops on env steps, so the learner ends up to
+    max_lead * utd_ratio updates short of the ratio.
+
+    Args:
+        env_name: name of the gym environment
+        env_config: kwargs passed to gym.make
+        model: model the learner trains, the actors get a copy
+        replay_buf: ReplayBuffer with shared=True
+        rollout_fn: fn(env, model, buf, total_steps) -> (obs1, obs2, acts, rews, done), runs one episode into the
+            EpisodeBuffer buf, total_steps is the number of env steps taken so far (for exploration schedules)
+        n_actors: number of actor processes
+        start_steps: env steps already taken before the actors were started
+        utd_ratio: gradient updates per env step
+        max_lead: how many env steps the actors may get ahead of the learner
+        sync_every: how many updates between copies of the policy to the actors
+        seed: actor i is seeded with seed + 1 + i
+
+    Example:
+        actors = AsyncActors(env_name, env_config, model, replay_buf, rollout_fn, n_actors=3)
+        while actors.steps < train_steps:
+            n_iters = min(actors.updates_allowed(), iters_per_update)
+            if n_iters <= 0:
+                time.sleep(1e-3)
+                continue
+            for replay_batch in zip(*actors.sample_batches(replay_batch_size, n_iters)):
+                ...
+            actors.record_updates(n_iters)
+        actors.close()
+    """
+
+    def __init__(self, env_name, env_config, model, replay_buf, rollout_fn, n_actors, start_steps=0, utd_ratio=1.0,
+                 max_lead=5000, sync_every=100, seed=0):
+        if getattr(replay_buf, "shm", None) is None:
+            raise ValueError("replay_buf needs to be a ReplayBuffer made with shared=True")
+        if isinstance(replay_buf, PrioritizedReplayBuffer):
+            raise NotImplementedError("actors can't update the priority tree of a PrioritizedReplayBuffer")
+        if utd_ratio <= 0:
+            raise ValueError(f"utd_ratio must be positive, got {utd_ratio}")
+
+        self.replay_buf = replay_buf
+        self.start_steps = start_steps
+        self.utd_ratio = utd_ratio
+        self.sync_every = sync_every
+        self.n_updates = 0
+
+        self.actor_model = dill.loads(dill.dumps(model))
+        for param in self.actor_model.policy.parameters():
+            param.requires_grad = False
+            param.share_memory_()
+        self.policy_sync = PolyakTarget(model.policy, self.actor_model.policy)
+
+        self.lock = Lock()
+        self.rew_queue = Queue()
+        self.progress = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.progress[_ENV_STEPS] = start_steps
+
+        rollout_payload = dill.dumps(rollout_fn)
+        self.proc_list = []
+        for i in range(n_actors):
+            proc = Process(target=actor_fn, args=(env_name, env_config, self.actor_model, replay_buf, rollout_payload,
+                                                  self.lock, self.progress, self.rew_queue, start_steps, utd_ratio,
+                                                  max_lead, seed + 1 + i))
+            proc.start()
+            self.proc_list.append(proc)
+
+    @property
+    def steps(self):
+        """
+        Total env steps taken, including the start_steps taken before the actors started
+        """
+        return int(self.progress[_ENV_STEPS])
+
+    def check_actors(self):
+        """
+        Raises a RuntimeError if any of the actors died, they only exit on their own after close
+        """
+        for i, proc in enumerate(self.proc_list):
+            if not proc.is_alive():
+                raise RuntimeError(f"actor {i} (pid {proc.pid}) exited with code {proc.exitcode} while training, "
+                                   f"see its traceback above")
+
+    def updates_allowed(self):
+        """
+        How many updates the learner may take right now, also checks that the actors are still running, since the
+        learner would otherwise wait on them forever
+        """
+        self.check_actors()
+        return int(self.utd_ratio * (self.steps - self.start_steps)) - self.n_updates
+
+    def sample_batches(self, batch_size, n_batches):
+        with self.lock:
+            return self.replay_buf.sample_batches(batch_size, n_batches)
+
+    def record_updates(self, n_iters):
+        """
+        Lets the actors know the learner took n_iters more updates, and syncs the policy if it's time to
+        """
+        if (self.n_updates + n_iters) // self.sync_every > self.n_updates // self.sync_every:
+            self.policy_sync.update(0)
+
+        self.n_updates += n_iters
+        self.progress[_UPDATES] = self.n_updates
+
+    def poll_returns(self):
+        """
+        Returns of every episode the actors finished since the last call
+        """
+        returns = []
+        while not self.rew_queue.empty():
+            returns.append(self.rew_queue.get())
+        return returns
+
+    def close(self, timeout=60):
+        """
+        Stops the actors, they finish the episode they are on first. Any still running after timeout seconds (stuck in
+        the env, or waiting on a lock a dead actor never released) are terminated.
+        """
+        self.progress[_STOP] = 1
+        deadline = time.time() + timeout
+        for proc in self.proc_list:
+            while proc.is_alive() and time.time() < deadline:
+                self.poll_returns()
+                proc.join(timeout=.1)
+
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
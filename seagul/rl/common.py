@@ -1,62 +1,314 @@
+import os
 import torch
 import numpy as np
 from torch.distributions import Normal, Categorical
+from scipy.signal import lfilter
 
 
 
 class ReplayBuffer:
     """
-    A simple FIFO experience replay buffer (modifed from from https://github.com/openai/spinningup/blob/master/spinup/algos/sac/sac.py)
+    A FIFO experience replay buffer (originally modifed from from https://github.com/openai/spinningup/blob/master/spinup/algos/sac/sac.py)
+
+    Everything lives in one preallocated numpy structured array, one record per row, which can optionally be put in
+    shared memory or memory mapped to a file. By default next observations are not stored separately, the next obs
+    for row i is just the obs in row i+1. Wherever that isn't true (the end of an episode, or the end of a call to
+    store) an extra row holding the next obs is written and marked invalid so it never gets sampled. That costs one row
+    per episode instead of doubling the memory used for observations, so leave room for one extra row per episode on
+    top of the number of transitions you want to keep.
+
+    sample_batches draws all the minibatches for an update phase with a single gather.
+
+    Args:
+        obs_dim: size of the observations
+        act_dim: size of the actions
+        max_size: number of rows to allocate, with share_next_obs each episode (and each call to store) uses one extra
+            row, so a buffer shorter than an episode can end up with nothing it can sample
+        share_next_obs: if False store next_obs in its own field instead of reusing the following row
+        shared: if True allocate the array (and ptr/size) in multiprocessing.shared_memory. Pickling the buffer then
+            only sends shm_name, so a copy handed to another process attaches to the same memory. Nothing is locked,
+            concurrent writers need to hold a lock around store (see seagul.rl.async_actors)
+        filename: if not None back the array with an np.memmap of this file
+
+    Example:
+        replay_buf = ReplayBuffer(obs_size, act_size, int(1e6))
+        replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
+        for obs1, obs2, acts, rews, done in zip(*replay_buf.sample_batches(64, 100)):
+            ...
     """
 
-    def __init__(self, obs_dim, act_dim, max_size):
-        self.obs1_buf = torch.zeros([max_size, obs_dim], dtype=torch.float32)
-        self.obs2_buf = torch.zeros([max_size, obs_dim], dtype=torch.float32)
-        self.acts_buf = torch.zeros([max_size, act_dim], dtype=torch.float32)
-        self.rews_buf = torch.zeros([max_size, 1], dtype=torch.float32)
-        self.done_buf = torch.zeros([max_size, 1], dtype=torch.float32)
-        self.ptr, self.size, self.max_size = 0, 0, max_size
+    def __init__(self, obs_dim, act_dim, max_size, share_next_obs=True, shared=False, filename=None):
+        self.obs_dim, self.act_dim, self.max_size = obs_dim, act_dim, max_size
+        self.share_next_obs = share_next_obs
+
+        fields = [("obs", np.float32, (obs_dim,)), ("act", np.float32, (act_dim,)), ("rew", np.float32),
+                  ("done", np.float32), ("valid", np.float32)]
+        if not share_next_obs:
+            fields.append(("next_obs", np.float32, (obs_dim,)))
+        self.dtype = np.dtype(fields)
+
+        self.shm = None
+        if shared:
+            from multiprocessing import shared_memory
+            self.shm = shared_memory.SharedMemory(create=True, size=self.dtype.itemsize * max_size + 24)
+            self.shm_name = self.shm.name
+            self.shm_owner_pid = os.getpid()
+            self._attach()
+            self.data[:] = np.zeros(1, dtype=self.dtype)
+            self._counters[:] = 0
+        elif filename is not None:
+            self.data = np.memmap(filename, dtype=self.dtype, mode="w+", shape=(max_size,))
+            self._counters = np.zeros(3, dtype=np.int64)
+        else:
+            self.data = np.zeros(max_size, dtype=self.dtype)
+            self._counters = np.zeros(3, dtype=np.int64)
+
+    def _attach(self):
+        # [ptr, size, n_valid] live in the first 24 bytes of the shared block so every process sees the same ones
+        self._counters = np.ndarray((3,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((self.max_size,), dtype=self.dtype, buffer=self.shm.buf, offset=24)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shm is not None:
+            del state["data"], state["_counters"], state["shm"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "data" not in state:
+            from multiprocessing import shared_memory
+            self.shm = shared_memory.SharedMemory(name=self.shm_name)
+            self._attach()
+
+    @property
+    def ptr(self):
+        return int(self._counters[0])
+
+    @ptr.setter
+    def ptr(self, value):
+        self._counters[0] = value
+
+    @property
+    def size(self):
+        return int(self._counters[1])
+
+    @size.setter
+    def size(self, value):
+        self._counters[1] = value
+
+    @property
+    def n_valid(self):
+        """
+        Number of rows that can be sampled, size minus the rows that only hold a next obs
+        """
+        return int(self._counters[2])
+
+    @n_valid.setter
+    def n_valid(self, value):
+        self._counters[2] = value
+
+    @property
+    def obs1_buf(self):
+        return torch.from_numpy(self.data["obs"])
 
     def store(self, obs, next_obs, act, rew, done):
-        
-        insert_size = obs.shape[0]
-        space_left = self.max_size - (self.ptr + insert_size)
-        
-        if(space_left >= 0):
-            self.obs1_buf[self.ptr:self.ptr + insert_size,:] = obs
-            self.obs2_buf[self.ptr:self.ptr + insert_size,:] = next_obs
-            self.acts_buf[self.ptr:self.ptr + insert_size,:] = act
-            self.rews_buf[self.ptr:self.ptr + insert_size,:] = rew
-            self.done_buf[self.ptr:self.ptr + insert_size,:] = done
-            
-            self.ptr = self.ptr + insert_size
-            self.size = max(self.size, self.ptr)
-            
+        obs = np.asarray(obs, dtype=np.float32).reshape(-1, self.obs_dim)
+        next_obs = np.asarray(next_obs, dtype=np.float32).reshape(-1, self.obs_dim)
+        n = obs.shape[0]
+
+        if self.share_next_obs:
+            # a segment ends wherever the next obs isn't the following obs, each one gets an extra row for its next obs
+            seg_ends = np.nonzero(np.any(next_obs[:-1] != obs[1:], axis=1))[0]
+            seg_ends = np.append(seg_ends, n - 1)
+            pos = np.arange(n) + np.searchsorted(seg_ends, np.arange(n))
+
+            block = np.zeros(n + seg_ends.shape[0], dtype=self.dtype)
+            block["obs"][pos[seg_ends] + 1] = next_obs[seg_ends]
+        else:
+            pos = np.arange(n)
+            block = np.zeros(n, dtype=self.dtype)
+            block["next_obs"] = next_obs
+
+        block["obs"][pos] = obs
+        block["act"][pos] = np.asarray(act, dtype=np.float32).reshape(n, self.act_dim)
+        block["rew"][pos] = np.asarray(rew, dtype=np.float32).reshape(n)
+        block["done"][pos] = np.asarray(done, dtype=np.float32).reshape(n)
+        block["valid"][pos] = 1
+
+        block = block[-self.max_size:]
+        insert_size = block.shape[0]
+        space_at_end = min(self.max_size - self.ptr, insert_size)
+
+        rows = (self.ptr + np.arange(insert_size)) % self.max_size
+        self.n_valid = self.n_valid + int(block["valid"].sum()) - int(self.data["valid"][rows].sum())
+
+        self.data[self.ptr:self.ptr + space_at_end] = block[:space_at_end]
+        self.data[:insert_size - space_at_end] = block[space_at_end:]
+
+        self.ptr = (self.ptr + insert_size) % self.max_size
+        self.size = min(self.size + insert_size, self.max_size)
+        return rows
+
+    def sample_idxs(self, n_samples):
+        if self.n_valid == 0:
+            raise ValueError(f"nothing to sample, the buffer holds {self.size} rows but none of them are transitions "
+                             f"(max_size={self.max_size} may be too small to fit an episode plus its next obs row)")
+
+        idxs = np.random.randint(0, self.size, size=n_samples)
+        invalid = self.data["valid"][idxs] == 0
+        while invalid.any():
+            idxs[invalid] = np.random.randint(0, self.size, size=np.count_nonzero(invalid))
+            invalid[invalid] = self.data["valid"][idxs[invalid]] == 0
+        return idxs
+
+    def get(self, idxs):
+        """
+        Returns (obs1, obs2, acts, rews, done) tensors for the transitions at idxs, with idxs.shape as leading dims
+        """
+        rows = self.data[idxs]
+        if self.share_next_obs:
+            next_obs = self.data["obs"][(idxs + 1) % self.max_size]
         else:
-            
-            space_at_end = self.max_size - self.ptr
-            space_at_beg = (self.ptr + insert_size) - self.max_size
-            
-            self.obs1_buf[self.ptr:,:] = obs[:space_at_end,:]
-            self.obs2_buf[self.ptr:,:] = next_obs[:space_at_end,:]
-            self.acts_buf[self.ptr:,:] = act[:space_at_end,:]
-            self.rews_buf[self.ptr:,:] = rew[:space_at_end,:]
-            self.done_buf[self.ptr:,:] = done[:space_at_end,:]
-            
-            self.obs1_buf[:space_at_beg,:] = obs[space_at_end:,:]
-            self.obs2_buf[:space_at_beg,:] = next_obs[space_at_end:,:]
-            self.acts_buf[:space_at_beg,:] = act[space_at_end:,:]
-            self.rews_buf[:space_at_beg,:] = rew[space_at_end:,:]
-            self.done_buf[:space_at_beg,:] = done[space_at_end:,:]
-            
-            self.ptr = (self.ptr + insert_size) % self.max_size
-            self.size = self.max_size 
-            
+            next_obs = rows["next_obs"]
+
+        return (torch.from_numpy(rows["obs"]), torch.from_numpy(next_obs), torch.from_numpy(rows["act"]),
+                torch.from_numpy(rows["rew"])[..., None], torch.from_numpy(rows["done"])[..., None])
 
     def sample_batch(self, batch_size=32):
-        idxs = np.random.randint(0, self.size, size=batch_size)
-        return (self.obs1_buf[idxs], self.obs2_buf[idxs], self.acts_buf[idxs], self.rews_buf[idxs], self.done_buf[idxs])
+        return self.get(self.sample_idxs(batch_size))
 
+    def sample_batches(self, batch_size, n_batches):
+        """
+        Samples n_batches minibatches at once, returned tensors have shape (n_batches, batch_size, ...)
+        """
+        return self.get(self.sample_idxs(n_batches * batch_size).reshape(n_batches, batch_size))
+
+    def close(self):
+        """
+        Frees the shared memory, copies attached from other processes only detach from it
+        """
+        if self.shm is not None:
+            self.data = np.zeros(0, dtype=self.dtype)
+            self._counters = self._counters.copy()
+            self.shm.close()
+            if os.getpid() == self.shm_owner_pid:
+                self.shm.unlink()
+            self.shm = None
+
+
+class SumTree:
+    """
+    Array backed binary tree where every node holds the sum of its children, used for sampling in proportion to a
+    priority. Leaves live at tree[capacity:2*capacity] (capacity is rounded up to a power of 2), node i has children
+    2i and 2i+1, tree[1] is the total. Both updates and lookups take a whole array of indices at once and go one level
+    of the tree at a time, so a batch costs O(batch_size * log(capacity)) in a handful of numpy calls.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.tree = np.zeros(2 * self.capacity)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxs):
+        return self.tree[np.asarray(idxs) + self.capacity]
+
+    def update(self, idxs, values):
+        nodes = np.asarray(idxs).reshape(-1) + self.capacity
+        self.tree[nodes] = values
+        # all the leaves are at the same depth, so we can move the whole batch up a level at a time
+        while nodes.shape[0] > 0 and nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Returns the leaf index for each entry of values, i.e. the first leaf where the cumulative sum exceeds the value
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        for _ in range(int(np.log2(self.capacity))):
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Proportional prioritized experience replay (https://arxiv.org/abs/1511.05952) on top of ReplayBuffer
+
+    Transitions are sampled with probability p_i^alpha / sum_k p_k^alpha, new transitions get the current max priority.
+    sample_batch / sample_batches return the usual (obs1, obs2, acts, rews, done) plus the importance sampling weights
+    and the sampled row indices, pass the indices and the new TD errors to update_priorities after the update.
+
+    Args:
+        obs_dim, act_dim, max_size: see ReplayBuffer, other kwargs are passed through to it
+        alpha: how strongly to prioritize, 0 is uniform sampling
+        beta: importance sampling correction, 1 fully corrects for the non uniform sampling
+        eps: added to the TD errors so nothing ends up with zero priority
+
+    Example:
+        replay_buf = PrioritizedReplayBuffer(obs_size, act_size, int(1e6))
+        model, rews, var_dict = sac(env_name, train_steps, model, replay_buf=replay_buf)
+    """
+
+    def __init__(self, obs_dim, act_dim, max_size, alpha=0.6, beta=0.4, eps=1e-6, **kwargs):
+        super(PrioritizedReplayBuffer, self).__init__(obs_dim, act_dim, max_size, **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree = SumTree(max_size)
+
+    def store(self, obs, next_obs, act, rew, done):
+        rows = super(PrioritizedReplayBuffer, self).store(obs, next_obs, act, rew, done)
+        self.tree.update(rows, self.max_priority * self.data["valid"][rows])
+        return rows
+
+    def sample_idxs(self, n_samples):
+        """
+        n_samples: an int, or a (n_batches, batch_size) shape, in which case each batch is stratified over the whole
+            buffer on its own
+        """
+        # stratified, one sample from each of batch_size equal slices of the total priority
+        shape = np.atleast_1d(n_samples)
+        batch_size = shape[-1]
+        bounds = (np.arange(batch_size) + np.random.uniform(size=shape)) * (self.tree.total / batch_size)
+        idxs = self.tree.find(bounds)
+
+        # floating point can very occasionally land us on an empty leaf, just resample those uniformly
+        invalid = self.tree[idxs] == 0
+        if invalid.any():
+            idxs[invalid] = super(PrioritizedReplayBuffer, self).sample_idxs(np.count_nonzero(invalid))
+        return idxs
+
+    def sample_batches(self, batch_size, n_batches):
+        return self.get(self.sample_idxs((n_batches, batch_size)))
+
+    def get(self, idxs):
+        """
+        Same as ReplayBuffer.get plus the importance sampling weights (normalized by the max within each batch, the last
+        dim of idxs) and idxs
+        """
+        # N is the number of rows that could have been sampled, the next obs only rows have zero priority
+        probs = self.tree[idxs] / self.tree.total
+        weights = (self.n_valid * probs) ** -self.beta
+        weights = weights / weights.max(axis=-1, keepdims=True)
+        batch = super(PrioritizedReplayBuffer, self).get(idxs)
+        return batch + (torch.as_tensor(weights, dtype=torch.float32)[..., None], torch.as_tensor(idxs))
+
+    def update_priorities(self, idxs, td_errors):
+        idxs = np.asarray(idxs).reshape(-1)
+        priorities = (np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.eps) ** self.alpha
+        self.tree.update(idxs, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
 
 
 def update_mean(data, cur_mean, cur_steps):
@@ -77,14 +329,55 @@ def update_std(data, cur_std, cur_steps):
         return torch.sqrt((new_var * new_steps + cur_var * cur_steps) / (cur_steps + new_steps))
 
 
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
+def discount_cumsum(rewards, discount, dones=None, last_value=None):
+    """
+    Discounted cumulative sum along the first axis, c[t] = rewards[t] + discount*(1 - dones[t])*c[t+1]
+
+    Runs as an IIR filter (scipy.signal.lfilter) over the whole array, so many episodes (and many envs, one per column)
+    can go through in a single call. Episode boundaries are handled by subtracting off whatever leaked across them.
+
+    Args:
+        rewards: (T,) or (T, ...) tensor or array
+        discount: discount factor, gamma for returns or gamma*lam for GAE
+        dones: optional bool array the same shape as rewards, True on the last step of an episode
+        last_value: optional (...) array, value of the step after the last one (bootstrap for unfinished episodes)
+
+    Returns:
+        cumulative_rewards: tensor the same shape as rewards
+
+    Example:
+        ret = discount_cumsum(rews, .99, dones, last_value=value_fn(last_obs))
+    """
+    out_dtype = torch.as_tensor(rewards).dtype
+    rewards = np.asarray(torch.as_tensor(rewards).detach(), dtype=np.float64)
+    if dones is not None:
+        dones = np.asarray(torch.as_tensor(dones).detach(), dtype=bool).reshape(rewards.shape)
+
+    if last_value is not None:
+        last_value = np.asarray(torch.as_tensor(last_value).detach(), dtype=np.float64).reshape(rewards.shape[1:])
+        rewards = np.concatenate((rewards, last_value[np.newaxis]))
+        if dones is not None:
+            dones = np.concatenate((dones, np.zeros_like(dones[:1])))
+
+    # y[t] = x[t] + discount*y[t-1] on the time reversed rewards
+    cumulative_rewards = lfilter([1.0], [1.0, -discount], rewards[::-1], axis=0)[::-1]
+
+    if dones is not None and dones.any():
+        # every step t picks up discount**(end - t + 1) * c[end + 1] from past the end of its episode, take it back off
+        T = rewards.shape[0]
+        steps = np.arange(T).reshape((-1,) + (1,) * (rewards.ndim - 1))
+        ep_end = np.where(dones, steps, T)
+        ep_end = np.minimum.accumulate(ep_end[::-1], axis=0)[::-1]
+        next_start = np.minimum(ep_end + 1, T)
+
+        padded = np.concatenate((cumulative_rewards, np.zeros_like(cumulative_rewards[:1])))
+        leaked = np.take_along_axis(padded, next_start, axis=0) * discount ** (next_start - steps)
+        cumulative_rewards = cumulative_rewards - leaked
+
+    if last_value is not None:
+        cumulative_rewards = cumulative_rewards[:-1]
+
+    return torch.as_tensor(np.ascontiguousarray(cumulative_rewards), dtype=out_dtype)
 
 
 class RandModel:
@@ -108,13 +401,202 @@ def make_schedule(std_schedule, num_steps):
     return std_lookup
 
 
+class PolyakTarget:
+    """
+    Keeps target_fn as a polyak average of fn, target = polyak*target + (1 - polyak)*fn, updated in place.
+
+    The matching parameters of both networks are collected into two flat lists once, so an update is a single fused
+    torch._foreach_lerp_ (one lerp_ per tensor on versions of torch without it) rather than building, blending and
+    loading a new state_dict. Parameters keep their identity through module.to(), so the networks can still be moved
+    between devices. Only parameters are averaged, buffers (like an obs_norm shared with fn) are left alone.
+
+    Example:
+        target_value_fn = dill.loads(dill.dumps(model.value_fn))
+        value_target = PolyakTarget(model.value_fn, target_value_fn)
+        ...
+        value_target.update(polyak)
+    """
+
+    def __init__(self, fn, target_fn):
+        self.fn = fn
+        self.target_fn = target_fn
+
+        fn_params = dict(fn.named_parameters())
+        target_params = dict(target_fn.named_parameters())
+        if fn_params.keys() != target_params.keys():
+            raise ValueError("fn and target_fn need to have the same parameters")
+
+        self.source_params = [fn_params[name] for name in target_params]
+        self.target_params = list(target_params.values())
+
+    def update(self, polyak):
+        with torch.no_grad():
+            if hasattr(torch, "_foreach_lerp_"):
+                torch._foreach_lerp_(self.target_params, self.source_params, 1 - polyak)
+            else:
+                for target_param, param in zip(self.target_params, self.source_params):
+                    target_param.lerp_(param, 1 - polyak)
+
+        return self.target_fn
+
+
 def update_target_fn(fn, target_fn, polyak):
+    """
+    One off version of PolyakTarget(fn, target_fn).update(polyak), prefer PolyakTarget inside a training loop
+    """
+    return PolyakTarget(fn, target_fn).update(polyak)
+
+
+class EpisodeBuffer:
+    """
+    Preallocated storage for one episode at a time, reused from one episode to the next.
+
+    Observations go into a single (max_steps + 1, obs_size) array, so obs1 and obs2 are overlapping views of the same
+    memory rather than two copies. Steps are written into numpy arrays (much cheaper per element than indexing into a
+    tensor) which the torch tensors handed out share memory with. If an episode runs past max_steps everything doubles
+    in size. The properties are views into the buffer, not copies: they are only good until the next episode starts,
+    clone them to keep them longer (ReplayBuffer.store, torch.cat and friends already copy).
+
+    Example:
+        buf = EpisodeBuffer(obs_size, act_size, env_max_steps)
+        run_episode(env, lambda obs: policy(obs), buf)
+        replay_buf.store(buf.obs1, buf.obs2, buf.acts, buf.rews, buf.dones)
+    """
+
+    def __init__(self, obs_size, act_size, max_steps=1000, dtype=torch.float32):
+        max_steps = max(int(max_steps), 1)
+        np_dtype = torch.zeros(0, dtype=dtype).numpy().dtype
+
+        self.length = 0
+        self._obs = np.zeros((max_steps + 1, obs_size), dtype=np_dtype)
+        self._acts = np.zeros((max_steps, act_size), dtype=np_dtype)
+        self._rews = np.zeros((max_steps, 1), dtype=np_dtype)
+        self._dones = np.zeros((max_steps, 1), dtype=bool)
+        self._make_views()
+
+    def __len__(self):
+        return self.length
+
+    def _make_views(self):
+        self._obs_t = torch.from_numpy(self._obs)
+        self._acts_t = torch.from_numpy(self._acts)
+        self._rews_t = torch.from_numpy(self._rews)
+        self._dones_t = torch.from_numpy(self._dones)
+
+    def _grow(self):
+        for name in ["_obs", "_acts", "_rews", "_dones"]:
+            old = getattr(self, name)
+            new = np.zeros((2 * old.shape[0],) + old.shape[1:], dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+        self._make_views()
+
+    def start(self, obs):
+        self.length = 0
+        self._obs[0] = obs
+
+    def add(self, act, rew, obs, done):
+        t = self.length
+        if t == self._acts.shape[0]:
+            self._grow()
+
+        if isinstance(act, torch.Tensor):
+            act = act.detach().numpy()
+        self._acts[t] = act.reshape(-1)
+        self._rews[t, 0] = rew
+        self._obs[t + 1] = obs
+        self._dones[t, 0] = done
+        self.length = t + 1
+
+    @property
+    def cur_obs(self):
+        return self._obs_t[self.length]
+
+    @property
+    def obs1(self):
+        return self._obs_t[:self.length]
+
+    @property
+    def obs2(self):
+        return self._obs_t[1:self.length + 1]
+
+    @property
+    def acts(self):
+        return self._acts_t[:self.length]
+
+    @property
+    def rews(self):
+        return self._rews_t[:self.length]
+
+    @property
+    def dones(self):
+        return self._dones_t[:self.length]
+
+
+def run_episode(env, act_fn, buf, timeout=None):
+    """
+    Runs one episode of env, recording it into buf (an EpisodeBuffer), the rollout loop shared by the algorithms.
+
+    Args:
+        env: gym environment
+        act_fn: fn(obs) -> act tensor, obs is a view of the current observation in buf, don't modify it
+        buf: EpisodeBuffer to record into, whatever it held before is overwritten
+        timeout: steps from this index on are recorded with done = False, they end because of a time limit rather
+            than a terminal state
+
+    Returns:
+        buf
+    """
+    buf.start(env.reset())
+    done = False
+    while not done:
+        t = buf.length
+        act = act_fn(buf.cur_obs)
+        obs, rew, done, _ = env.step(act.detach().numpy().reshape(env.action_space.shape))
+        buf.add(act, rew, obs, done and (timeout is None or t < timeout))
+
+    return buf
+
+
+class MinibatchSampler:
+    """
+    Shuffled minibatches over the rows of a batch of tensors, for the sgd epochs of on policy algorithms like PPO.
+
+    Every call to epoch draws a fresh permutation of the rows and gathers each minibatch with a single index tensor
+    into buffers allocated once (a set per combination of tensor shapes it gets called with, so alternating between a
+    policy and a value update doesn't reallocate), so no new tensors are created per minibatch. The last minibatch
+    holds whatever rows are left over rather than being dropped. The minibatches handed out are views into those
+    buffers and are overwritten by the next one, which is fine for a loss that gets backpropagated right away.
+
+    Example:
+        sampler = MinibatchSampler(sgd_batch_size)
+        for epoch in range(sgd_epochs):
+            for local_obs, local_act, local_adv in sampler.epoch(batch_obs, batch_act, batch_adv):
+                ...
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._bufs = {}
 
-    fn_sd = fn.state_dict()
-    target_sd = target_fn.state_dict()
-    for layer in target_sd:
-        target_sd[layer] = polyak * target_sd[layer] + (1 - polyak) * fn_sd[layer]
+    def _get_bufs(self, tensors):
+        size = min(self.batch_size, tensors[0].shape[0])
+        key = tuple((t.shape[1:], t.dtype, t.device) for t in tensors)
+        bufs = self._bufs.get(key)
+        if bufs is None or bufs[0].shape[0] < size:
+            bufs = [torch.empty((size,) + t.shape[1:], dtype=t.dtype, device=t.device) for t in tensors]
+            self._bufs[key] = bufs
+        return bufs
 
-    target_fn.load_state_dict(target_sd)
+    def epoch(self, *tensors):
+        """
+        Yields one tuple of minibatches (one per tensor passed in) at a time until every row was used once
+        """
+        tensors = [t.detach() for t in tensors]
+        n = tensors[0].shape[0]
+        bufs = self._get_bufs(tensors)
 
-    return target_fn
\ No newline at end of file
+        perm = torch.randperm(n, device=tensors[0].device)
+        for start in range(0, n, self.batch_size):
+            idx = perm[start:start + self.batch_size]
+            yield tuple(torch.index_select(t, 0, idx, out=buf[:idx.shape[0]]) for t, buf in zip(tensors, bufs))
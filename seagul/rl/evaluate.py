@@ -0,0 +1,202 @@
+import gym
+import numpy as np
+import torch
+from torch.multiprocessing import Process, Queue
+
+
+def run_episodes(envs, policy, results, seed_idx, seed=0, dtype=None):
+    """
+    Runs one episode in each of envs side by side and writes them into row seed_idx of the evaluate result arrays.
+    The policy is called once per step on the stacked observations of the envs that haven't finished yet. Episodes
+    that finish early just drop out of the batch.
+
+    Env k is seeded with seed + seed_idx*len(envs) + k, and torch and numpy's global generator (which plenty of envs
+    draw their initial states from) with seed + seed_idx, before anything is run.
+    """
+    if dtype is None:
+        dtype = results["rews"].dtype
+
+    n_episodes = len(envs)
+    max_steps = results["rews"].shape[2]
+    keep_obs = "obs" in results
+
+    for k, env in enumerate(envs):
+        env.seed(seed + seed_idx * n_episodes + k)
+    torch.manual_seed(seed + seed_idx)
+    np.random.seed(seed + seed_idx)
+
+    obs = [env.reset() for env in envs]
+    active = list(range(n_episodes))
+    for t in range(max_steps):
+        if not active:
+            break
+
+        obs_tens = torch.as_tensor(np.stack([obs[k] for k in active]), dtype=dtype)
+        acts = torch.as_tensor(policy(obs_tens)).reshape(len(active), -1)
+        if keep_obs:
+            results["obs"][seed_idx, active, t] = obs_tens
+            results["acts"][seed_idx, active, t] = acts.to(dtype)
+
+        still_active = []
+        for k, act in zip(active, acts):
+            obs[k], rew, done, _ = envs[k].step(act.numpy())
+            results["rews"][seed_idx, k, t] = float(rew)
+            if done:
+                results["ep_lens"][seed_idx, k] = t + 1
+            else:
+                still_active.append(k)
+        active = still_active
+
+    for k in active:
+        results["ep_lens"][seed_idx, k] = max_steps
+
+
+def worker_fn(env_name, env_config, policy, results, seed, job_queue, done_queue):
+    torch.autograd.set_grad_enabled(False)
+    torch.set_num_threads(1)
+
+    n_episodes = results["rews"].shape[1]
+    envs = [gym.make(env_name, **env_config) for _ in range(n_episodes)]
+
+    while True:
+        seed_idx = job_queue.get()
+
+        if seed_idx == "STOP":
+            for env in envs:
+                env.close()
+            return
+
+        run_episodes(envs, policy, results, seed_idx, seed)
+        done_queue.put(seed_idx)
+
+
+def evaluate(env_name, policy, n_seeds=10, n_episodes=1, max_steps=None, env_config=None, n_workers=4, seed=0,
+             keep_obs=True):
+    """
+    Runs n_seeds x n_episodes episodes of a trained policy across worker processes.
+
+    Each worker takes one seed off a queue at a time and runs all n_episodes episodes for it side by side in its own
+    env copies (see run_episodes), so the policy sees a (n_episodes, obs_size) batch every step. Trajectories are
+    written straight into preallocated shared memory tensors rather than sent back through pipes. Seeding only depends
+    on the seed index and episode number, so the results don't depend on n_workers.
+
+    Args:
+        env_name: name of the gym environment
+        policy: fn(obs) -> acts working on a (batch, obs_size) tensor, e.g. a seagul.nn.MLP or model.policy
+        n_seeds: number of seeds to evaluate
+        n_episodes: episodes per seed
+        max_steps: episodes are cut off after this many steps, defaults to the envs max_episode_steps
+        env_config: kwargs passed to gym.make
+        n_workers: number of worker processes, 0 runs everything in this process
+        seed: base seed, seed index i uses env seeds seed + i*n_episodes + k, torch and numpy get seed + i
+        keep_obs: if False only rewards and episode lengths are kept
+
+    Returns:
+        dict with
+            obs: (n_seeds, n_episodes, max_steps, obs_size) tensor, zero past the end of each episode
+            acts: (n_seeds, n_episodes, max_steps, act_size) tensor, zero past the end of each episode
+            rews: (n_seeds, n_episodes, max_steps) tensor, zero past the end of each episode
+            ep_lens: (n_seeds, n_episodes) tensor
+            returns: (n_seeds, n_episodes) tensor, summed rewards
+            seed_means: (n_seeds,) tensor, mean return of each seed
+            mean_return, std_return, min_return, max_return, mean_ep_len: floats over every episode
+
+    Example:
+        from seagul.rl.evaluate import evaluate
+        results = evaluate("HalfCheetah-v2", policy, n_seeds=100, n_episodes=5, n_workers=8)
+        print(results["mean_return"], results["std_return"])
+    """
+    if env_config is None:
+        env_config = {}
+
+    env = gym.make(env_name, **env_config)
+    obs_size = env.observation_space.shape[0]
+    act_size = int(np.prod(env.action_space.shape)) if env.action_space.shape else 1
+    if max_steps is None:
+        max_steps = env.spec.max_episode_steps if env.spec is not None else None
+    env.close()
+
+    if max_steps is None:
+        raise ValueError(f"{env_name} doesn't have a max_episode_steps, pass max_steps")
+
+    params = list(policy.parameters()) if isinstance(policy, torch.nn.Module) else []
+    dtype = params[0].dtype if params else torch.get_default_dtype()
+
+    results = {
+        "rews": torch.zeros(n_seeds, n_episodes, max_steps, dtype=dtype),
+        "ep_lens": torch.zeros(n_seeds, n_episodes, dtype=torch.int64),
+    }
+    if keep_obs:
+        results["obs"] = torch.zeros(n_seeds, n_episodes, max_steps, obs_size, dtype=dtype)
+        results["acts"] = torch.zeros(n_seeds, n_episodes, max_steps, act_size, dtype=dtype)
+
+    grad_enabled = torch.is_grad_enabled()
+    torch.autograd.set_grad_enabled(False)
+
+    if n_workers == 0:
+        envs = [gym.make(env_name, **env_config) for _ in range(n_episodes)]
+        for seed_idx in range(n_seeds):
+            run_episodes(envs, policy, results, seed_idx, seed)
+        for env in envs:
+            env.close()
+    else:
+        for tensor in results.values():
+            tensor.share_memory_()
+
+        job_queue = Queue()
+        done_queue = Queue()
+        proc_list = []
+        for _ in range(min(n_workers, n_seeds)):
+            proc = Process(target=worker_fn, args=(env_name, env_config, policy, results, seed, job_queue, done_queue))
+            proc.start()
+            proc_list.append(proc)
+
+        for seed_idx in range(n_seeds):
+            job_queue.put(seed_idx)
+        for _ in range(n_seeds):
+            done_queue.get()
+
+        for _ in proc_list:
+            job_queue.put("STOP")
+        for proc in proc_list:
+            proc.join()
+
+    torch.autograd.set_grad_enabled(grad_enabled)
+
+    returns = results["rews"].sum(dim=2)
+    results["returns"] = returns
+    results["seed_means"] = returns.mean(dim=1)
+    results["mean_return"] = returns.mean().item()
+    results["std_return"] = returns.std().item() if returns.numel() > 1 else 0.0
+    results["min_return"] = returns.min().item()
+    results["max_return"] = returns.max().item()
+    results["mean_ep_len"] = results["ep_lens"].double().mean().item()
+
+    return results
+
+
+if __name__ == "__main__":
+    # Times evaluate against running the same episodes one at a time with a single env
+    import time
+    import seagul.envs
+    from seagul.nn import MLP
+
+    env_name, n_seeds, n_episodes, max_steps = "su_acrobot-v0", 16, 8, 500
+    env = gym.make(env_name)
+    policy = MLP(env.observation_space.shape[0], env.action_space.shape[0], 2, 32)
+
+    start = time.time()
+    with torch.no_grad():
+        for i in range(n_seeds * n_episodes):
+            env.seed(i)
+            obs, done, t = env.reset(), False, 0
+            while not done and t < max_steps:
+                obs, rew, done, _ = env.step(policy(torch.as_tensor(obs, dtype=torch.float32)).numpy())
+                t += 1
+    loop_time = time.time() - start
+
+    for n_workers in [0, 4]:
+        start = time.time()
+        results = evaluate(env_name, policy, n_seeds, n_episodes, max_steps, n_workers=n_workers)
+        print(f"n_workers={n_workers}: one at a time {loop_time:.2f}s, evaluate {time.time() - start:.2f}s, "
+              f"mean return {results['mean_return']:.2f}")
@@ -0,0 +1,160 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+
+class NoveltyIndex:
+    """
+    Nearest neighbour index over the last capacity observations seen, for visitation and novelty bonuses.
+
+    Points go into a FIFO ring buffer. Queries are answered by a cKDTree over the buffer plus a brute force pass over
+    whatever was inserted since the tree was built. The tree is rebuilt lazily on the next query once more than
+    rebuild_every points are pending, or once an insert evicted points the tree still holds. Every query takes a whole
+    batch (e.g. an episode) at once.
+
+    mode="exact" gives exact distances. mode="approx" is meant for high dimensional observations: points are first
+    mapped to proj_dim dimensions with a fixed random (Johnson-Lindenstrauss) projection, which roughly preserves
+    distances, and the tree search is allowed to return neighbours up to (1 + approx_eps) times further than the true
+    ones.
+
+    Args:
+        obs_dim: size of the observations
+        capacity: how many of the most recent points to keep
+        mode: "exact" or "approx"
+        proj_dim: dimension to project down to in approx mode, ignored if it isn't smaller than obs_dim
+        approx_eps: slack allowed in the tree search in approx mode
+        rebuild_every: how many pending points to brute force before rebuilding the tree
+        seed: seed for the random projection
+
+    Example:
+        novelty_index = NoveltyIndex(obs_size, int(5e4))
+        bonus = novelty_index.novelty(ep_obs, k=5)  # mean distance to the 5 nearest points already seen, (ep_len,)
+        novelty_index.insert(ep_obs)
+    """
+
+    def __init__(self, obs_dim, capacity=int(5e4), mode="exact", proj_dim=8, approx_eps=0.5, rebuild_every=1024,
+                 seed=0):
+        if mode not in ("exact", "approx"):
+            raise ValueError(f"mode must be 'exact' or 'approx', got {mode}")
+
+        self.obs_dim, self.capacity, self.mode = obs_dim, capacity, mode
+        self.rebuild_every = rebuild_every
+
+        if mode == "approx" and proj_dim < obs_dim:
+            rng = np.random.RandomState(seed)
+            self.proj = rng.randn(obs_dim, proj_dim) / np.sqrt(proj_dim)
+        else:
+            self.proj = None
+        self.eps = approx_eps if mode == "approx" else 0.0
+
+        key_dim = obs_dim if self.proj is None else proj_dim
+        self.keys = np.zeros((capacity, key_dim))
+        self.ptr, self.size = 0, 0
+
+        # the tree holds every point except the n_pending most recent ones, which sit just behind ptr
+        self.tree = None
+        self.n_pending = 0
+
+    def __len__(self):
+        return self.size
+
+    def _to_keys(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.obs_dim)
+        if self.proj is not None:
+            return points @ self.proj
+        return points
+
+    def _pending_keys(self):
+        return self.keys[(self.ptr - self.n_pending + np.arange(self.n_pending)) % self.capacity]
+
+    def _maybe_rebuild(self):
+        if self.tree is None or self.n_pending > self.rebuild_every:
+            self.tree = cKDTree(self.keys[:self.size])
+            self.n_pending = 0
+
+    def insert(self, points):
+        """
+        Adds a batch of points, evicting the oldest ones once the index is full
+        """
+        keys = self._to_keys(points)[-self.capacity:]
+        n = keys.shape[0]
+
+        if self.size + n > self.capacity:
+            # evicted points would still be found in the tree
+            self.tree = None
+
+        self.keys[(self.ptr + np.arange(n)) % self.capacity] = keys
+        self.ptr = (self.ptr + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.n_pending = self.size if self.tree is None else self.n_pending + n
+
+    def query(self, points, k=1):
+        """
+        Returns the distances from each point to its k nearest neighbours in the index, sorted, (n_points, k).
+        Missing neighbours (fewer than k points stored) come back as inf.
+        """
+        keys = self._to_keys(points)
+        if self.size == 0:
+            return np.full((keys.shape[0], k), np.inf)
+
+        self._maybe_rebuild()
+        dists, _ = self.tree.query(keys, k=k, eps=self.eps)
+        dists = dists.reshape(-1, k)
+
+        if self.n_pending > 0:
+            pending_dists = cdist(keys, self._pending_keys())
+            if pending_dists.shape[1] > k:
+                pending_dists = np.partition(pending_dists, k - 1, axis=1)[:, :k]
+            dists = np.sort(np.concatenate((dists, pending_dists), axis=1), axis=1)[:, :k]
+
+        return dists
+
+    def novelty(self, points, k=1):
+        """
+        Mean distance from each point to its k nearest neighbours, (n_points,). 0 for an empty index.
+        """
+        dists = self.query(points, k)
+        found = np.isfinite(dists)
+        return np.where(found, dists, 0).sum(axis=1) / np.maximum(found.sum(axis=1), 1)
+
+    def count(self, points, radius):
+        """
+        Number of stored points within radius of each point, (n_points,). Useful for count based bonuses like
+        1/sqrt(count + 1).
+        """
+        keys = self._to_keys(points)
+        if self.size == 0:
+            return np.zeros(keys.shape[0], dtype=np.int64)
+
+        self._maybe_rebuild()
+        counts = np.asarray(self.tree.query_ball_point(keys, radius, eps=self.eps, return_length=True), dtype=np.int64)
+        if self.n_pending > 0:
+            counts += (cdist(keys, self._pending_keys()) <= radius).sum(axis=1)
+
+        return counts
+
+
+if __name__ == "__main__":
+    # Benchmark against the old per observation scan over a whole replay buffer, 1000 step episodes
+    import time
+
+    obs_dim, capacity, ep_len, n_eps = 4, int(5e4), 1000, 100
+    eps = [np.random.randn(ep_len, obs_dim) for _ in range(n_eps)]
+
+    buf = np.zeros((capacity, obs_dim))
+    ptr = 0
+    start = time.time()
+    for ep_obs in eps[:10]:
+        loop_novelty = [np.min(np.linalg.norm(obs - buf, axis=1)) for obs in ep_obs]
+        buf[(ptr + np.arange(ep_len)) % capacity] = ep_obs
+        ptr = (ptr + ep_len) % capacity
+    loop_time = (time.time() - start) / 10
+
+    for mode in ["exact", "approx"]:
+        novelty_index = NoveltyIndex(obs_dim, capacity, mode=mode, proj_dim=2)
+        start = time.time()
+        for ep_obs in eps:
+            novelty_index.novelty(ep_obs)
+            novelty_index.insert(ep_obs)
+        index_time = (time.time() - start) / n_eps
+        print(f"{mode:>6} | per episode: loop scan {loop_time * 1e3:.1f}ms, NoveltyIndex {index_time * 1e3:.2f}ms")
@@ -2,8 +2,10 @@ import numpy as np
 import torch
 import tqdm.auto as tqdm
 import gym
-import copy
-from seagul.rl.common import update_mean, update_std, make_schedule, discount_cumsum
+from seagul.rl.common import update_mean, update_std, make_schedule, discount_cumsum, EpisodeBuffer, run_episode, \
+    MinibatchSampler
+from seagul.nn import MLP, RunningMeanStd
+from seagul.envs.classic_control.vec_env import make_vec_env
 
 
 class PPOAgent:
@@ -34,6 +36,8 @@ class PPOAgent:
                  normalize_return=True,
                  normalize_obs=True,
                  normalize_adv=True,
+                 num_envs=1,
+                 fused_update=False,
                  env_config=None):
 
         """
@@ -47,17 +51,23 @@ class PPOAgent:
                       seed: seed for all the rngs
                       sgd_batch_size: mini batch size for policy/value updates
                       lr_schedule: learning rate for policy policy / value optimizers
-                      sgd_epochs: how many epochs to use for each policy.value update
+                      sgd_epochs: how many epochs to use for each policy.value update, each epoch goes over the whole
+                          batch once in shuffled minibatches
                       val_coef: coefficient to multiply the value loss by
                       clip_val: True-> use a clipped value function update, False-> normal MSE update
                       clip_pol: True-> use the ppo clipped objective, False-> use the PG update
                       env_no_term_steps: maximum episode length if no early termination occurs
-                      target_kl: max KL divergence before breaking
+                      target_kl: max KL divergence before breaking, checked once at the end of each epoch
                       use_gpu:  want to use the GPU? set to true
                       reward_stop: reward value to stop training at if we achieve
                       normalize_return: should we normalize the return?
                       normalize_obs: normalize obs before sending to the model?
                       normalize_adv: normalize advantage after each batch?
+                      num_envs: how many copies of the environment to step at once, ignored if env_name is already a
+                          batched env (pass num_envs in env_config for those)
+                      fused_update: True-> step the policy and value fn together on each minibatch, one backward pass
+                          for both, the KL stop then ends the value fn epochs too. False-> separate policy and value
+                          epochs
                       env_config: dictionary containing kwargs to pass to the environment
            """
 
@@ -82,10 +92,11 @@ class PPOAgent:
         self.normalize_return = normalize_return
         self.normalize_obs = normalize_obs
         self.normalize_adv = normalize_adv
+        self.num_envs = num_envs
+        self.fused_update = fused_update
         if env_config is None:
             env_config = {}
         self.env_config = env_config
-        self.old_model = copy.deepcopy(self.model)
 
         torch.set_num_threads(1)
         env = gym.make(self.env_name, **self.env_config)
@@ -97,10 +108,14 @@ class PPOAgent:
 
 
         obs_size = env.observation_space.shape[0]
-        self.obs_mean = torch.zeros(obs_size)
-        self.obs_std = torch.ones(obs_size)
+        self.obs_rms = RunningMeanStd(obs_size)
         self.rew_mean = torch.zeros(1)
         self.rew_std = torch.ones(1)
+        if self.normalize_obs:
+            self.model.policy.obs_norm = self.obs_rms
+            self.model.value_fn.obs_norm = self.obs_rms
+        if isinstance(self.model.policy, MLP):
+            self.model.policy.compile_inference()
 
         # set defaults, and decide if we are using a GPU or not
         use_cuda = torch.cuda.is_available() and self.use_gpu
@@ -129,7 +144,7 @@ class PPOAgent:
         # init everything
         # ==============================================================================
         # seed all our RNGs
-        env = gym.make(self.env_name, **self.env_config)
+        env = make_vec_env(self.env_name, self.num_envs, self.env_config)
 
         cur_total_steps = 0
         env.seed(self.seed)
@@ -145,15 +160,29 @@ class PPOAgent:
         early_stop = False
         self.pol_opt = torch.optim.RMSprop(self.model.policy.parameters(), lr=lr_lookup(cur_total_steps))
         self.val_opt = torch.optim.RMSprop(self.model.value_fn.parameters(), lr=lr_lookup(cur_total_steps))
+        self.sampler = MinibatchSampler(self.sgd_batch_size)
+
+        # Every env takes n_steps per epoch, all the batch data lives in buffers we allocate once here
+        n_envs = env.num_envs
+        n_steps = int(np.ceil(self.epoch_batch_size / n_envs))
+        obs_size = env.observation_space.shape[0]
+
+        buf_obs = torch.zeros(n_steps, n_envs, obs_size)
+        buf_act = torch.zeros(n_steps, n_envs, self.act_size)
+        buf_rew = torch.zeros(n_steps, n_envs)
+        buf_boot = torch.zeros(n_steps, n_envs)
+        buf_done = torch.zeros(n_steps, n_envs)
+        buf_val = torch.zeros(n_steps + 1, n_envs)
+        buf_adv = torch.zeros(n_steps, n_envs)
+        buf_discrew = torch.zeros(n_steps, n_envs)
+
+        obs = env.reset()
+        ep_lens = np.zeros(n_envs, dtype=np.int64)
+        ep_rets = np.zeros(n_envs)
 
         # Train until we hit our total steps or reach our reward threshold
         # ==============================================================================
         while cur_total_steps < total_steps:
-            batch_obs = torch.empty(0)
-            batch_act = torch.empty(0)
-            batch_adv = torch.empty(0)
-            batch_discrew = torch.empty(0)
-            cur_batch_steps = 0
 
             # Bail out if we have met out reward threshold
             if len(self.raw_rew_hist) > 2 and self.reward_stop:
@@ -161,40 +190,59 @@ class PPOAgent:
                     early_stop = True
                     break
 
-            # construct batch data from rollouts
+            # construct batch data from rollouts, the policy and value fn are evaluated on every env at once
             # ==============================================================================
-            while cur_batch_steps < self.epoch_batch_size:
-                ep_obs, ep_act, ep_rew, ep_steps, ep_term = do_rollout(env, self.model, self.env_no_term_steps)
+            with torch.no_grad():
+                buf_boot.zero_()
+                for t in range(n_steps):
+                    obs_tens = torch.as_tensor(obs, dtype=torch.float32)
+                    buf_obs[t] = obs_tens
+                    buf_val[t] = self.model.value_fn(obs_tens).reshape(-1)
 
-                cur_batch_steps += ep_steps
-                cur_total_steps += ep_steps
+                    act, _ = self.model.select_action(obs_tens)
+                    obs, rew, done, info = env.step(act.numpy())
 
-                #print(sum(ep_rew).item())
-                self.raw_rew_hist.append(sum(ep_rew).item())
-                batch_obs = torch.cat((batch_obs, ep_obs.clone()))
-                batch_act = torch.cat((batch_act, ep_act.clone()))
+                    buf_act[t] = act
+                    buf_rew[t] = torch.as_tensor(rew)
+                    buf_done[t] = torch.as_tensor(done)
 
-                if self.normalize_return:
-                    self.rew_mean = update_mean(ep_rew, self.rew_mean, cur_total_steps)
-                    self.rew_std = update_std(ep_rew, self.rew_std, cur_total_steps)
-                    ep_rew = ep_rew / (self.rew_std + 1e-6)
+                    ep_lens += 1
+                    ep_rets += rew
+                    if done.any():
+                        for i in np.nonzero(done)[0]:
+                            self.raw_rew_hist.append(float(ep_rets[i]))
 
-                if ep_term:
-                    ep_rew = torch.cat((ep_rew, torch.zeros(1, 1)))
-                else:
-                    ep_rew = torch.cat((ep_rew, self.model.value_fn(ep_obs[-1]).detach().reshape(1, 1).clone()))
+                        # episodes cut off by a time limit (rather than failing) get bootstrapped from the value fn
+                        trunc = done & (ep_lens >= self.env_no_term_steps)
+                        if trunc.any():
+                            term_obs = torch.as_tensor(info["terminal_obs"][trunc], dtype=torch.float32)
+                            buf_boot[t, torch.as_tensor(trunc)] = self.model.value_fn(term_obs).reshape(-1)
 
-                ep_discrew = discount_cumsum(ep_rew, self.gamma)[:-1]
-                batch_discrew = torch.cat((batch_discrew, ep_discrew.clone()))
+                        ep_lens[done] = 0
+                        ep_rets[done] = 0
 
-                with torch.no_grad():
-                    ep_val = torch.cat((self.model.value_fn(ep_obs), ep_rew[-1].reshape(1, 1).clone()))
-                    deltas = ep_rew[:-1] + self.gamma * ep_val[1:] - ep_val[:-1]
+                buf_val[n_steps] = self.model.value_fn(torch.as_tensor(obs, dtype=torch.float32)).reshape(-1)
 
-                ep_adv = discount_cumsum(deltas, self.gamma * self.lam)
-                # make sure our advantages are zero mean and unit variance
+                cur_batch_steps = n_steps * n_envs
+                cur_total_steps += cur_batch_steps
 
-                batch_adv = torch.cat((batch_adv, ep_adv.clone()))
+                if self.normalize_return:
+                    self.rew_mean = update_mean(buf_rew.reshape(-1, 1), self.rew_mean, cur_total_steps)
+                    self.rew_std = update_std(buf_rew.reshape(-1, 1), self.rew_std, cur_total_steps)
+                    buf_rew /= (self.rew_std + 1e-6)
+
+                self.compute_targets(buf_rew, buf_boot, buf_done, buf_val, buf_discrew, buf_adv)
+
+            batch_obs = buf_obs.reshape(-1, obs_size)
+            batch_act = buf_act.reshape(-1, self.act_size)
+            batch_adv = buf_adv.reshape(-1, 1)
+            batch_discrew = buf_discrew.reshape(-1, 1)
+
+            # The policy and value fn as they were when the batch was collected, which the clipped updates compare
+            # against. buf_val already holds the values, the log probs only need one pass over the whole batch
+            batch_val = buf_val[:-1].reshape(-1, 1)
+            with torch.no_grad():
+                batch_logp = self.model.get_logp(batch_obs, batch_act).reshape(-1, self.act_size).sum(axis=1)
 
             # PostProcess epoch and update weights
             # ==============================================================================
@@ -203,29 +251,31 @@ class PPOAgent:
                 # adv_var = update_std(batch_adv, adv_var, cur_total_steps)
                 batch_adv = (batch_adv - batch_adv.mean()) / (batch_adv.std() + 1e-6)
 
-            # Update the policy using the PPO loss
-            for pol_epoch in range(self.sgd_epochs):
-                pol_loss, approx_kl = self.policy_update(batch_act, batch_obs, batch_adv)
-                if approx_kl > self.target_kl:
-                    print("KL Stop")
-                    break
+            if self.fused_update:
+                for sgd_epoch in range(self.sgd_epochs):
+                    pol_loss, val_loss, approx_kl = self.joint_update(batch_act, batch_obs, batch_adv, batch_logp,
+                                                                      batch_discrew, batch_val)
+                    if approx_kl > self.target_kl:
+                        print("KL Stop")
+                        break
+            else:
+                # Update the policy using the PPO loss
+                for pol_epoch in range(self.sgd_epochs):
+                    pol_loss, approx_kl = self.policy_update(batch_act, batch_obs, batch_adv, batch_logp)
+                    if approx_kl > self.target_kl:
+                        print("KL Stop")
+                        break
 
-            for val_epoch in range(self.sgd_epochs):
-                val_loss = self.value_update(batch_obs, batch_discrew)
+                for val_epoch in range(self.sgd_epochs):
+                    val_loss = self.value_update(batch_obs, batch_discrew, batch_val)
 
             # update observation mean and variance
 
             if self.normalize_obs:
-                self.obs_mean = update_mean(batch_obs, self.obs_mean, cur_total_steps)
-                self.obs_std = update_std(batch_obs, self.obs_std, cur_total_steps)
-                self.model.policy.state_means = self.obs_mean
-                self.model.value_fn.state_means = self.obs_mean
-                self.model.policy.state_std = self.obs_std
-                self.model.value_fn.state_std = self.obs_std
+                self.obs_rms.update(batch_obs)
 
             sgd_lr = lr_lookup(cur_total_steps)
 
-            self.old_model = copy.deepcopy(self.model)
             self.val_loss_hist.append(val_loss)
             self.pol_loss_hist.append(pol_loss)
             self.lrp_hist.append(self.pol_opt.state_dict()['param_groups'][0]['lr'])
@@ -236,106 +286,122 @@ class PPOAgent:
         progress_bar.close()
         return self.model, self.raw_rew_hist, locals()
 
-    # Takes list or array and returns a lambda that interpolates it for each epoch
-    def policy_update(self, batch_act, batch_obs, batch_adv):
-        num_mbatch = int(batch_obs.shape[0] / self.sgd_batch_size)
-        for i in range(num_mbatch):
-            # policy update
-            # ========================================================================
-            cur_sample = i * self.sgd_batch_size
+    def compute_targets(self, rew, boot, done, val, discrew_out, adv_out):
+        """
+        Discounted returns and GAE advantages for (n_steps, n_envs) batch data, written into discrew_out and adv_out.
+        boot holds value estimates for episodes that were cut off by a time limit, val has one extra row with the
+        value of the obs each env ended the batch on.
+        """
+        r = rew + self.gamma * boot
+        discrew_out[:] = discount_cumsum(r, self.gamma, done, last_value=val[-1])
 
-            # Transfer to GPU (if GPU is enabled, else this does nothing)
-            local_obs = batch_obs[cur_sample:cur_sample + self.sgd_batch_size]
-            local_act = batch_act[cur_sample:cur_sample + self.sgd_batch_size]
-            local_adv = batch_adv[cur_sample:cur_sample + self.sgd_batch_size]
+        deltas = r + self.gamma * (1 - done) * val[1:] - val[:-1]
+        adv_out[:] = discount_cumsum(deltas, self.gamma * self.lam, done)
 
-            logp = self.model.get_logp(local_obs, local_act).reshape(-1, self.act_size).sum(axis=1)
-            mean_entropy = -(logp * torch.exp(logp)).mean()
+    def policy_loss(self, local_obs, local_act, local_adv, old_logp):
+        """
+        PPO policy loss for one minibatch, returns (loss, approximate KL from the policy the batch was collected with)
+        """
+        logp = self.model.get_logp(local_obs, local_act).reshape(-1, self.act_size).sum(axis=1)
+        mean_entropy = -(logp * torch.exp(logp)).mean()
 
-            if self.clip_pol:
-                with torch.no_grad():
-                    old_logp = self.old_model.get_logp(local_obs, local_act).reshape(-1, self.act_size).sum(axis=1)
+        if self.clip_pol:
+            approx_kl = ((logp - old_logp) ** 2).mean().detach()
+            r = torch.exp(logp - old_logp).reshape(-1, 1)
+            clip_r = torch.clamp(r, 1 - self.eps, 1 + self.eps).reshape(-1, 1)
 
-                approx_kl = ((logp - old_logp) ** 2).mean()
-                r = torch.exp(logp - old_logp).reshape(-1, 1)
-                clip_r = torch.clamp(r, 1 - self.eps, 1 + self.eps).reshape(-1, 1)
+            pol_loss = -(torch.min(r * local_adv, clip_r * local_adv)).mean() - self.entropy_coef * mean_entropy
+        else:
+            pol_loss = -(logp * local_adv).mean() - self.entropy_coef * mean_entropy
+            approx_kl = torch.zeros(())
 
-                pol_loss = -(torch.min(r * local_adv, clip_r * local_adv)).mean() - self.entropy_coef * mean_entropy
+        return pol_loss, approx_kl
 
-            else:
-                pol_loss = -(logp*local_adv).mean() - self.entropy_coef*mean_entropy
-                approx_kl = 0
+    def value_loss(self, local_obs, local_val, old_val_preds):
+        val_preds = self.model.value_fn(local_obs)
+
+        if self.clip_val:
+            val_preds_clipped = old_val_preds + torch.clamp(val_preds - old_val_preds, -self.eps, self.eps)
+            val_loss1 = (val_preds_clipped - local_val) ** 2
+            val_loss2 = (val_preds - local_val) ** 2
+            return self.val_coef * torch.max(val_loss1, val_loss2).mean()
+        else:
+            return self.val_coef * ((val_preds - local_val) ** 2).mean()
+
+    def policy_update(self, batch_act, batch_obs, batch_adv, batch_logp):
+        """
+        One epoch of policy updates, returns the mean loss and the mean approximate KL over the epoch
+        """
+        pol_loss_sum, kl_sum = 0, 0
+        for local_obs, local_act, local_adv, old_logp in self.sampler.epoch(batch_obs, batch_act, batch_adv,
+                                                                            batch_logp):
+            pol_loss, approx_kl = self.policy_loss(local_obs, local_act, local_adv, old_logp)
 
             self.pol_opt.zero_grad()
             pol_loss.backward()
             self.pol_opt.step()
 
-        return pol_loss, approx_kl
+            pol_loss_sum += pol_loss.detach() * local_obs.shape[0]
+            kl_sum += approx_kl * local_obs.shape[0]
 
-    def value_update(self, batch_obs, batch_discrew):
-        num_mbatch = int(batch_obs.shape[0] / self.sgd_batch_size)
-        for i in range(num_mbatch):
-            # value_fn update
-            # ========================================================================
-            cur_sample = i * self.sgd_batch_size
-            local_obs = batch_obs[cur_sample:cur_sample + self.sgd_batch_size]
-            local_val = batch_discrew[cur_sample:cur_sample + self.sgd_batch_size]
-            val_preds = self.model.value_fn(local_obs)
-
-            if self.clip_val:
-                with torch.no_grad():
-                    old_val_preds = self.old_model.value_fn(local_obs)
-
-                val_preds_clipped = old_val_preds + torch.clamp(val_preds - old_val_preds, -self.eps, self.eps)
-                val_loss1 = (val_preds_clipped - local_val) ** 2
-                val_loss2 = (val_preds - local_val) ** 2
-                val_loss = self.val_coef * torch.max(val_loss1, val_loss2).mean()
-            else:
-                val_loss = self.val_coef * ((val_preds - local_val) ** 2).mean()
+        return pol_loss_sum / batch_obs.shape[0], (kl_sum / batch_obs.shape[0]).item()
+
+    def value_update(self, batch_obs, batch_discrew, batch_val):
+        """
+        One epoch of value fn updates, returns the mean loss over the epoch
+        """
+        val_loss_sum = 0
+        for local_obs, local_val, old_val_preds in self.sampler.epoch(batch_obs, batch_discrew, batch_val):
+            val_loss = self.value_loss(local_obs, local_val, old_val_preds)
 
             self.val_opt.zero_grad()
             val_loss.backward()
             self.val_opt.step()
 
-            return val_loss
-
-
-def do_rollout(env, model, n_steps_complete):
-    torch.autograd.set_grad_enabled(False)
-
-    act_list = []
-    obs_list = []
-    rew_list = []
+            val_loss_sum += val_loss.detach() * local_obs.shape[0]
 
-    dtype = torch.float32
-    obs = env.reset()
-    done = False
-    cur_step = 0
+        return val_loss_sum / batch_obs.shape[0]
 
-    while not done:
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-        obs_list.append(obs.clone())
+    def joint_update(self, batch_act, batch_obs, batch_adv, batch_logp, batch_discrew, batch_val):
+        """
+        One epoch of joint policy and value fn updates, each minibatch gets one backward pass through the summed
+        losses and then both optimizers step. Returns the mean policy loss, value loss and approximate KL
+        """
+        pol_loss_sum, val_loss_sum, kl_sum = 0, 0, 0
+        for local_obs, local_act, local_adv, old_logp, local_val, old_val_preds in self.sampler.epoch(
+                batch_obs, batch_act, batch_adv, batch_logp, batch_discrew, batch_val):
+            pol_loss, approx_kl = self.policy_loss(local_obs, local_act, local_adv, old_logp)
+            val_loss = self.value_loss(local_obs, local_val, old_val_preds)
 
-        act, logprob = model.select_action(obs)
-        obs, rew, done, _ = env.step(act.numpy())
+            self.pol_opt.zero_grad()
+            self.val_opt.zero_grad()
+            (pol_loss + val_loss).backward()
+            self.pol_opt.step()
+            self.val_opt.step()
 
-        act_list.append(torch.as_tensor(act.clone()))
-        rew_list.append(rew)
+            pol_loss_sum += pol_loss.detach() * local_obs.shape[0]
+            val_loss_sum += val_loss.detach() * local_obs.shape[0]
+            kl_sum += approx_kl * local_obs.shape[0]
 
-        cur_step += 1
+        n = batch_obs.shape[0]
+        return pol_loss_sum / n, val_loss_sum / n, (kl_sum / n).item()
 
-    if cur_step < n_steps_complete:
-        ep_term = True
-    else:
-        ep_term = False
 
-    ep_length = len(rew_list)
-    ep_obs = torch.stack(obs_list)
-    ep_act = torch.stack(act_list)
-    ep_rew = torch.tensor(rew_list, dtype=dtype)
-    ep_rew = ep_rew.reshape(-1, 1)
+def do_rollout(env, model, n_steps_complete, buf=None):
+    """
+    Runs one episode with model, returns (obs, act, rew) views into buf (see EpisodeBuffer), which are only valid
+    until the next rollout into the same buffer, plus the episode length and whether it ended before n_steps_complete
+    """
+    if buf is None:
+        act_size = env.action_space.shape[0] if env.action_space.shape else 1
+        buf = EpisodeBuffer(env.observation_space.shape[0], act_size, n_steps_complete)
 
+    torch.autograd.set_grad_enabled(False)
+    run_episode(env, lambda obs: model.select_action(obs)[0], buf)
     torch.autograd.set_grad_enabled(True)
-    return ep_obs, ep_act, ep_rew, ep_length, ep_term
+
+    ep_length = len(buf)
+    ep_term = ep_length < n_steps_complete
+    return buf.obs1, buf.acts, buf.rews, ep_length, ep_term
 
 
@@ -2,8 +2,8 @@ import numpy as np
 import torch
 import tqdm.auto as tqdm
 import gym
-import pickle
-from seagul.rl.common import update_mean, update_std, make_schedule
+from seagul.rl.common import update_mean, update_std, make_schedule, discount_cumsum, MinibatchSampler
+from seagul.mesh import variation_dim
 
 
 def ppo_dim(
@@ -50,7 +50,7 @@ def ppo_dim(
         lr_schedule: learning rate for policy pol_optimizer
         sgd_epochs: how many epochs to use for each policy update
         val_epochs: how many epochs to use for each value update
-        target_kl: max KL before breaking
+        target_kl: max KL before breaking, checked at the end of each epoch
         use_gpu:  want to use the GPU? set to true
         reward_stop: reward value to stop if we achieve
         normalize_return: should we normalize the return?
@@ -103,9 +103,6 @@ def ppo_dim(
     rew_mean = torch.zeros(1)
     rew_std = torch.ones(1)
 
-    # copy.deepcopy broke for me with older version of torch. Using pickle for this is weird but works fine
-    old_model = pickle.loads(pickle.dumps(model))
-
     # seed all our RNGs
     env.seed(seed)
     torch.manual_seed(seed)
@@ -119,6 +116,7 @@ def ppo_dim(
     raw_rew_hist = []
     val_loss_hist = []
     pol_loss_hist = []
+    sampler = MinibatchSampler(sgd_batch_size)
     progress_bar = tqdm.tqdm(total=total_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -146,7 +144,7 @@ def ppo_dim(
         # ==============================================================================
         while cur_batch_steps < epoch_batch_size:
             ep_obs, ep_act, ep_rew, ep_steps, ep_term = do_rollout(env, model, env_no_term_steps)
-            ep_rew /= var_dim(ep_obs[transient_length:],order=1)
+            ep_rew /= variation_dim(ep_obs[transient_length:],order=1)
 
 
             raw_rew_hist.append(sum(ep_rew).item())
@@ -180,44 +178,31 @@ def ppo_dim(
             #adv_var = update_std(batch_adv, adv_var, cur_total_steps)
             batch_adv = (batch_adv - batch_adv.mean()) / (batch_adv.std() + 1e-6)
 
-
-        num_mbatch = int(batch_obs.shape[0] / sgd_batch_size)
-        # Update the policy using the PPO loss
-        for pol_epoch in range(sgd_epochs):
-            for i in range(num_mbatch):
-                # policy update
+        # log probs and values of the policy and value fn the batch was collected with, for the clipped updates
+        with torch.no_grad():
+            batch_logp = model.get_logp(batch_obs, batch_act).reshape(-1, act_size)
+            batch_val = model.value_fn(batch_obs)
+
+        # Update the policy and value fn together using the PPO loss, one backward pass per minibatch
+        for sgd_epoch in range(sgd_epochs):
+            kl_sum = 0
+            for local_obs, local_act, local_adv, local_val, old_logp, old_val_preds in sampler.epoch(
+                    batch_obs, batch_act, batch_adv, batch_discrew, batch_logp, batch_val):
+                # policy loss
                 # ========================================================================
-                cur_sample = i * sgd_batch_size
-
-                # Transfer to GPU (if GPU is enabled, else this does nothing)
-                local_obs = batch_obs[cur_sample:cur_sample + sgd_batch_size]
-                local_act = batch_act[cur_sample:cur_sample + sgd_batch_size]
-                local_adv = batch_adv[cur_sample:cur_sample + sgd_batch_size]
-                local_val = batch_discrew[cur_sample:cur_sample + sgd_batch_size]
-
-                # Compute the loss
                 logp = model.get_logp(local_obs, local_act).reshape(-1, act_size)
-                old_logp = old_model.get_logp(local_obs, local_act).reshape(-1, act_size)
                 mean_entropy = -(logp*torch.exp(logp)).mean()
 
                 r = torch.exp(logp - old_logp)
                 clip_r = torch.clamp(r, 1 - eps, 1 + eps)
 
                 pol_loss = -torch.min(r * local_adv, clip_r * local_adv).mean() - entropy_coef*mean_entropy
+                kl_sum += ((logp - old_logp)**2).mean().detach() * local_obs.shape[0]
 
-                approx_kl = ((logp - old_logp)**2).mean()
-                if approx_kl > target_kl:
-                    break
-
-                pol_opt.zero_grad()
-                pol_loss.backward()
-                pol_opt.step()
-
-                # value_fn update
+                # value_fn loss
                 # ========================================================================
                 val_preds = model.value_fn(local_obs)
                 if clip_val:
-                    old_val_preds = old_model.value_fn(local_obs)
                     val_preds_clipped = old_val_preds + torch.clamp(val_preds - old_val_preds, -eps, eps)
                     val_loss1 = (val_preds_clipped - local_val)**2
                     val_loss2 = (val_preds - local_val)**2
@@ -225,10 +210,16 @@ def ppo_dim(
                 else:
                     val_loss = val_coef*((val_preds - local_val) ** 2).mean()
 
+                pol_opt.zero_grad()
                 val_opt.zero_grad()
-                val_loss.backward()
+                (pol_loss + val_loss).backward()
+                pol_opt.step()
                 val_opt.step()
 
+            approx_kl = (kl_sum / batch_obs.shape[0]).item()
+            if approx_kl > target_kl:
+                break
+
         # update observation mean and variance
 
         if normalize_obs:
@@ -242,7 +233,6 @@ def ppo_dim(
         model.action_std = actstd_lookup(cur_total_steps)
         sgd_lr = lr_lookup(cur_total_steps)
 
-        old_model = pickle.loads(pickle.dumps(model))
         val_loss_hist.append(val_loss)
         pol_loss_hist.append(pol_loss)
 
@@ -292,40 +282,3 @@ def do_rollout(env, model, n_steps_complete):
 
     torch.autograd.set_grad_enabled(True)
     return ep_obs, ep_act, ep_rew, ep_length, ep_term
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
-
-
-def variogram(data, l, ord):
-    """Method of moments variogram estimator: eq (16) from https://arxiv.org/pdf/1101.1444.pdf
-    Args:
-        data: np.array, data you want to estimate the variogram of
-        l: int, lag
-        ord: int, order of the estimator
-    Returns:
-        float, the variogram at point l
-
-    """
-    return 1 / (2 * len(data) - l) * np.sum(np.linalg.norm(data[l:] - data[:-l],ord=ord))
-
-
-def var_dim(data, order):
-    """Variation fractal dimension estimator: eq (18) from https://arxiv.org/pdf/1101.1444.pdf
-        Args:
-            data: np.array, data you want to estimate the dimension of
-            ord: int, order of the estimator
-        Returns:
-            float, the dimension estimate
-        """
-    return 2 - 1/(order*np.log(2))*(np.log(variogram(data, 2, order)) - np.log(variogram(data, 1, order)))
-
-
-
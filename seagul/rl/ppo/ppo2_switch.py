@@ -1,11 +1,9 @@
 import numpy as np
 import torch
-from torch.utils import data
 import tqdm.auto as tqdm
 import gym
-import pickle
 
-from seagul.rl.common import update_mean, update_std
+from seagul.rl.common import update_mean, update_std, discount_cumsum, MinibatchSampler
 
 
 def ppo_switch(
@@ -50,7 +48,7 @@ def ppo_switch(
         val_lr: learning rate of value function pol_optimizer
         pol_epochs: how many epochs to use for each policy update
         val_epochs: how many epochs to use for each value update
-        target_kl: max KL before breaking
+        target_kl: max KL before breaking, checked at the end of each epoch
         goal_state: final state that we are aiming for
         goal_thresh: how close to the goal do we want to be to consider an episode a success
         use_gpu:  want to use the GPU? set to true
@@ -103,9 +101,6 @@ def ppo_switch(
     rew_mean = torch.zeros(1)
     rew_var = torch.ones(1)
 
-    old_model = pickle.loads(
-        pickle.dumps(model)
-    )  # copy.deepcopy broke for me with older version of torch. Using pickle for this is weird but works fine
     pol_opt = torch.optim.Adam(model.policy.parameters(), lr=pol_lr)
     val_opt = torch.optim.Adam(model.value_fn.parameters(), lr=val_lr)
 
@@ -122,6 +117,8 @@ def ppo_switch(
     raw_rew_hist = []
     val_loss_hist = []
     pol_loss_hist = []
+    pol_sampler = MinibatchSampler(pol_batch_size)
+    val_sampler = MinibatchSampler(val_batch_size)
     progress_bar = tqdm.tqdm(total=total_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -201,46 +198,46 @@ def ppo_switch(
         adv_var = update_std(batch_adv, adv_var, cur_total_steps)
         batch_adv = (batch_adv - adv_mean) / (adv_var + 1e-6)
 
+        # log probs of the policy the batch was collected with, for the clipped update
+        with torch.no_grad():
+            batch_logp = model.get_logp(batch_obs, batch_act).reshape(-1, act_size)
+
         # policy update
         # ========================================================================
-        training_data = data.TensorDataset(batch_obs, batch_act, batch_adv)
-        training_generator = data.DataLoader(training_data, batch_size=pol_batch_size, shuffle=True, num_workers=0,
-                                             pin_memory=False)
-
         # Update the policy using the PPO loss
         for pol_epoch in range(pol_epochs):
-            for local_obs, local_act, local_adv in training_generator:
+            kl_sum = 0
+            for local_obs, local_act, local_adv, old_logp in pol_sampler.epoch(batch_obs, batch_act, batch_adv,
+                                                                               batch_logp):
                 # Transfer to GPU (if GPU is enabled, else this does nothing)
-                local_obs, local_act, local_adv = (
+                local_obs, local_act, local_adv, old_logp = (
                     local_obs.to(device),
                     local_act.to(device),
                     local_adv.to(device),
+                    old_logp.to(device),
                 )
 
                 # Compute the loss
                 logp = model.get_logp(local_obs, local_act).reshape(-1, act_size)
-                old_logp = old_model.get_logp(local_obs, local_act).reshape(-1, act_size)
                 r = torch.exp(logp - old_logp)
                 clip_r = torch.clamp(r, 1 - eps, 1 + eps)
                 pol_loss = -torch.min(r * local_adv, clip_r * local_adv).mean()
 
-                approx_kl = (logp - old_logp).mean()
-                if approx_kl > target_kl:
-                    break
+                kl_sum += (logp - old_logp).mean().detach() * local_obs.shape[0]
 
                 pol_opt.zero_grad()
                 pol_loss.backward()
                 pol_opt.step()
 
+            approx_kl = (kl_sum / batch_obs.shape[0]).item()
+            if approx_kl > target_kl:
+                break
+
         # value_fn update
         # ========================================================================
-        training_data = data.TensorDataset(batch_obs, batch_discrew)
-        training_generator = data.DataLoader(training_data, batch_size=val_batch_size, shuffle=True, num_workers=0,
-                                             pin_memory=False)
-
         # Update value function with the standard L2 Loss
         for val_epoch in range(val_epochs):
-            for local_obs, local_val in training_generator:
+            for local_obs, local_val in val_sampler.epoch(batch_obs, batch_discrew):
                 # Transfer to GPU (if GPU is enabled, else this does nothing)
                 local_obs, local_val = (local_obs.to(device), local_val.to(device))
 
@@ -261,7 +258,6 @@ def ppo_switch(
         model.policy.state_std = obs_var
         model.value_fn.state_std = obs_var
         model.action_var = actvar_lookup(cur_total_steps)
-        old_model = pickle.loads(pickle.dumps(model))
 
         val_loss_hist.append(val_loss)
         pol_loss_hist.append(pol_loss)
@@ -355,14 +351,3 @@ def do_rollout(env, model):
     ep_path = torch.tensor(path_list).reshape(-1, 1)
 
     return ep_obs, ep_act, ep_rew, ep_length, ep_path
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
-
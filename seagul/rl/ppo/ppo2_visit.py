@@ -2,9 +2,8 @@ import numpy as np
 import torch
 import tqdm.auto as tqdm
 import gym
-import pickle
-from seagul.rl.common import update_mean, update_std, make_schedule
-from seagul.rl.common import ReplayBuffer
+from seagul.rl.common import update_mean, update_std, make_schedule, discount_cumsum, MinibatchSampler
+from seagul.rl.novelty import NoveltyIndex
 
 
 def ppo_visit(
@@ -41,6 +40,8 @@ def ppo_visit(
         env_name: name of the openAI gym environment to solve
         total_steps: number of timesteps to run the PPO for
         model: model from seagul.rl.models. Contains policy and value fn
+        vc: weight on the distance to the nearest previously visited state, which is subtracted from the reward
+        replay_buf_size: how many of the most recently visited states to keep
         act_std_schedule: schedule to set the variance of the policy. Will linearly interpolate values
         epoch_batch_size: number of environment steps to take per batch, total steps will be num_epochs*epoch_batch_size
         seed: seed for all the rngs
@@ -52,7 +53,7 @@ def ppo_visit(
         lr_schedule: learning rate for policy pol_optimizer
         sgd_epochs: how many epochs to use for each policy update
         val_epochs: how many epochs to use for each value update
-        target_kl: max KL before breaking
+        target_kl: max KL before breaking, checked at the end of each epoch
         use_gpu:  want to use the GPU? set to true
         reward_stop: reward value to stop if we achieve
         normalize_return: should we normalize the return?
@@ -94,7 +95,7 @@ def ppo_visit(
         raise NotImplementedError("trying to use unsupported action space", env.action_space)
 
 
-    replay_buf = ReplayBuffer(env.observation_space.shape[0], act_size, replay_buf_size)
+    novelty_index = NoveltyIndex(env.observation_space.shape[0], replay_buf_size)
 
     actstd_lookup = make_schedule(act_std_schedule, total_steps)
     lr_lookup = make_schedule(lr_schedule, total_steps)
@@ -108,9 +109,6 @@ def ppo_visit(
     rew_mean = torch.zeros(1)
     rew_std = torch.ones(1)
 
-    # copy.deepcopy broke for me with older version of torch. Using pickle for this is weird but works fine
-    old_model = pickle.loads(pickle.dumps(model))
-
     # seed all our RNGs
     env.seed(seed)
     torch.manual_seed(seed)
@@ -124,6 +122,7 @@ def ppo_visit(
     raw_rew_hist = []
     val_loss_hist = []
     pol_loss_hist = []
+    sampler = MinibatchSampler(sgd_batch_size)
     progress_bar = tqdm.tqdm(total=total_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -155,10 +154,9 @@ def ppo_visit(
             raw_rew_hist.append(sum(ep_rew).item())
 
 
-            for i, obs in enumerate(ep_obs):
-                ep_rew[i] -= (np.min(np.linalg.norm(obs - replay_buf.obs1_buf, axis=1)))*vc
-
-            replay_buf.store(ep_obs, ep_obs, ep_act, ep_rew, ep_rew)
+            # penalize distance to the nearest state seen in earlier episodes
+            ep_rew -= torch.as_tensor(novelty_index.novelty(ep_obs), dtype=ep_rew.dtype).reshape(-1, 1)*vc
+            novelty_index.insert(ep_obs)
 
             batch_obs = torch.cat((batch_obs, ep_obs[:-1]))
             batch_act = torch.cat((batch_act, ep_act[:-1]))
@@ -190,44 +188,31 @@ def ppo_visit(
             #adv_var = update_std(batch_adv, adv_var, cur_total_steps)
             batch_adv = (batch_adv - batch_adv.mean()) / (batch_adv.std() + 1e-6)
 
-
-        num_mbatch = int(batch_obs.shape[0] / sgd_batch_size)
-        # Update the policy using the PPO loss
-        for pol_epoch in range(sgd_epochs):
-            for i in range(num_mbatch):
-                # policy update
+        # log probs and values of the policy and value fn the batch was collected with, for the clipped updates
+        with torch.no_grad():
+            batch_logp = model.get_logp(batch_obs, batch_act).reshape(-1, act_size)
+            batch_val = model.value_fn(batch_obs)
+
+        # Update the policy and value fn together using the PPO loss, one backward pass per minibatch
+        for sgd_epoch in range(sgd_epochs):
+            kl_sum = 0
+            for local_obs, local_act, local_adv, local_val, old_logp, old_val_preds in sampler.epoch(
+                    batch_obs, batch_act, batch_adv, batch_discrew, batch_logp, batch_val):
+                # policy loss
                 # ========================================================================
-                cur_sample = i * sgd_batch_size
-
-                # Transfer to GPU (if GPU is enabled, else this does nothing)
-                local_obs = batch_obs[cur_sample:cur_sample + sgd_batch_size]
-                local_act = batch_act[cur_sample:cur_sample + sgd_batch_size]
-                local_adv = batch_adv[cur_sample:cur_sample + sgd_batch_size]
-                local_val = batch_discrew[cur_sample:cur_sample + sgd_batch_size]
-
-                # Compute the loss
                 logp = model.get_logp(local_obs, local_act).reshape(-1, act_size)
-                old_logp = old_model.get_logp(local_obs, local_act).reshape(-1, act_size)
                 mean_entropy = -(logp*torch.exp(logp)).mean()
 
                 r = torch.exp(logp - old_logp)
                 clip_r = torch.clamp(r, 1 - eps, 1 + eps)
 
                 pol_loss = -torch.min(r * local_adv, clip_r * local_adv).mean() - entropy_coef*mean_entropy
+                kl_sum += ((logp - old_logp)**2).mean().detach() * local_obs.shape[0]
 
-                approx_kl = ((logp - old_logp)**2).mean()
-                if approx_kl > target_kl:
-                    break
-
-                pol_opt.zero_grad()
-                pol_loss.backward()
-                pol_opt.step()
-
-                # value_fn update
+                # value_fn loss
                 # ========================================================================
                 val_preds = model.value_fn(local_obs)
                 if clip_val:
-                    old_val_preds = old_model.value_fn(local_obs)
                     val_preds_clipped = old_val_preds + torch.clamp(val_preds - old_val_preds, -eps, eps)
                     val_loss1 = (val_preds_clipped - local_val)**2
                     val_loss2 = (val_preds - local_val)**2
@@ -235,10 +220,16 @@ def ppo_visit(
                 else:
                     val_loss = val_coef*((val_preds - local_val) ** 2).mean()
 
+                pol_opt.zero_grad()
                 val_opt.zero_grad()
-                val_loss.backward()
+                (pol_loss + val_loss).backward()
+                pol_opt.step()
                 val_opt.step()
 
+            approx_kl = (kl_sum / batch_obs.shape[0]).item()
+            if approx_kl > target_kl:
+                break
+
         # update observation mean and variance
 
         if normalize_obs:
@@ -252,7 +243,6 @@ def ppo_visit(
         model.action_std = actstd_lookup(cur_total_steps)
         sgd_lr = lr_lookup(cur_total_steps)
 
-        old_model = pickle.loads(pickle.dumps(model))
         val_loss_hist.append(val_loss)
         pol_loss_hist.append(pol_loss)
 
@@ -302,13 +292,3 @@ def do_rollout(env, model, n_steps_complete):
 
     torch.autograd.set_grad_enabled(True)
     return ep_obs, ep_act, ep_rew, ep_length, ep_term
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
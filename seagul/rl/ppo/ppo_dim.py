@@ -5,7 +5,8 @@ import tqdm.auto as tqdm
 import gym
 import pickle
 
-from seagul.rl.common import update_mean, update_std
+from seagul.rl.common import update_mean, update_std, discount_cumsum
+from seagul.mesh import variation_dim
 
 
 def ppo_dim(
@@ -149,7 +150,7 @@ def ppo_dim(
 
             ep_obs, ep_act, ep_rew, ep_steps = do_rollout(env, model)
 
-            ep_rew /= var_dim(ep_obs[transient_length:],order=1)
+            ep_rew /= variation_dim(ep_obs[transient_length:],order=1)
 
             raw_rew_hist.append(sum(ep_rew))
             ep_rew = (ep_rew - ep_rew.mean()) / (ep_rew.std() + 1e-6)
@@ -282,40 +283,3 @@ def do_rollout(env, model):
     ep_rew = ep_rew.reshape(-1, 1)
 
     return ep_obs, ep_act, ep_rew, ep_length
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
-
-
-def variogram(data, l, ord):
-    """Method of moments variogram estimator: eq (16) from https://arxiv.org/pdf/1101.1444.pdf
-    Args:
-        data: np.array, data you want to estimate the variogram of
-        l: int, lag
-        ord: int, order of the estimator
-    Returns:
-        float, the variogram at point l
-
-    """
-    return 1 / (2 * len(data) - l) * np.sum(np.linalg.norm(data[l:] - data[:-l],ord=ord))
-
-
-def var_dim(data, order):
-    """Variation fractal dimension estimator: eq (18) from https://arxiv.org/pdf/1101.1444.pdf
-        Args:
-            data: np.array, data you want to estimate the dimension of
-            ord: int, order of the estimator
-        Returns:
-            float, the dimension estimate
-        """
-    return 2 - 1/(order*np.log(2))*(np.log(variogram(data, 2, order)) - np.log(variogram(data, 1, order)))
-
-
-
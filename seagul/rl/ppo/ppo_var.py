@@ -5,7 +5,7 @@ import tqdm.auto as tqdm
 import gym
 import pickle
 
-from seagul.rl.common import update_mean, update_std
+from seagul.rl.common import update_mean, update_std, discount_cumsum
 
 
 def ppo(
@@ -278,14 +278,3 @@ def do_rollout(env, model):
     ep_rew = ep_rew.reshape(-1, 1)
 
     return ep_obs, ep_act, ep_rew, ep_length
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
-
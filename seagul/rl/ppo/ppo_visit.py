@@ -4,10 +4,10 @@ from torch.utils import data
 import tqdm.auto as tqdm
 import gym
 import pickle
-from seagul.rl.common import ReplayBuffer
+from seagul.rl.novelty import NoveltyIndex
 
 
-from seagul.rl.common import update_mean, update_std
+from seagul.rl.common import update_mean, update_std, discount_cumsum
 
 
 def ppo_visit(
@@ -98,7 +98,7 @@ def ppo_visit(
     actvar_lookup = make_variance_schedule(act_var_schedule, model, total_steps)
     model.action_var = actvar_lookup(0)
 
-    replay_buf = ReplayBuffer(env.observation_space.shape[0], act_size, replay_buf_size)
+    novelty_index = NoveltyIndex(env.observation_space.shape[0], replay_buf_size)
 
 
     obs_size = env.observation_space.shape[0]
@@ -155,10 +155,9 @@ def ppo_visit(
 
             ep_obs, ep_act, ep_rew, ep_steps = do_rollout(env, model)
 
-            for i, obs in enumerate(ep_obs):
-                ep_rew[i] -= (np.min(np.linalg.norm(obs - replay_buf.obs1_buf, axis=1)))*vc
-
-            replay_buf.store(ep_obs, ep_obs, ep_act, ep_rew, ep_rew)
+            # penalize distance to the nearest state seen in earlier episodes
+            ep_rew -= torch.as_tensor(novelty_index.novelty(ep_obs), dtype=ep_rew.dtype).reshape(-1, 1)*vc
+            novelty_index.insert(ep_obs)
 
             raw_rew_hist.append(sum(ep_rew))
             ep_rew = (ep_rew - ep_rew.mean()) / (ep_rew.std() + 1e-6)
@@ -291,14 +290,3 @@ def do_rollout(env, model):
     ep_rew = ep_rew.reshape(-1, 1)
 
     return ep_obs, ep_act, ep_rew, ep_length
-
-
-# can make this faster I think?
-def discount_cumsum(rewards, discount):
-    future_cumulative_reward = 0
-    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
-    for i in range(len(rewards) - 1, -1, -1):
-        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
-        future_cumulative_reward = cumulative_rewards[i]
-    return cumulative_rewards
-
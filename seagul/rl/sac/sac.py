@@ -1,3 +1,4 @@
+import time
 import numpy as np
 import torch
 from torch.utils import data
@@ -5,7 +6,10 @@ import tqdm.auto as tqdm
 import gym
 import dill
 
-from seagul.rl.common import ReplayBuffer, update_mean, update_std, RandModel
+from seagul.rl.common import ReplayBuffer, PrioritizedReplayBuffer, update_mean, update_std, RandModel, PolyakTarget, \
+    EpisodeBuffer, run_episode
+from seagul.rl.async_actors import AsyncActors
+from seagul.nn import MLP, RunningMeanStd
 
 
 def sac(
@@ -24,9 +28,14 @@ def sac(
         sgd_lr=1e-3,
         exploration_steps=100,
         replay_buf_size=int(100000),
+        replay_buf=None,
         normalize_steps = 1000,
         use_gpu=False,
         reward_stop=None,
+        n_actors=0,
+        utd_ratio=1.0,
+        max_actor_lead=5000,
+        actor_sync_every=100,
         env_config = {},
 ):
     """
@@ -35,7 +44,7 @@ def sac(
     Args:
         env_name: name of the openAI gym environment to solve
         train_steps: number of timesteps to run the PPO for
-        model: model from seagul.rl.models. Contains policy, value fn, q1_fn, q2_fn
+        model: model from seagul.rl.models. Contains policy, value fn, q1_fn, q2_fn (or a q_fns ensemble)
         min_steps_per_update: minimun number of steps to take before running updates, will finish episodes before updating
         env_max_steps: number of steps the environment takes before finishing, if the environment emits a done signal before this we consider it a failure.
         iters_per_update: how many update steps to make every time we update
@@ -50,8 +59,16 @@ def sac(
         q_lr: initial learning rate for q fn optimizer
         exploration_steps: initial number of random actions to take, aids exploration
         replay_buf_size: how big of a replay buffer to use
+        replay_buf: buffer to use instead of a new ReplayBuffer(replay_buf_size), e.g. a PrioritizedReplayBuffer
         use_gpu: determines if we try to use a GPU or not
         reward_stop: reward value to bail at
+        n_actors: if > 0, after exploration collect data in this many actor processes while training runs at the same
+            time in this one (see seagul.rl.async_actors). 0 alternates between episodes and updates.
+            A replay buffer made for the actors is freed before returning, pass a ReplayBuffer(..., shared=True) as
+            replay_buf to keep it
+        utd_ratio: with n_actors > 0, gradient updates per env step, the learner and actors throttle each other to it
+        max_actor_lead: with n_actors > 0, how many env steps the actors may get ahead of the learner
+        actor_sync_every: with n_actors > 0, how many updates between copies of the policy to the actors
         env_config: dictionary containing kwargs to pass to your the environment
     
     Returns:
@@ -90,14 +107,35 @@ def sac(
 
     obs_size = env.observation_space.shape[0]
 
+    # rollouts call the policy on one observation at a time, see MLP.compile_inference
+    if isinstance(model.policy, MLP):
+        model.policy.compile_inference()
+
     random_model = RandModel(model.act_limit, act_size)
-    replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size)
+    # with actors a buffer made here lives in shared memory and gets freed before we return, pass in a
+    # ReplayBuffer(..., shared=True) to keep it around
+    own_replay_buf = replay_buf is None
+    if replay_buf is None:
+        replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size, shared=n_actors > 0)
+    prioritized = isinstance(replay_buf, PrioritizedReplayBuffer)
     target_value_fn = dill.loads(dill.dumps(model.value_fn))
+    value_target = PolyakTarget(model.value_fn, target_value_fn)
 
     pol_opt = torch.optim.Adam(model.policy.parameters(), lr=sgd_lr)
     val_opt = torch.optim.Adam(model.value_fn.parameters(), lr=sgd_lr)
-    q1_opt = torch.optim.Adam(model.q1_fn.parameters(), lr=sgd_lr)
-    q2_opt = torch.optim.Adam(model.q2_fn.parameters(), lr=sgd_lr)
+
+    # q_fns(x) returns every q prediction stacked into one (n_q, batch_size, 1) tensor
+    if getattr(model, "q_fns", None) is not None:
+        q_modules = [model.q_fns]
+        q_fns = model.q_fns
+        q1_fn = lambda x: model.q_fns(x)[0]
+    else:
+        q_modules = [model.q1_fn, model.q2_fn]
+        q_fns = lambda x: torch.stack((model.q1_fn(x), model.q2_fn(x)))
+        q1_fn = model.q1_fn
+
+    q_params = [param for q_module in q_modules for param in q_module.parameters()]
+    q_opt = torch.optim.Adam(q_params, lr=sgd_lr)
 
     # seed all our RNGs
     env.seed(seed)
@@ -114,6 +152,7 @@ def sac(
     q1_loss_hist = []
     q2_loss_hist = []
 
+    ep_buf = EpisodeBuffer(obs_size, act_size, env_max_steps)
     progress_bar = tqdm.tqdm(total=train_steps + normalize_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -123,7 +162,7 @@ def sac(
 
 
     while cur_total_steps < normalize_steps:
-        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps)
+        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, buf=ep_buf)
         norm_obs1 = torch.cat((norm_obs1, ep_obs1))
         
         ep_steps = ep_rews.shape[0]
@@ -131,24 +170,22 @@ def sac(
 
         progress_bar.update(ep_steps)
     if normalize_steps > 0:
-        obs_mean = norm_obs1.mean(axis=0)
-        obs_std  = norm_obs1.std(axis=0)
-        obs_std[torch.isinf(1/obs_std)] = 1
-
-        model.policy.state_means = obs_mean
-        model.policy.state_std  =  obs_std
-        model.value_fn.state_means = obs_mean
-        model.value_fn.state_std = obs_std
-        target_value_fn.state_means = obs_mean
-        target_value_fn.state_std = obs_std
-
-        model.q1_fn.state_means = torch.cat((obs_mean, torch.zeros(act_size)))
-        model.q1_fn.state_std = torch.cat((obs_std, torch.ones(act_size)))
-        model.q2_fn.state_means = model.q1_fn.state_means
-        model.q2_fn.state_std = model.q1_fn.state_std
+        obs_rms = RunningMeanStd(norm_obs1.shape[1])
+        obs_rms.update(norm_obs1)
+
+        model.policy.obs_norm = obs_rms
+        model.value_fn.obs_norm = obs_rms
+        target_value_fn.obs_norm = obs_rms
+
+        # the q fns see [obs, act], only the obs part gets normalized
+        obs_mean = obs_rms.mean.to(norm_obs1.dtype)
+        obs_std = obs_rms.std.to(norm_obs1.dtype)
+        for q_module in q_modules:
+            q_module.state_means = torch.cat((obs_mean, torch.zeros(act_size)))
+            q_module.state_std = torch.cat((obs_std, torch.ones(act_size)))
 
     while cur_total_steps < exploration_steps:
-        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps)
+        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, buf=ep_buf)
         replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
         ep_steps = ep_rews.shape[0]
@@ -156,166 +193,187 @@ def sac(
 
         progress_bar.update(ep_steps)
 
-    while cur_total_steps < train_steps:
-        cur_batch_steps = 0
-
-        # Bail out if we have met out reward threshold
-        if len(raw_rew_hist) > 2 and reward_stop:
-            if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
-                early_stop = True
-                break
+    # One update from a replay batch, used by both the synchronous and the asynchronous loop
+    # ========================================================================
+    def update_step(replay_batch):
+        replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_batch[:5]
+        if prioritized:
+            replay_weights, replay_idxs = replay_batch[5:]
+            td_errors = torch.zeros(replay_batch_size, 1)
+        else:
+            replay_weights = torch.ones(replay_batch_size, 1)
 
-        # collect data with the current policy
+        # compute targets for Q and V
         # ========================================================================
-        while cur_batch_steps < min_steps_per_update:
-            ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps)
-            replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
-
-            ep_steps = ep_rews.shape[0]
-            cur_batch_steps += ep_steps
-            cur_total_steps += ep_steps
+        q_targ = replay_rews + gamma * (1 - replay_done) * target_value_fn(replay_obs2)
+        q_targ = q_targ.detach()
 
-            raw_rew_hist.append(torch.sum(ep_rews))
-            print(raw_rew_hist[-1])
+        noise = torch.randn(replay_batch_size, act_size)
+        sample_acts, sample_logp = model.select_action(replay_obs1, noise)
 
+        q_in = torch.cat((replay_obs1, sample_acts), dim=1)
+        q_min, q_min_idx = torch.min(q_fns(q_in), dim=0)
 
+        v_targ = q_min - alpha * sample_logp
+        v_targ = v_targ.detach()
 
-        progress_bar.update(cur_batch_steps)
-
-        for _ in range(min(int(ep_steps), iters_per_update)):
-            # compute targets for Q and V
-            # ========================================================================
-            replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_buf.sample_batch(replay_batch_size)
+        # q_fn update
+        # ========================================================================
+        num_mbatch = int(replay_batch_size / sgd_batch_size)
 
-            q_targ = replay_rews + gamma * (1 - replay_done) * target_value_fn(replay_obs2)
-            q_targ = q_targ.detach()
+        for i in range(num_mbatch):
+            cur_sample = i*sgd_batch_size
 
-            noise = torch.randn(replay_batch_size, act_size)
-            sample_acts, sample_logp = model.select_action(replay_obs1, noise)
+            q_in = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], replay_acts[cur_sample:cur_sample + sgd_batch_size]), dim=1)
+            q_preds = q_fns(q_in)
+            local_weights = replay_weights[cur_sample:cur_sample + sgd_batch_size]
+            q_errs = q_preds - q_targ[cur_sample:cur_sample + sgd_batch_size]
+            q_losses = (local_weights*torch.pow(q_errs, 2)).mean(dim=(1, 2))
+            q1_loss, q2_loss = q_losses[0], q_losses[-1]
+            q_loss = q_losses.sum()
 
-            q_in = torch.cat((replay_obs1, sample_acts), dim=1)
-            q_preds = torch.cat((model.q1_fn(q_in), model.q2_fn(q_in)), dim=1)
-            q_min, q_min_idx = torch.min(q_preds, dim=1)
-            q_min = q_min.reshape(-1, 1)
+            if prioritized:
+                td_errors[cur_sample:cur_sample + sgd_batch_size] = q_errs[0].detach()
 
-            v_targ = q_min - alpha * sample_logp
-            v_targ = v_targ.detach()
+            q_opt.zero_grad()
+            q_loss.backward()
+            q_opt.step()
 
-            # q_fn update
-            # ========================================================================
-            num_mbatch = int(replay_batch_size / sgd_batch_size)
-
-            for i in range(num_mbatch):
-                cur_sample = i*sgd_batch_size
-
-                q_in = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], replay_acts[cur_sample:cur_sample + sgd_batch_size]), dim=1)
-                q1_preds = model.q1_fn(q_in)
-                q2_preds = model.q2_fn(q_in)
-                q1_loss = torch.pow(q1_preds - q_targ[cur_sample:cur_sample + sgd_batch_size], 2).mean()
-                q2_loss = torch.pow(q2_preds - q_targ[cur_sample:cur_sample + sgd_batch_size], 2).mean()
-                q_loss = q1_loss + q2_loss
-            
-                q1_opt.zero_grad()
-                q2_opt.zero_grad()
-                q_loss.backward()
-                q1_opt.step()
-                q2_opt.step()
-
-            # val_fn update
-            # ========================================================================
-            for i in range(num_mbatch):
-                cur_sample = i*sgd_batch_size
+        if prioritized:
+            # rows past the last full minibatch weren't trained on, leave their priorities alone
+            n_trained = num_mbatch * sgd_batch_size
+            replay_buf.update_priorities(replay_idxs[:n_trained], td_errors[:n_trained])
 
-                # predict and calculate loss for the batch
-                val_preds = model.value_fn(replay_obs1[cur_sample:cur_sample + sgd_batch_size])
-                val_loss = torch.sum(torch.pow(val_preds - v_targ[cur_sample:cur_sample + sgd_batch_size], 2)) / replay_batch_size
+        # val_fn update
+        # ========================================================================
+        for i in range(num_mbatch):
+            cur_sample = i*sgd_batch_size
 
-                # do the normal pytorch update
-                val_opt.zero_grad()
-                val_loss.backward()
-                val_opt.step()
+            # predict and calculate loss for the batch
+            val_preds = model.value_fn(replay_obs1[cur_sample:cur_sample + sgd_batch_size])
+            val_loss = torch.sum(torch.pow(val_preds - v_targ[cur_sample:cur_sample + sgd_batch_size], 2)) / replay_batch_size
 
-            # policy_fn update
-            # ========================================================================
-            for param in model.q1_fn.parameters():
-                param.requires_grad = False
+            # do the normal pytorch update
+            val_opt.zero_grad()
+            val_loss.backward()
+            val_opt.step()
 
-            for i in range(num_mbatch):
-                cur_sample = i*sgd_batch_size
+        # policy_fn update
+        # ========================================================================
+        for param in q_params:
+            param.requires_grad = False
 
-                noise = torch.randn(replay_obs1[cur_sample:cur_sample + sgd_batch_size].shape[0], act_size)
-                local_acts, local_logp = model.select_action(replay_obs1[cur_sample:cur_sample + sgd_batch_size], noise)
+        for i in range(num_mbatch):
+            cur_sample = i*sgd_batch_size
 
-                q_in = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], local_acts), dim=1)
-                pol_loss = torch.sum(alpha * local_logp - model.q1_fn(q_in)) / replay_batch_size
+            noise = torch.randn(replay_obs1[cur_sample:cur_sample + sgd_batch_size].shape[0], act_size)
+            local_acts, local_logp = model.select_action(replay_obs1[cur_sample:cur_sample + sgd_batch_size], noise)
 
-                pol_opt.zero_grad()
-                pol_loss.backward()
-                pol_opt.step()
+            q_in = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], local_acts), dim=1)
+            pol_loss = torch.sum(alpha * local_logp - q1_fn(q_in)) / replay_batch_size
 
-            for param in model.q1_fn.parameters():
-                param.requires_grad = True
+            pol_opt.zero_grad()
+            pol_loss.backward()
+            pol_opt.step()
 
-            # Update target value fn with polyak average
-            # ========================================================================
-            val_loss_hist.append(val_loss.item())
-            pol_loss_hist.append(pol_loss.item())
-            q1_loss_hist.append(q1_loss.item())
-            q2_loss_hist.append(q2_loss.item())
+        for param in q_params:
+            param.requires_grad = True
 
+        # Update target value fn with polyak average
+        # ========================================================================
+        val_loss_hist.append(val_loss.item())
+        pol_loss_hist.append(pol_loss.item())
+        q1_loss_hist.append(q1_loss.item())
+        q2_loss_hist.append(q2_loss.item())
 
+        value_target.update(polyak)
 
-            val_sd = model.value_fn.state_dict()
-            tar_sd = target_value_fn.state_dict()
-            for layer in tar_sd:
-                tar_sd[layer] = polyak * tar_sd[layer] + (1 - polyak) * val_sd[layer]
+    if n_actors > 0:
+        # actors collect episodes in their own processes while this one trains, see seagul.rl.async_actors
+        # ========================================================================
+        def rollout_fn(env, actor_model, buf, total_steps):
+            return do_rollout(env, actor_model, env_max_steps, buf=buf)
+
+        actors = AsyncActors(env_name, env_config, model, replay_buf, rollout_fn, n_actors, cur_total_steps, utd_ratio,
+                             max_actor_lead, actor_sync_every, seed)
+
+        try:
+            while cur_total_steps < train_steps:
+                raw_rew_hist.extend(torch.as_tensor(ep_ret) for ep_ret in actors.poll_returns())
+                if len(raw_rew_hist) > 2 and reward_stop:
+                    if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                        early_stop = True
+                        break
+
+                n_iters = min(actors.updates_allowed(), iters_per_update)
+                if n_iters > 0:
+                    for replay_batch in zip(*actors.sample_batches(replay_batch_size, n_iters)):
+                        update_step(replay_batch)
+                    actors.record_updates(n_iters)
+                else:
+                    time.sleep(1e-3)
+
+                progress_bar.update(actors.steps - cur_total_steps)
+                cur_total_steps = actors.steps
+        finally:
+            actors.close()
+            if own_replay_buf:
+                replay_buf.close()
+    else:
+        while cur_total_steps < train_steps:
+            cur_batch_steps = 0
 
-            target_value_fn.load_state_dict(tar_sd)
+            # Bail out if we have met out reward threshold
+            if len(raw_rew_hist) > 2 and reward_stop:
+                if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                    early_stop = True
+                    break
 
-    return model, raw_rew_hist, locals()
+            # collect data with the current policy
+            # ========================================================================
+            while cur_batch_steps < min_steps_per_update:
+                ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps, buf=ep_buf)
+                replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
+                ep_steps = ep_rews.shape[0]
+                cur_batch_steps += ep_steps
+                cur_total_steps += ep_steps
 
-def do_rollout(env, model, num_steps):
-    torch.autograd.set_grad_enabled(False)
-    acts_list = []
-    obs1_list = []
-    obs2_list = []
-    rews_list = []
-    done_list = []
+                raw_rew_hist.append(torch.sum(ep_rews))
+                print(raw_rew_hist[-1])
 
-    dtype = torch.float32
-    act_size = env.action_space.shape[0]
-    obs = env.reset()
-    done = False
-    cur_step = 0
 
-    while not done:
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-        obs1_list.append(obs.clone())
 
-        noise = torch.randn(1, act_size)
-        act, _ = model.select_action(obs.reshape(1, -1), noise)
-        act = act.detach()
+            progress_bar.update(cur_batch_steps)
 
-        obs, rew, done, _ = env.step(act.numpy().reshape(-1))
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
+            n_iters = min(int(ep_steps), iters_per_update)
+            if prioritized:
+                # one batch at a time so each draw sees the priorities the previous update wrote
+                for _ in range(n_iters):
+                    update_step(replay_buf.sample_batch(replay_batch_size))
+            else:
+                replay_batches = replay_buf.sample_batches(replay_batch_size, n_iters)
+                for replay_batch in zip(*replay_batches):
+                    update_step(replay_batch)
 
-        acts_list.append(torch.as_tensor(act.clone(), dtype=dtype))
-        rews_list.append(torch.as_tensor(rew, dtype=dtype))
-        obs2_list.append(obs.clone())
+    return model, raw_rew_hist, locals()
 
-        if cur_step < num_steps:
-            done_list.append(torch.as_tensor(done))
-        else:
-            done_list.append(torch.as_tensor(False))
 
-        cur_step += 1
+def do_rollout(env, model, num_steps, buf=None):
+    """
+    Runs one episode with model, returns (obs1, obs2, acts, rews, done) views into buf (see EpisodeBuffer), which
+    are only valid until the next rollout into the same buffer
+    """
+    act_size = env.action_space.shape[0]
+    if buf is None:
+        buf = EpisodeBuffer(env.observation_space.shape[0], act_size, num_steps)
 
-    ep_obs1 = torch.stack(obs1_list)
-    ep_acts = torch.stack(acts_list).reshape(-1, act_size)
-    ep_rews = torch.stack(rews_list).reshape(-1, 1)
-    ep_obs2 = torch.stack(obs2_list)
-    ep_done = torch.stack(done_list).reshape(-1, 1)
+    def act_fn(obs):
+        noise = torch.randn(1, act_size)
+        act, _ = model.select_action(obs.reshape(1, -1), noise)
+        return act.detach()
 
+    torch.autograd.set_grad_enabled(False)
+    run_episode(env, act_fn, buf, timeout=num_steps)
     torch.autograd.set_grad_enabled(True)
-    return (ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
+    return buf.obs1, buf.obs2, buf.acts, buf.rews, buf.dones
@@ -5,7 +5,7 @@ import tqdm.auto as tqdm
 import gym
 import dill
 
-from seagul.rl.common import ReplayBuffer, update_mean, update_std, RandModel
+from seagul.rl.common import ReplayBuffer, update_mean, update_std, RandModel, PolyakTarget
 from seagul.nn import fit_model
 
 
@@ -108,6 +108,7 @@ def sac_switched(
     replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size)
     needle_buf = ReplayBuffer(obs_size, act_size, replay_buf_size)
     target_value_fn = dill.loads(dill.dumps(model.value_fn))
+    value_target = PolyakTarget(model.value_fn, target_value_fn)
 
     pol_opt = torch.optim.Adam(model.policy.parameters(), lr=sgd_lr)
     val_opt = torch.optim.Adam(model.value_fn.parameters(), lr=sgd_lr)
@@ -331,12 +332,7 @@ def sac_switched(
 
             # Update target networks
             # ========================================================================
-            val_sd = model.value_fn.state_dict()
-            tar_sd = target_value_fn.state_dict()
-            for layer in tar_sd:
-                tar_sd[layer] = polyak * tar_sd[layer] + (1 - polyak) * val_sd[layer]
-
-            target_value_fn.load_state_dict(tar_sd)
+            value_target.update(polyak)
 
     return model, raw_rew_hist, locals()
 
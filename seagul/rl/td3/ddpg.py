@@ -1,5 +1,8 @@
-from seagul.rl.common import ReplayBuffer, RandModel, make_schedule, update_target_fn
+from seagul.rl.common import ReplayBuffer, RandModel, make_schedule, PolyakTarget, EpisodeBuffer, run_episode
+from seagul.rl.async_actors import AsyncActors
+from seagul.nn import MLP
 import numpy as np
+import time
 import copy
 import gym
 import dill
@@ -23,6 +26,10 @@ def ddpg(
         exploration_steps=1000,
         replay_buf_size=int(100000),
         reward_stop=None,
+        n_actors=0,
+        utd_ratio=1.0,
+        max_actor_lead=5000,
+        actor_sync_every=100,
         env_config=None
 ):
     # Initialize env, and other globals
@@ -38,6 +45,9 @@ def ddpg(
 
     obs_size = env.observation_space.shape[0]
 
+    if isinstance(model.policy, MLP):
+        model.policy.compile_inference()
+
     # seed all our RNGs
     env.seed(seed)
     torch.manual_seed(seed)
@@ -45,7 +55,8 @@ def ddpg(
 
     random_model = RandModel(model.act_limit, act_size)
     target_model = copy.deepcopy(model)
-    replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size)
+    # with actors the buffer lives in shared memory, it gets freed before we return
+    replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size, shared=n_actors > 0)
 
     for param in target_model.q1_fn.parameters():
         param.requires_grad = False
@@ -53,12 +64,16 @@ def ddpg(
     for param in target_model.policy.parameters():
         param.requires_grad = False
 
+    q1_target = PolyakTarget(model.q1_fn, target_model.q1_fn)
+    policy_target = PolyakTarget(model.policy, target_model.policy)
+
     act_std_lookup = make_schedule(act_std_schedule, train_steps)
     act_std = act_std_lookup(0)
 
     pol_opt = torch.optim.Adam(model.policy.parameters(), lr=sgd_lr)
     q1_opt = torch.optim.Adam(model.q1_fn.parameters(), lr=sgd_lr)
 
+    ep_buf = EpisodeBuffer(obs_size, act_size, env_max_steps)
     progress_bar = tqdm.tqdm(total=train_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -72,7 +87,7 @@ def ddpg(
     # Fill the replay buffer with actions taken from a random model
     # ========================================================================
     while cur_total_steps < exploration_steps:
-        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, act_std)
+        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, act_std, buf=ep_buf)
         replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
         ep_steps = ep_rews.shape[0]
@@ -80,126 +95,135 @@ def ddpg(
 
         progress_bar.update(ep_steps)
 
-    # Keep training until we take train_step environment steps
+    # One update from a replay batch, used by both the synchronous and the asynchronous loop
     # ========================================================================
-    while cur_total_steps < train_steps:
-        cur_batch_steps = 0
+    def update_step(replay_batch):
+        replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_batch
 
-        # Bail out if we have met out reward threshold
-        if len(raw_rew_hist) > 2 and reward_stop:
-            if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
-                early_stop = True
-                break
+        # Compute target Q
+        with torch.no_grad():
+            noise = torch.randn(replay_batch_size, act_size) * act_std
+            target_acts, _ = target_model.select_action(replay_obs2, noise)
+            q_in = torch.cat((replay_obs2, target_acts), dim=1)
+            q_targ = replay_rews + gamma * (1 - replay_done) * target_model.q1_fn(q_in)
 
-        # collect data with the current policy
+        # q_fn update
         # ========================================================================
-        while cur_batch_steps < min_steps_per_update:
-            ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps, act_std)
-            replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
+        q_in = torch.cat((replay_obs1, replay_acts), dim=1)
+        q_loss = ((model.q1_fn(q_in) - q_targ)**2).mean()
 
-            ep_steps = ep_rews.shape[0]
-            cur_batch_steps += ep_steps
-            cur_total_steps += ep_steps
+        q1_opt.zero_grad()
+        q_loss.backward()
+        q1_opt.step()
 
-            raw_rew_hist.append(torch.sum(ep_rews))
+        # policy_fn update
+        # ========================================================================
+        for param in model.q1_fn.parameters():
+            param.requires_grad = False
 
-        progress_bar.update(cur_batch_steps)
+        local_acts = model.policy(replay_obs1)
+        q_in = torch.cat((replay_obs1, local_acts), dim=1)
 
-        # Do the update
-        # ========================================================================
-        for _ in range(min(int(ep_steps), iters_per_update)):
+        pol_loss = -(model.q1_fn(q_in).mean())
 
-            replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_buf.sample_batch(replay_batch_size)
-#            print(raw_rew_hist[-1])
+        pol_opt.zero_grad()
+        pol_loss.backward()
+        pol_opt.step()
 
-            # Compute target Q
-            with torch.no_grad():
-                noise = torch.randn(replay_batch_size, act_size) * act_std
-                target_acts, _ = target_model.select_action(replay_obs2, noise)
-                q_in = torch.cat((replay_obs2, target_acts), dim=1)
-                q_targ = replay_rews + gamma * (1 - replay_done) * target_model.q1_fn(q_in)
+        for param in model.q1_fn.parameters():
+            param.requires_grad = True
 
-            # q_fn update
-            # ========================================================================
-            q_in = torch.cat((replay_obs1, replay_acts), dim=1)
-            q_loss = ((model.q1_fn(q_in) - q_targ)**2).mean()
-#            print('q_loss:', q_loss)
+        # Update target value fn with polyak average
+        # ========================================================================
+        pol_loss_hist.append(pol_loss.item())
+        q1_loss_hist.append(q_loss.item())
 
-            q1_opt.zero_grad()
-            q_loss.backward()
-            q1_opt.step()
+        q1_target.update(polyak)
+        policy_target.update(polyak)
 
-            # policy_fn update
-            # ========================================================================
-            for param in model.q1_fn.parameters():
-                param.requires_grad = False
+    # Keep training until we take train_step environment steps
+    # ========================================================================
+    if n_actors > 0:
+        # actors collect episodes in their own processes while this one trains, see seagul.rl.async_actors
+        # ========================================================================
+        def rollout_fn(env, actor_model, buf, total_steps):
+            return do_rollout(env, actor_model, env_max_steps, act_std_lookup(total_steps), buf=buf)
+
+        actors = AsyncActors(env_name, env_config, model, replay_buf, rollout_fn, n_actors, cur_total_steps, utd_ratio,
+                             max_actor_lead, actor_sync_every, seed)
+
+        try:
+            while cur_total_steps < train_steps:
+                raw_rew_hist.extend(torch.as_tensor(ep_ret) for ep_ret in actors.poll_returns())
+                if len(raw_rew_hist) > 2 and reward_stop:
+                    if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                        early_stop = True
+                        break
+
+                n_iters = min(actors.updates_allowed(), iters_per_update)
+                if n_iters > 0:
+                    for replay_batch in zip(*actors.sample_batches(replay_batch_size, n_iters)):
+                        update_step(replay_batch)
+                    actors.record_updates(n_iters)
+                else:
+                    time.sleep(1e-3)
+
+                progress_bar.update(actors.steps - cur_total_steps)
+                cur_total_steps = actors.steps
+                act_std = act_std_lookup(cur_total_steps)
+        finally:
+            actors.close()
+            replay_buf.close()
+    else:
+        while cur_total_steps < train_steps:
+            cur_batch_steps = 0
 
-            local_acts = model.policy(replay_obs1)
-            q_in = torch.cat((replay_obs1, local_acts), dim=1)
+            # Bail out if we have met out reward threshold
+            if len(raw_rew_hist) > 2 and reward_stop:
+                if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                    early_stop = True
+                    break
 
-            pol_loss = -(model.q1_fn(q_in).mean())
-#            print('pol_loss:', pol_loss)
+            # collect data with the current policy
+            # ========================================================================
+            while cur_batch_steps < min_steps_per_update:
+                ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps, act_std, buf=ep_buf)
+                replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
-            pol_opt.zero_grad()
-            pol_loss.backward()
-            pol_opt.step()
+                ep_steps = ep_rews.shape[0]
+                cur_batch_steps += ep_steps
+                cur_total_steps += ep_steps
 
-            for param in model.q1_fn.parameters():
-                param.requires_grad = True
+                raw_rew_hist.append(torch.sum(ep_rews))
 
-            # Update target value fn with polyak average
-            # ========================================================================
-            pol_loss_hist.append(pol_loss.item())
-            q1_loss_hist.append(q_loss.item())
+            progress_bar.update(cur_batch_steps)
 
-            target_model.q1_fn = update_target_fn(model.q1_fn, target_model.q1_fn, polyak)
-            target_model.policy = update_target_fn(model.policy, target_model.policy, polyak)
+            # Do the update
+            # ========================================================================
+            n_iters = min(int(ep_steps), iters_per_update)
+            replay_batches = replay_buf.sample_batches(replay_batch_size, n_iters)
+            for replay_batch in zip(*replay_batches):
+                update_step(replay_batch)
             act_std = act_std_lookup(cur_total_steps)
 
     return model, raw_rew_hist, locals()
 
 
-def do_rollout(env, model, num_steps, act_std):
-    torch.autograd.set_grad_enabled(False)
-    acts_list = []
-    obs1_list = []
-    obs2_list = []
-    rews_list = []
-    done_list = []
-
-    dtype = torch.float32
+def do_rollout(env, model, num_steps, act_std, buf=None):
+    """
+    Runs one episode with model, exploring with gaussian noise of std act_std. Returns (obs1, obs2, acts, rews, done)
+    views into buf (see EpisodeBuffer), which are only valid until the next rollout into the same buffer
+    """
     act_size = env.action_space.shape[0]
-    obs = env.reset()
-    done = False
-    cur_step = 0
-
-    while not done:
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-        obs1_list.append(obs.clone())
+    if buf is None:
+        buf = EpisodeBuffer(env.observation_space.shape[0], act_size, num_steps)
 
+    def act_fn(obs):
         noise = torch.randn(1, act_size)*act_std
         act, _ = model.select_action(obs.reshape(1, -1), noise)
-        act = act.detach()
-
-        obs, rew, done, _ = env.step(act.numpy().reshape(-1))
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-
-        acts_list.append(torch.as_tensor(act.clone(), dtype=dtype))
-        rews_list.append(torch.as_tensor(rew, dtype=dtype))
-        obs2_list.append(obs.clone())
-
-        if cur_step < num_steps:
-            done_list.append(torch.as_tensor(done))
-        else:
-            done_list.append(torch.as_tensor(False))
-
-        cur_step += 1
-
-    ep_obs1 = torch.stack(obs1_list)
-    ep_acts = torch.stack(acts_list).reshape(-1, act_size)
-    ep_rews = torch.stack(rews_list).reshape(-1, 1)
-    ep_obs2 = torch.stack(obs2_list)
-    ep_done = torch.stack(done_list).reshape(-1, 1)
+        return act.detach()
 
+    torch.autograd.set_grad_enabled(False)
+    run_episode(env, act_fn, buf, timeout=num_steps)
     torch.autograd.set_grad_enabled(True)
-    return ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done
+    return buf.obs1, buf.obs2, buf.acts, buf.rews, buf.dones
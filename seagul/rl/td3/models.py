@@ -24,10 +24,14 @@ class TD3Model:
     LOG_STD_MAX = 2
     LOG_STD_MIN = -20
 
-    def __init__(self, policy, q1_fn, q2_fn, act_limit):
+    def __init__(self, policy, q1_fn, q2_fn, act_limit, q_fns=None):
+        """
+        q_fns: optional seagul.nn.EnsembleMLP to use instead of q1_fn and q2_fn (pass None for those)
+        """
         self.policy = policy
         self.q1_fn = q1_fn
         self.q2_fn = q2_fn
+        self.q_fns = q_fns
 
         self.num_acts = int(policy.output_layer.out_features / 2)
         self.act_limit = act_limit
@@ -1,5 +1,9 @@
-from seagul.rl.common import ReplayBuffer, RandModel, make_schedule, update_target_fn
+from seagul.rl.common import ReplayBuffer, PrioritizedReplayBuffer, RandModel, make_schedule, PolyakTarget, \
+    EpisodeBuffer, run_episode
+from seagul.rl.async_actors import AsyncActors
+from seagul.nn import MLP
 import numpy as np
+import time
 
 import gym
 import dill
@@ -22,7 +26,12 @@ def td3(
         sgd_lr=3e-4,
         exploration_steps=1000,
         replay_buf_size=int(100000),
+        replay_buf=None,
         reward_stop=None,
+        n_actors=0,
+        utd_ratio=1.0,
+        max_actor_lead=5000,
+        actor_sync_every=100,
         env_config=None
 ):
     # Initialize env, and other globals
@@ -38,22 +47,42 @@ def td3(
 
     obs_size = env.observation_space.shape[0]
 
+    if isinstance(model.policy, MLP):
+        model.policy.compile_inference()
+
     # seed all our RNGs
     env.seed(seed)
     torch.manual_seed(seed)
     np.random.seed(seed)
 
     random_model = RandModel(model.act_limit, act_size)
-    replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size)
-    target_q1_fn = dill.loads(dill.dumps(model.q1_fn))
-    target_q2_fn = dill.loads(dill.dumps(model.q2_fn))
+    # with actors a buffer made here lives in shared memory and gets freed before we return, pass in a
+    # ReplayBuffer(..., shared=True) to keep it around
+    own_replay_buf = replay_buf is None
+    if replay_buf is None:
+        replay_buf = ReplayBuffer(obs_size, act_size, replay_buf_size, shared=n_actors > 0)
+    prioritized = isinstance(replay_buf, PrioritizedReplayBuffer)
+
+    # Only q1_fn is trained unless the model carries a q_fns ensemble, then the target is the min over every network
+    # in it (clipped double Q). Either way q_fns(x) returns the predictions stacked as (n_q, batch_size, 1)
+    if getattr(model, "q_fns", None) is not None:
+        q_module = model.q_fns
+        target_q_module = dill.loads(dill.dumps(model.q_fns))
+        q_fns = model.q_fns
+        target_q_fns = target_q_module
+    else:
+        q_module = model.q1_fn
+        target_q_module = dill.loads(dill.dumps(model.q1_fn))
+        q_fns = lambda x: model.q1_fn(x).unsqueeze(0)
+        target_q_fns = lambda x: target_q_module(x).unsqueeze(0)
+
     target_policy = dill.loads(dill.dumps(model.policy))
 
-    for param in target_q1_fn.parameters():
+    for param in target_q_module.parameters():
         param.requires_grad = False
 
-    for param in target_q2_fn.parameters():
-        param.requires_grad = False
+    q_target = PolyakTarget(q_module, target_q_module)
+    policy_target = PolyakTarget(model.policy, target_policy)
 
     for param in target_policy.parameters():
         param.requires_grad = False
@@ -62,9 +91,9 @@ def td3(
     act_std = act_std_lookup(0)
 
     pol_opt = torch.optim.Adam(model.policy.parameters(), lr=sgd_lr)
-    q1_opt = torch.optim.Adam(model.q1_fn.parameters(), lr=sgd_lr)
-    q2_opt = torch.optim.Adam(model.q2_fn.parameters(), lr=sgd_lr)
+    q_opt = torch.optim.Adam(q_module.parameters(), lr=sgd_lr)
 
+    ep_buf = EpisodeBuffer(obs_size, act_size, env_max_steps)
     progress_bar = tqdm.tqdm(total=train_steps)
     cur_total_steps = 0
     progress_bar.update(0)
@@ -78,7 +107,7 @@ def td3(
     # Fill the replay buffer with actions taken from a random model
     # ========================================================================
     while cur_total_steps < exploration_steps:
-        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, act_std)
+        ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, random_model, env_max_steps, act_std, buf=ep_buf)
         replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
         ep_steps = ep_rews.shape[0]
@@ -86,141 +115,169 @@ def td3(
 
         progress_bar.update(ep_steps)
 
-    # Keep training until we take train_step environment steps
+    # One update from a replay batch, used by both the synchronous and the asynchronous loop
     # ========================================================================
-    while cur_total_steps < train_steps:
-        cur_batch_steps = 0
+    def update_step(replay_batch):
+        replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_batch[:5]
+        if prioritized:
+            replay_weights, replay_idxs = replay_batch[5:]
+            td_errors = torch.zeros(replay_batch_size, 1)
+        else:
+            replay_weights = torch.ones(replay_batch_size, 1)
+
+        # Compute target Q
+        with torch.no_grad():
+            acts_from_target = target_policy(replay_obs2)
+            q_in = torch.cat((replay_obs2, acts_from_target), dim=1)
+            q_targ = replay_rews + gamma*(1 - replay_done)*torch.min(target_q_fns(q_in), dim=0)[0]
 
-        # Bail out if we have met out reward threshold
-        if len(raw_rew_hist) > 2 and reward_stop:
-            print(raw_rew_hist[-1])
-            if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
-                early_stop = True
-                break
+        num_mbatch = int(replay_batch_size / sgd_batch_size)
 
-        # collect data with the current policy
+        # q_fn update
         # ========================================================================
-        while cur_batch_steps < min_steps_per_update:
-            ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps, act_std)
-            replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
+        for i in range(num_mbatch):
+            cur_sample = i * sgd_batch_size
 
-            ep_steps = ep_rews.shape[0]
-            cur_batch_steps += ep_steps
-            cur_total_steps += ep_steps
+            q_in_local = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], replay_acts[cur_sample:cur_sample + sgd_batch_size]), dim=1)
+            local_qtarg = q_targ[cur_sample:cur_sample + sgd_batch_size]
 
-            raw_rew_hist.append(torch.sum(ep_rews))
+            local_weights = replay_weights[cur_sample:cur_sample + sgd_batch_size]
+            q_errs = q_fns(q_in_local) - local_qtarg
+            q_losses = (local_weights*q_errs**2).mean(dim=(1, 2))
+            q1_loss = q_losses[0]
+            q_loss = q_losses.sum()
 
-        progress_bar.update(cur_batch_steps)
+            if prioritized:
+                td_errors[cur_sample:cur_sample + sgd_batch_size] = q_errs[0].detach()
 
-        # Do the update
+            q_opt.zero_grad()
+            q_loss.backward()
+            q_opt.step()
+
+        if prioritized:
+            # rows past the last full minibatch weren't trained on, leave their priorities alone
+            n_trained = num_mbatch * sgd_batch_size
+            replay_buf.update_priorities(replay_idxs[:n_trained], td_errors[:n_trained])
+
+        # policy_fn update
         # ========================================================================
-        for _ in range(min(int(ep_steps), iters_per_update)):
+        for param in q_module.parameters():
+            param.requires_grad = False
 
-            # Compute target Q
-            replay_obs1, replay_obs2, replay_acts, replay_rews, replay_done = replay_buf.sample_batch(replay_batch_size)
+        for i in range(num_mbatch):
+            cur_sample = i * sgd_batch_size
+            local_obs = replay_obs1[cur_sample:cur_sample + sgd_batch_size]
+            local_acts = model.policy(local_obs)
+            q_in = torch.cat((local_obs, local_acts), dim=1)
 
-            with torch.no_grad():
-                acts_from_target = target_policy(replay_obs2)
-                q_in = torch.cat((replay_obs2, acts_from_target), dim=1)
-                q_targ = replay_rews + gamma*(1 - replay_done)*target_q1_fn(q_in)
+            pol_loss = -(q_fns(q_in)[0].mean())
 
-            num_mbatch = int(replay_batch_size / sgd_batch_size)
+            pol_opt.zero_grad()
+            pol_loss.backward()
+            pol_opt.step()
 
-            # q_fn update
-            # ========================================================================
-            for i in range(num_mbatch):
-                cur_sample = i * sgd_batch_size
+        for param in q_module.parameters():
+            param.requires_grad = True
 
-                q_in_local = torch.cat((replay_obs1[cur_sample:cur_sample + sgd_batch_size], replay_acts[cur_sample:cur_sample + sgd_batch_size]), dim=1)
-                local_qtarg = q_targ[cur_sample:cur_sample + sgd_batch_size]
+        # Update target value fn with polyak average
+        # ========================================================================
+        pol_loss_hist.append(pol_loss.item())
+        q1_loss_hist.append(q1_loss.item())
+        #q2_loss_hist.append(q2_loss.item())
 
-                q1_loss = ((model.q1_fn(q_in_local) - local_qtarg)**2).mean()
+        q_target.update(polyak)
+        policy_target.update(polyak)
 
-                #q2_preds = model.q2_fn(q_in)
-                #q2_loss = (q2_preds - q_targ[cur_sample:cur_sample + sgd_batch_size]**2).mean()
-                q_loss = q1_loss# + q2_loss
+    # Keep training until we take train_step environment steps
+    # ========================================================================
+    if n_actors > 0:
+        # actors collect episodes in their own processes while this one trains, see seagul.rl.async_actors
+        # ========================================================================
+        def rollout_fn(env, actor_model, buf, total_steps):
+            return do_rollout(env, actor_model, env_max_steps, act_std_lookup(total_steps), buf=buf)
+
+        actors = AsyncActors(env_name, env_config, model, replay_buf, rollout_fn, n_actors, cur_total_steps, utd_ratio,
+                             max_actor_lead, actor_sync_every, seed)
+
+        try:
+            while cur_total_steps < train_steps:
+                raw_rew_hist.extend(torch.as_tensor(ep_ret) for ep_ret in actors.poll_returns())
+                if len(raw_rew_hist) > 2 and reward_stop:
+                    if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                        early_stop = True
+                        break
+
+                n_iters = min(actors.updates_allowed(), iters_per_update)
+                if n_iters > 0:
+                    for replay_batch in zip(*actors.sample_batches(replay_batch_size, n_iters)):
+                        update_step(replay_batch)
+                    actors.record_updates(n_iters)
+                else:
+                    time.sleep(1e-3)
+
+                progress_bar.update(actors.steps - cur_total_steps)
+                cur_total_steps = actors.steps
+                act_std = act_std_lookup(cur_total_steps)
+        finally:
+            actors.close()
+            if own_replay_buf:
+                replay_buf.close()
+    else:
+        while cur_total_steps < train_steps:
+            cur_batch_steps = 0
 
-                q1_opt.zero_grad()
-                #q2_opt.zero_grad()
-                q_loss.backward()
-                q1_opt.step()
-                #q2_opt.step()
+            # Bail out if we have met out reward threshold
+            if len(raw_rew_hist) > 2 and reward_stop:
+                print(raw_rew_hist[-1])
+                if raw_rew_hist[-1] >= reward_stop and raw_rew_hist[-2] >= reward_stop:
+                    early_stop = True
+                    break
 
-            # policy_fn update
+            # collect data with the current policy
             # ========================================================================
-            for param in model.q1_fn.parameters():
-                param.requires_grad = False
-
-            for i in range(num_mbatch):
-                cur_sample = i * sgd_batch_size
-                local_obs = replay_obs1[cur_sample:cur_sample + sgd_batch_size]
-                local_acts = model.policy(local_obs)
-                q_in = torch.cat((local_obs, local_acts), dim=1)
+            while cur_batch_steps < min_steps_per_update:
+                ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done = do_rollout(env, model, env_max_steps, act_std, buf=ep_buf)
+                replay_buf.store(ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done)
 
-                pol_loss = -(model.q1_fn(q_in).mean())
+                ep_steps = ep_rews.shape[0]
+                cur_batch_steps += ep_steps
+                cur_total_steps += ep_steps
 
-                pol_opt.zero_grad()
-                pol_loss.backward()
-                pol_opt.step()
+                raw_rew_hist.append(torch.sum(ep_rews))
 
-            for param in model.q1_fn.parameters():
-                param.requires_grad = True
+            progress_bar.update(cur_batch_steps)
 
-            # Update target value fn with polyak average
+            # Do the update
             # ========================================================================
-            pol_loss_hist.append(pol_loss.item())
-            q1_loss_hist.append(q1_loss.item())
-            #q2_loss_hist.append(q2_loss.item())
-
-            target_q1_fn = update_target_fn(model.q1_fn, target_q1_fn, polyak)
-            target_q2_fn = update_target_fn(model.q2_fn, target_q2_fn, polyak)
-            target_policy = update_target_fn(model.policy, target_policy, polyak)
+            n_iters = min(int(ep_steps), iters_per_update)
+            if prioritized:
+                # one batch at a time so each draw sees the priorities the previous update wrote
+                for _ in range(n_iters):
+                    update_step(replay_buf.sample_batch(replay_batch_size))
+            else:
+                replay_batches = replay_buf.sample_batches(replay_batch_size, n_iters)
+                for replay_batch in zip(*replay_batches):
+                    update_step(replay_batch)
             act_std = act_std_lookup(cur_total_steps)
 
     return model, raw_rew_hist, locals()
 
 
-def do_rollout(env, model, num_steps, act_std):
-    torch.autograd.set_grad_enabled(False)
-    acts_list = []
-    obs1_list = []
-    obs2_list = []
-    rews_list = []
-    done_list = []
-
-    dtype = torch.float32
+def do_rollout(env, model, num_steps, act_std, buf=None):
+    """
+    Runs one episode with model, exploring with gaussian noise of std act_std. Returns (obs1, obs2, acts, rews, done)
+    views into buf (see EpisodeBuffer), which are only valid until the next rollout into the same buffer
+    """
     act_size = env.action_space.shape[0]
-    obs = env.reset()
-    done = False
-    cur_step = 0
-
-    while not done:
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-        obs1_list.append(obs.clone())
+    if buf is None:
+        buf = EpisodeBuffer(env.observation_space.shape[0], act_size, num_steps)
 
+    def act_fn(obs):
         noise = torch.randn(1, act_size)*act_std
         act, _ = model.select_action(obs.reshape(1, -1), noise)
-        act = act.detach()
-
-        obs, rew, done, _ = env.step(act.numpy().reshape(-1))
-        obs = torch.as_tensor(obs, dtype=dtype).detach()
-
-        acts_list.append(torch.as_tensor(act.clone(), dtype=dtype))
-        rews_list.append(torch.as_tensor(rew, dtype=dtype))
-        obs2_list.append(obs.clone())
-
-        if cur_step < num_steps:
-            done_list.append(torch.as_tensor(done))
-        else:
-            done_list.append(torch.as_tensor(False))
-
-        cur_step += 1
-
-    ep_obs1 = torch.stack(obs1_list)
-    ep_acts = torch.stack(acts_list).reshape(-1, act_size)
-    ep_rews = torch.stack(rews_list).reshape(-1, 1)
-    ep_obs2 = torch.stack(obs2_list)
-    ep_done = torch.stack(done_list).reshape(-1, 1)
+        return act.detach()
 
+    torch.autograd.set_grad_enabled(False)
+    run_episode(env, act_fn, buf, timeout=num_steps)
     torch.autograd.set_grad_enabled(True)
-    return ep_obs1, ep_obs2, ep_acts, ep_rews, ep_done
+    return buf.obs1, buf.obs2, buf.acts, buf.rews, buf.dones
@@ -0,0 +1,19 @@
+# Times single observation calls of a rollout sized MLP with and without compile_inference, with autograd off like
+# during a rollout.
+import time
+import torch
+from seagul.nn import MLP
+
+
+if __name__ == "__main__":
+    policy = MLP(input_size=17, output_size=6, num_layers=2, layer_size=64)
+    obs = torch.randn(17)
+    with torch.no_grad():
+        regular_out = policy(obs)
+        for enable in [False, True]:
+            policy.compile_inference(enable)
+            start = time.time()
+            for _ in range(10000):
+                policy(obs)
+            print(f"compile_inference({enable}): {(time.time() - start) * 100:.1f}us per call, "
+                  f"max difference {(policy(obs) - regular_out).abs().max().item():.1e}")
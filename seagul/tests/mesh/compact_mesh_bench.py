@@ -0,0 +1,60 @@
+# Inserts the same keys into a BylMesh of MeshPoints (one at a time, like create_mesh_act) and a CompactMesh (in
+# batches), checks they give the same ids and frequencies, and compares time and memory. Then times CompactMesh alone
+# on many small batches.
+import time
+import tracemalloc
+import numpy as np
+from seagul.mesh import BylMesh, MeshPoint, CompactMesh
+
+
+def byl_insert(mesh, keys):
+    ids = np.empty(keys.shape[0], dtype=np.int64)
+    for n, key in enumerate(keys):
+        if key in mesh:
+            mesh[key].freq += 1
+        else:
+            mesh[key] = MeshPoint(len(mesh), key.copy())
+        ids[n] = mesh[key].id
+    return ids
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    d, key_dim, batch_size = 0.05, 4, 10000
+
+    for n_keys in [int(1e5), int(1e6)]:
+        keys = rng.standard_normal((n_keys, key_dim))
+
+        tracemalloc.start()
+        start = time.time()
+        byl_mesh = BylMesh(d)
+        byl_ids = byl_insert(byl_mesh, keys)
+        byl_time = time.time() - start
+        byl_mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start = time.time()
+        compact_mesh = CompactMesh(d, key_dim)
+        compact_ids = np.concatenate([compact_mesh.lookup_or_insert(keys[i:i + batch_size])
+                                      for i in range(0, n_keys, batch_size)])
+        compact_time = time.time() - start
+        compact_mem = tracemalloc.get_traced_memory()[0] - compact_ids.nbytes
+        tracemalloc.stop()
+
+        byl_freqs = np.array([point.freq for point in sorted(byl_mesh.mesh.values(), key=lambda p: p.id)])
+        assert np.array_equal(byl_ids, compact_ids)
+        assert np.array_equal(byl_freqs, compact_mesh.freqs)
+
+        n_cells = len(compact_mesh)
+        print(f"{n_keys:>8} keys, {n_cells} cells | BylMesh {byl_time:.2f}s {byl_mem / n_cells:.0f} B/cell, "
+              f"CompactMesh {compact_time:.2f}s {compact_mem / n_cells:.0f} B/cell")
+
+    # lots of small batches of mostly new cells, where inserting into one sorted index would copy it every batch
+    for n_keys in [int(1e6), int(3e6)]:
+        keys = rng.standard_normal((n_keys, key_dim))
+        start = time.time()
+        compact_mesh = CompactMesh(d, key_dim)
+        for i in range(0, n_keys, 500):
+            compact_mesh.lookup_or_insert(keys[i:i + 500])
+        print(f"{n_keys:>8} keys in batches of 500, {len(compact_mesh)} cells | CompactMesh {time.time() - start:.2f}s")
@@ -0,0 +1,51 @@
+# Times seagul.mesh.create_mesh on random walk trajectories, 1e4 - 1e7 points in 3 - 20 dimensions. The old version,
+# which compared every new mesh point against the whole dataset, is only run where it finishes in reasonable time.
+import time
+import numpy as np
+from seagul.mesh import create_mesh
+
+
+def brute_force_create_mesh(data, d):
+    mesh = []
+    weights = []
+    in_mesh = np.zeros(data.shape[0], dtype=bool)
+
+    for i, x in enumerate(data):
+        if in_mesh[i]:
+            continue
+        else:
+            in_criteria = np.linalg.norm(x - data, axis=1, ord=1) < d
+            in_mesh = np.logical_or(in_mesh, in_criteria)
+            mesh.append(x)
+            weights.append(np.sum(in_criteria))
+
+    return mesh, weights
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    max_brute_force_points = int(1e4)
+
+    for n_dims, d in [(3, .1), (10, .5), (20, 1.0)]:
+        for n_points in [int(1e4), int(1e5), int(1e6), int(1e7)]:
+            # normalized random walk, looks more like rollout data than uniform noise does. Done in place, at 1e7 x 20
+            # the data alone is 1.6GB
+            data = rng.standard_normal((n_points, n_dims))
+            np.cumsum(data, axis=0, out=data)
+            data -= data.mean(axis=0)
+            data /= data.std(axis=0)
+
+            start = time.time()
+            mesh, weights = create_mesh(data, d)
+            mesh_time = time.time() - start
+
+            if n_points <= max_brute_force_points:
+                start = time.time()
+                bf_mesh, bf_weights = brute_force_create_mesh(data, d)
+                bf_time = f"{time.time() - start:.2f}s"
+                assert len(bf_mesh) == len(mesh) and list(bf_weights) == list(weights)
+            else:
+                bf_time = "-"
+
+            print(f"{n_dims:>2} dims | {n_points:>8} points | {len(mesh):>6} mesh points | "
+                  f"create_mesh: {mesh_time:.2f}s | brute force: {bf_time}", flush=True)
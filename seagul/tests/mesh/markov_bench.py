@@ -0,0 +1,40 @@
+# Times the sparse Markov chain analytics in seagul.mesh on synthetic create_mesh_act transition tables, 8
+# perturbations per mesh point, mostly landing on nearby ids with a small chance of failing.
+import time
+import numpy as np
+from seagul.mesh import transition_matrix, absorption_probs, mean_first_passage, stationary_distribution
+
+
+def fake_transitions(n_states, n_perts, fail_prob, rng):
+    ids = np.arange(n_states)[:, None] + rng.randint(-50, 50, size=(n_states, n_perts))
+    ids = np.clip(ids, 1, n_states - 1)
+    ids[rng.uniform(size=ids.shape) < fail_prob] = 0
+    ids[0] = 0
+    return ids
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+
+    for n_states in [int(1e5), int(1e6)]:
+        transitions = fake_transitions(n_states, 8, 1e-3, rng)
+
+        start = time.time()
+        P = transition_matrix(transitions)
+        matrix_time = time.time() - start
+
+        start = time.time()
+        fail_probs = absorption_probs(P, 0)
+        absorb_time = time.time() - start
+
+        start = time.time()
+        steps = mean_first_passage(P, 0)
+        passage_time = time.time() - start
+
+        start = time.time()
+        p = stationary_distribution(P, max_iter=1000)
+        stationary_time = time.time() - start
+
+        print(f"{n_states:>8} states | matrix {matrix_time:.2f}s, absorption {absorb_time:.2f}s "
+              f"(min {fail_probs.min():.3f}), first passage {passage_time:.2f}s (mean {steps[1:].mean():.0f} steps), "
+              f"1000 power iterations {stationary_time:.2f}s")
@@ -0,0 +1,47 @@
+# Times seagul.mesh.mesh_dim on HalfCheetah sized (17 dim) random walk trajectories, against the old version that built
+# a dict of tuples with create_box_mesh at every scale.
+import time
+import numpy as np
+from seagul.mesh import mesh_dim
+import seagul.mesh
+
+
+def dict_count_boxes(data, d):
+    mesh = {}
+    keys = np.round(np.asarray(data) * (1 / d), decimals=0) * d
+    keys[keys == -0.0] = 0.0
+    for key in keys:
+        key = tuple(key)
+        if key in mesh:
+            mesh[key] += 1
+        else:
+            mesh[key] = 1
+    return len(mesh)
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    count_boxes = seagul.mesh.count_boxes
+
+    for n_points in [int(1e4), int(1e5), int(1e6)]:
+        data = rng.standard_normal((n_points, 17))
+        np.cumsum(data, axis=0, out=data)
+        data -= data.mean(axis=0)
+        data /= data.std(axis=0)
+
+        start = time.time()
+        mdim, cdim, mesh_sizes, d_vals = mesh_dim(data)
+        new_time = time.time() - start
+
+        if n_points <= int(1e5):
+            seagul.mesh.count_boxes = dict_count_boxes
+            start = time.time()
+            old_mdim, _, _, _ = mesh_dim(data)
+            old_time = f"{time.time() - start:.2f}s"
+            seagul.mesh.count_boxes = count_boxes
+            assert old_mdim == mdim
+        else:
+            old_time = "-"
+
+        print(f"{n_points:>8} x 17 | {len(d_vals)} scales | mdim {mdim:.3f} | "
+              f"mesh_dim: {new_time:.2f}s | dict of tuples: {old_time}", flush=True)
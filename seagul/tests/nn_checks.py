@@ -0,0 +1,49 @@
+# Behavior checks for seagul.nn, run this file directly, it asserts if anything is off.
+import dill
+import torch
+from torch import nn
+from seagul.nn import MLP, RunningMeanStd
+
+
+def check_compile_inference_matches_forward(policy, obs_size):
+    obs = torch.randn(obs_size)
+    with torch.no_grad():
+        if policy.input_bias is not None:
+            policy.input_bias.normal_()  # MLP leaves it uninitialized
+
+        regular_out = policy.compile_inference(False)(obs)
+        compiled_out = policy.compile_inference()(obs)
+        assert compiled_out.shape == regular_out.shape
+        assert torch.allclose(compiled_out, regular_out, atol=1e-5)
+        assert torch.equal(obs, obs.clone())  # the obs is left alone
+
+        # parameters and normalization changing under it get picked up on the next call
+        for param in policy.parameters():
+            param.add_(torch.randn_like(param))
+        if policy.obs_norm is not None:
+            policy.obs_norm.update(torch.randn(10, obs_size) * 3 + 1)
+        else:
+            policy.state_means = torch.randn(obs_size)
+        assert torch.allclose(policy(obs), policy.compile_inference(False)(obs), atol=1e-5)
+
+        # batches and calls with grad on go through the regular forward
+        policy.compile_inference()
+        batch_obs = torch.randn(5, obs_size)
+        assert torch.allclose(policy(batch_obs), policy.compile_inference(False)(batch_obs))
+
+    policy.compile_inference()
+    assert policy(obs).requires_grad
+    assert dill.loads(dill.dumps(policy)).inference_compiled
+
+
+if __name__ == "__main__":
+    check_compile_inference_matches_forward(MLP(17, 6, 2, 64), 17)
+    check_compile_inference_matches_forward(MLP(4, 1, 3, 12, activation=nn.Tanh, output_activation=nn.Tanh), 4)
+    check_compile_inference_matches_forward(MLP(4, 2, 1, 8, activation=nn.LeakyReLU, input_bias=True), 4)
+    check_compile_inference_matches_forward(MLP(4, 2, 1, 8, activation=nn.ELU, bias=False), 4)
+
+    policy = MLP(6, 3, 2, 16)
+    policy.obs_norm = RunningMeanStd(6)
+    check_compile_inference_matches_forward(policy, 6)
+
+    print("all checks passed")
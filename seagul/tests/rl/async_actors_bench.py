@@ -0,0 +1,45 @@
+# Times sac with the usual alternating loop against the same number of env steps and updates with actors. The env
+# gets a fixed latency added to every step (like a slow simulator, or hardware running in real time), the actors can
+# only help as far as the learner has something to do while an env step waits, and as far as there are cores for them.
+import time
+import gym
+import seagul.envs
+from seagul.nn import MLP
+from seagul.rl.sac import sac, SACModel
+
+
+class LatencyWrapper(gym.Wrapper):
+    def __init__(self, env, latency):
+        super(LatencyWrapper, self).__init__(env)
+        self.latency = latency
+
+    def step(self, action):
+        time.sleep(self.latency)
+        return self.env.step(action)
+
+
+def make_latency_acrobot(latency=0.0):
+    return LatencyWrapper(gym.make("su_acrobot-v0"), latency)
+
+
+gym.envs.registration.register(id="latency_su_acrobot-v0", entry_point=make_latency_acrobot)
+
+
+if __name__ == "__main__":
+    train_steps, env_max_steps = 20000, 500
+    env = gym.make("su_acrobot-v0")
+    obs_size, act_size = env.observation_space.shape[0], env.action_space.shape[0]
+
+    for latency in [0.0, 1e-3, 1e-2]:
+        for n_actors in [0, 1, 3]:
+            model = SACModel(MLP(obs_size, 2 * act_size, 2, 64), MLP(obs_size, 1, 2, 64),
+                             MLP(obs_size + act_size, 1, 2, 64), MLP(obs_size + act_size, 1, 2, 64), 25)
+
+            start = time.time()
+            _, _, var_dict = sac("latency_su_acrobot-v0", train_steps, model, env_config={"latency": latency},
+                                 env_max_steps=env_max_steps, iters_per_update=env_max_steps, n_actors=n_actors,
+                                 utd_ratio=1.0)
+            total_time = time.time() - start
+
+            print(f"{latency * 1e3:.0f}ms latency, n_actors={n_actors}: {total_time:.1f}s, "
+                  f"{var_dict['cur_total_steps'] / total_time:.0f} env steps/s, {len(var_dict['val_loss_hist'])} updates")
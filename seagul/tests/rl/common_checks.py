@@ -0,0 +1,162 @@
+# Behavior checks for seagul.rl.common, run this file directly, it asserts if anything is off.
+import copy
+import gym
+import numpy as np
+import torch
+from seagul.nn import MLP
+from seagul.rl.common import discount_cumsum, ReplayBuffer, PrioritizedReplayBuffer, PolyakTarget, EpisodeBuffer, \
+    run_episode, MinibatchSampler
+
+
+def masked_loop_discount_cumsum(rewards, discount, dones, last_value):
+    cumulative_rewards = np.empty_like(rewards)
+    future_cumulative_reward = last_value
+    for i in range(rewards.shape[0] - 1, -1, -1):
+        future_cumulative_reward = rewards[i] + discount * (1 - dones[i]) * future_cumulative_reward
+        cumulative_rewards[i] = future_cumulative_reward
+    return cumulative_rewards
+
+
+def check_discount_cumsum():
+    rng = np.random.RandomState(0)
+    rews = rng.standard_normal((500, 8))
+    dones = rng.rand(500, 8) < .05
+    dones[:, 0] = False  # one env that never finishes, only the bootstrap
+    dones[-1, 1] = True  # and one that finishes on the last step, so the bootstrap shouldn't leak in
+    last_value = rng.standard_normal(8)
+
+    ret = discount_cumsum(torch.as_tensor(rews), .97, dones, last_value=last_value)
+    assert ret.shape == rews.shape
+    assert np.allclose(ret.numpy(), masked_loop_discount_cumsum(rews, .97, dones, last_value))
+
+    ret = discount_cumsum(rews[:, 0], .97)
+    assert np.allclose(ret.numpy(), masked_loop_discount_cumsum(rews[:, 0], .97, np.zeros(500), 0.0))
+
+
+def check_replay_buffer_next_obs():
+    # obs are (episode, step), so the right next obs for any sampled obs is just one step further along
+    for share_next_obs in [True, False]:
+        buf = ReplayBuffer(2, 1, 50, share_next_obs=share_next_obs)
+        for ep in range(40):
+            ep_len = np.random.randint(1, 12)
+            obs = np.stack((np.full(ep_len + 1, ep), np.arange(ep_len + 1)), axis=1)
+            buf.store(obs[:-1], obs[1:], np.zeros(ep_len), obs[:-1, 1], np.arange(ep_len) == ep_len - 1)
+            assert buf.n_valid == buf.data["valid"][:buf.size].sum()
+
+            obs1, obs2, acts, rews, done = buf.sample_batch(256)
+            assert (obs2[:, 0] == obs1[:, 0]).all() and (obs2[:, 1] == obs1[:, 1] + 1).all()
+            assert (rews[:, 0] == obs1[:, 1]).all()
+            assert obs1[:, 0].min() > ep - 50  # nothing older than what fits should still be around
+
+    # with one row there is only ever room for the next obs, so there's nothing valid to sample
+    buf = ReplayBuffer(2, 1, 1)
+    buf.store(np.zeros((1, 2)), np.ones((1, 2)), np.zeros(1), np.zeros(1), np.zeros(1))
+    try:
+        buf.sample_batch(8)
+        assert False, "sampling from a buffer with no valid rows should raise"
+    except ValueError:
+        pass
+
+
+def check_prioritized_replay_buffer():
+    # 4 episodes of 5 steps, so 20 transitions and 4 next obs only rows that should never come up
+    buf = PrioritizedReplayBuffer(1, 1, 100, alpha=1.0, beta=.5, eps=0.0)
+    for ep in range(4):
+        obs = np.arange(6).reshape(-1, 1) + 10 * ep
+        buf.store(obs[:-1], obs[1:], np.zeros(5), np.zeros(5), np.zeros(5))
+    assert buf.size == 24 and buf.n_valid == 20
+
+    valid_rows = np.nonzero(buf.data["valid"][:buf.size])[0]
+    priorities = np.arange(1, 21, dtype=np.float64)
+    buf.update_priorities(valid_rows, priorities)
+
+    obs1, obs2, acts, rews, done, weights, idxs = buf.sample_batches(5, 20000)
+    idxs = idxs.numpy()
+    assert np.isin(idxs, valid_rows).all()
+
+    # stratified per batch, each of the 5 samples comes from its own fifth of the total priority (a row straddling a
+    # boundary can show up in either of the two)
+    rank = np.searchsorted(valid_rows, idxs)
+    strata = np.searchsorted(np.cumsum(priorities), (np.arange(5) + 1) * priorities.sum() / 5, side="left")
+    lower = np.concatenate(([0], strata[:-1]))
+    assert ((rank >= lower) & (rank <= strata)).all()
+
+    # overall, rows come up in proportion to their priority
+    freqs = np.bincount(rank.reshape(-1), minlength=20) / rank.size
+    assert np.abs(freqs - priorities / priorities.sum()).max() < .01
+
+    # weights are (N * P(i))^-beta with N the number of valid rows, normalized by the max within each batch
+    expected = (20 * priorities[rank] / priorities.sum()) ** -.5
+    expected = expected / expected.max(axis=-1, keepdims=True)
+    assert np.allclose(weights[..., 0].numpy(), expected, atol=1e-6)
+    assert (weights.max(dim=1)[0] == 1).all()
+
+
+def check_polyak_target():
+    fn = MLP(5, 2, 2, 16)
+    target_fn = MLP(5, 2, 2, 16)
+    expected = copy.deepcopy(target_fn)
+
+    polyak_target = PolyakTarget(fn, target_fn)
+    for _ in range(3):
+        polyak_target.update(.9)
+        for param, target_param in zip(fn.parameters(), expected.parameters()):
+            target_param.data = .9 * target_param.data + .1 * param.data
+
+    for target_param, expected_param in zip(target_fn.parameters(), expected.parameters()):
+        assert torch.allclose(target_param, expected_param, atol=1e-6)
+
+
+class CountingEnv(gym.Env):
+    observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(1,))
+    action_space = gym.spaces.Box(-np.inf, np.inf, shape=(1,))
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(1)
+
+    def step(self, act):
+        self.t += 1
+        return np.full(1, self.t), 0.0, self.t >= 3, {}
+
+
+def check_run_episode_keeps_obs():
+    # act_fn gets a view of the obs in the buffer, a policy that modifies its input would rewrite the episode
+    policy = MLP(1, 1, 0, 0, input_bias=True)
+    with torch.no_grad():
+        policy.input_bias.fill_(100)
+
+    buf = EpisodeBuffer(1, 1, 3)
+    for compiled in [False, True]:
+        policy.compile_inference(compiled)
+        with torch.set_grad_enabled(not compiled):
+            run_episode(CountingEnv(), policy, buf)
+        assert (buf.obs1[:, 0] == torch.tensor([0., 1., 2.])).all()
+        assert (buf.obs2[:, 0] == torch.tensor([1., 2., 3.])).all()
+
+
+def check_minibatch_sampler():
+    sampler = MinibatchSampler(64)
+    for n in [1000, 30, 64]:
+        # row i of every tensor holds i, so each minibatch can be checked for rows that don't line up across tensors
+        rows = torch.arange(n)
+        obs = rows[:, None].float().repeat(1, 3)
+        for epoch in range(2):
+            seen = []
+            for local_rows, local_obs in sampler.epoch(rows, obs):
+                assert local_rows.shape[0] <= 64
+                assert (local_obs == local_rows[:, None].float()).all()
+                seen.append(local_rows.clone())  # the minibatches are views into the sampler's buffers
+
+            seen = torch.cat(seen)
+            assert seen.shape[0] == n and (seen.sort()[0] == rows).all()
+
+
+if __name__ == "__main__":
+    check_discount_cumsum()
+    check_replay_buffer_next_obs()
+    check_prioritized_replay_buffer()
+    check_polyak_target()
+    check_run_episode_keeps_obs()
+    check_minibatch_sampler()
+    print("all checks passed")
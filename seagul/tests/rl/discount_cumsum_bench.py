@@ -0,0 +1,37 @@
+# Times discount_cumsum against the old per element loop, on one long episode and on the same number of steps split
+# into episodes across 64 envs side by side.
+import time
+import torch
+from seagul.rl.common import discount_cumsum
+
+
+def loop_discount_cumsum(rewards, discount):
+    future_cumulative_reward = 0
+    cumulative_rewards = torch.empty_like(torch.as_tensor(rewards))
+    for i in range(len(rewards) - 1, -1, -1):
+        cumulative_rewards[i] = rewards[i] + discount * future_cumulative_reward
+        future_cumulative_reward = cumulative_rewards[i]
+    return cumulative_rewards
+
+
+if __name__ == "__main__":
+    for num_steps in [int(1e3), int(1e4), int(1e5), int(1e6)]:
+        rews = torch.randn(num_steps, 1)
+
+        start = time.time()
+        loop_ret = loop_discount_cumsum(rews, .99)
+        loop_time = time.time() - start
+
+        start = time.time()
+        ret = discount_cumsum(rews, .99)
+        filt_time = time.time() - start
+
+        # same thing split into 1000 step episodes, 64 envs side by side
+        rews = torch.randn(num_steps // 64 + 1, 64)
+        dones = torch.rand(num_steps // 64 + 1, 64) < 1e-3
+        start = time.time()
+        discount_cumsum(rews, .99, dones, last_value=torch.zeros(64))
+        batch_time = time.time() - start
+
+        print(f"{num_steps:>8} steps | loop: {loop_time:.4f}s | lfilter: {filt_time:.4f}s | "
+              f"64 envs w/ dones: {batch_time:.4f}s | max err: {(loop_ret - ret).abs().max().item():.2e}")
@@ -0,0 +1,57 @@
+# Times the rollout loop overhead of run_episode + EpisodeBuffer against the old list append + torch.stack version,
+# with an env that does nothing so only the bookkeeping is timed.
+import time
+import gym
+import numpy as np
+import torch
+from seagul.rl.common import EpisodeBuffer, run_episode
+
+
+class NullEnv(gym.Env):
+    observation_space = gym.spaces.Box(-1, 1, shape=(17,))
+    action_space = gym.spaces.Box(-1, 1, shape=(6,))
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(17)
+
+    def step(self, act):
+        self.t += 1
+        return np.zeros(17), 0.0, self.t >= 1000, {}
+
+
+def list_rollout(env, act_fn):
+    obs1_list, obs2_list, acts_list, rews_list, done_list = [], [], [], [], []
+    obs = env.reset()
+    done = False
+    while not done:
+        obs = torch.as_tensor(obs, dtype=torch.float32)
+        obs1_list.append(obs.clone())
+        act = act_fn(obs)
+        obs, rew, done, _ = env.step(act.numpy().reshape(-1))
+        obs = torch.as_tensor(obs, dtype=torch.float32)
+        acts_list.append(act.clone())
+        rews_list.append(torch.as_tensor(rew, dtype=torch.float32))
+        obs2_list.append(obs.clone())
+        done_list.append(torch.as_tensor(done))
+    return (torch.stack(obs1_list), torch.stack(obs2_list), torch.stack(acts_list),
+            torch.stack(rews_list).reshape(-1, 1), torch.stack(done_list).reshape(-1, 1))
+
+
+if __name__ == "__main__":
+    env = NullEnv()
+    act = torch.zeros(6)
+    act_fn = lambda obs: act
+    buf = EpisodeBuffer(17, 6, 1000)
+
+    start = time.time()
+    for _ in range(20):
+        list_rollout(env, act_fn)
+    list_time = (time.time() - start) / 20
+
+    start = time.time()
+    for _ in range(20):
+        run_episode(env, act_fn, buf)
+    buf_time = (time.time() - start) / 20
+
+    print(f"1000 step episode overhead | list + stack: {list_time * 1e3:.1f}ms | EpisodeBuffer: {buf_time * 1e3:.1f}ms")
@@ -0,0 +1,28 @@
+# Times one epoch of minibatches over a PPO sized batch, MinibatchSampler against the DataLoader some of the PPO
+# variants used.
+import time
+import torch
+from torch.utils import data
+from seagul.rl.common import MinibatchSampler
+
+
+if __name__ == "__main__":
+    n_samples, batch_size, n_epochs = 4096, 64, 20
+    batch = [torch.randn(n_samples, 17), torch.randn(n_samples, 6), torch.randn(n_samples, 1), torch.randn(n_samples, 1)]
+
+    loader = data.DataLoader(data.TensorDataset(*batch), batch_size=batch_size, shuffle=True)
+    start = time.time()
+    for _ in range(n_epochs):
+        for minibatch in loader:
+            pass
+    loader_time = (time.time() - start) / n_epochs
+
+    sampler = MinibatchSampler(batch_size)
+    start = time.time()
+    for _ in range(n_epochs):
+        for minibatch in sampler.epoch(*batch):
+            pass
+    sampler_time = (time.time() - start) / n_epochs
+
+    print(f"{n_samples} sample epoch, {batch_size} minibatches | DataLoader: {loader_time * 1e3:.1f}ms | "
+          f"MinibatchSampler: {sampler_time * 1e3:.1f}ms")
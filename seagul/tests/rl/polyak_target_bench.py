@@ -0,0 +1,37 @@
+# Times PolyakTarget.update against the old state_dict round trip for updating a target network.
+import time
+import torch
+from seagul.nn import MLP
+from seagul.rl.common import PolyakTarget
+
+
+def state_dict_update_target_fn(fn, target_fn, polyak):
+    fn_sd = fn.state_dict()
+    target_sd = target_fn.state_dict()
+    for layer in target_sd:
+        target_sd[layer] = polyak * target_sd[layer] + (1 - polyak) * fn_sd[layer]
+
+    target_fn.load_state_dict(target_sd)
+    return target_fn
+
+
+if __name__ == "__main__":
+    torch.set_num_threads(1)
+    n_updates = 2000
+    for layer_size in [64, 256]:
+        fn = MLP(17, 6, 2, layer_size)
+        target_fn = MLP(17, 6, 2, layer_size)
+        polyak_target = PolyakTarget(fn, target_fn)
+
+        start = time.time()
+        for _ in range(n_updates):
+            state_dict_update_target_fn(fn, target_fn, .995)
+        sd_time = time.time() - start
+
+        start = time.time()
+        for _ in range(n_updates):
+            polyak_target.update(.995)
+        inplace_time = time.time() - start
+
+        print(f"{layer_size:>4} unit MLP | state_dict: {n_updates / sd_time:.0f} updates/sec | "
+              f"PolyakTarget: {n_updates / inplace_time:.0f} updates/sec")
@@ -0,0 +1,22 @@
+# Times sampling minibatches from a full 1e6 transition buffer, uniform ReplayBuffer against PrioritizedReplayBuffer
+# (including updating the priorities of everything sampled).
+import time
+import numpy as np
+from seagul.rl.common import ReplayBuffer, PrioritizedReplayBuffer
+
+
+if __name__ == "__main__":
+    obs_dim, act_dim, capacity, batch_size, n_batches = 17, 6, int(1e6), 256, 100
+    for buf in [ReplayBuffer(obs_dim, act_dim, capacity), PrioritizedReplayBuffer(obs_dim, act_dim, capacity)]:
+        for _ in range(capacity // 1000):
+            obs = np.random.randn(1001, obs_dim)
+            buf.store(obs[:-1], obs[1:], np.random.randn(1000, act_dim), np.random.randn(1000), np.zeros(1000))
+
+        start = time.time()
+        for _ in range(10):
+            batches = buf.sample_batches(batch_size, n_batches)
+            if isinstance(buf, PrioritizedReplayBuffer):
+                buf.update_priorities(batches[-1], np.random.randn(n_batches, batch_size))
+        sample_time = time.time() - start
+
+        print(f"{type(buf).__name__:>24} | {capacity} capacity | {10 * n_batches * batch_size / sample_time:.0f} samples/sec")